@@ -1,3 +1,5 @@
+import time
+_IMPORT_START = time.perf_counter()  # startup breakdown (src/startup.py) counts from here
 import warnings
 warnings.filterwarnings(
     "ignore",
@@ -9,39 +11,45 @@ import io
 import json
 from flask_cors import CORS
 import uuid
-import time
+import hmac
 import random
 import logging
 import datetime
 import threading
-from typing import List, Optional
-from gtts import gTTS
-from flask import send_file
-import tempfile
+import multiprocessing
+from typing import Callable, List, Optional
 from flask import abort
 
 from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, jsonify, request, Response, send_from_directory
+from flask import Flask, g, has_request_context, render_template, jsonify, request, Response, send_from_directory
 from werkzeug.utils import secure_filename
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-import pytesseract
-pytesseract.pytesseract.tesseract_cmd = "/usr/bin/tesseract"
-from PIL import Image
-import cv2
-from pypdf import PdfReader
-
 import smtplib
 from email.mime.text import MIMEText
 
 # Project-specific imports (keep unchanged if present)
 # ---- REQUIRED imports (FAIL FAST) ----
-from src.helper import download_hugging_face_embeddings
+from src.helper import EMBED_BACKEND, download_hugging_face_embeddings
+from src.chat_store import create_chat_store, make_title
+from src.conversation_state import create_state_store
+from src.answer_cache import SemanticAnswerCache, fingerprint
+from src.singleflight import SingleFlight, make_key
+from src.ocr_service import OCRService, OCR_PIPELINE_VERSION, TESSERACT_CONFIG, is_pdf
+from src.ocr_cache import OCRCache
+from src.tts import AudioCache, TTSService, load_engine
+from src.translation import Translator, load_backend as load_translation_backend, parse_language
+from src.rerank import CrossEncoderReranker, RerankingRetriever
+from src.context_packer import SEPARATOR as CONTEXT_SEPARATOR, ContextPacker, make_token_counter
+from src.intent import CentroidIntentClassifier, detect_intent as detect_rule_intent
+from src.startup import Components, StartupTimer
+from src.metrics import MetricsRegistry, TimedProxy, executor_queue_depth
+from src.tracing import SamplingProfiler, Tracer
 
 # ---- OPTIONAL imports (ISOLATED) ----
 try:
@@ -54,10 +62,21 @@ try:
 except Exception:
     PineconeVectorStore = None
 
-# Twilio
-from twilio.twiml.messaging_response import MessagingResponse
-from twilio.rest import Client as TwilioClient
-from twilio.base.exceptions import TwilioRestException
+try:
+    from src.vector_index import LocalVectorStore
+except Exception:
+    LocalVectorStore = None
+
+try:
+    from src.lexical_index import HybridRetriever, LexicalIndex
+except Exception:
+    HybridRetriever = LexicalIndex = None
+
+# gTTS, pytesseract and twilio are imported on first use (see /readyz for what is warm)
+
+startup_timer = StartupTimer(_IMPORT_START)
+startup_timer.mark("imports")
+components = Components()
 
 # ---------------- app config ----------------
 app = Flask(__name__, static_folder="static", template_folder="templates")
@@ -73,6 +92,15 @@ CHATS_FILE = os.getenv("CHATS_FILE", "chats.json")
 chats_dir = os.path.dirname(os.path.abspath(CHATS_FILE))
 if chats_dir and not os.path.exists(chats_dir):
     os.makedirs(chats_dir, exist_ok=True)
+# "sqlite" (default, WAL) | "log" (per-chat append-only files) | "json" (legacy chats.json)
+CHAT_STORE = os.getenv("CHAT_STORE", "sqlite")
+CHAT_STORE_PATH = os.getenv("CHAT_STORE_PATH") or None
+# Per-sender follow-up state (see src/conversation_state.py): "sqlite" is shared by workers, "memory" is not
+STATE_STORE = os.getenv("STATE_STORE", "sqlite")
+STATE_STORE_PATH = os.getenv("STATE_STORE_PATH", "conversation_state.db")
+STATE_TTL = float(os.getenv("STATE_TTL", "21600"))  # seconds since the sender's last update
+STATE_MAX_SENDERS = int(os.getenv("STATE_MAX_SENDERS", "10000"))
+STATE_MAX_MB = float(os.getenv("STATE_MAX_MB", "16"))
 
 # ---------------- env & logging ----------------
 load_dotenv()
@@ -88,17 +116,121 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD", "")
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")  # faster default
 CHAT_TEMPERATURE = float(os.getenv("CHAT_TEMPERATURE", "0.7"))
 CHAT_MAX_TOKENS = int(os.getenv("CHAT_MAX_TOKENS", "1000"))
+# /stream line framing: an unfinished line is sent once it is this long or this old
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "64"))
+STREAM_FLUSH_MS = float(os.getenv("STREAM_FLUSH_MS", "150"))
 RAG_K = int(os.getenv("RAG_K", "1"))  # default k for retrieval (1 for speed)
+# Hybrid retrieval: BM25 over the ingested chunks (built by store_index.py) fused with dense results.
+# "auto" enables it when LEXICAL_INDEX_DIR exists.
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "auto").lower()
+LEXICAL_INDEX_DIR = os.getenv("LEXICAL_INDEX_DIR", "lexical_index")
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "8"))  # per retriever, before fusion
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "1.0"))
+# Cross-encoder rerank (see src/rerank.py): over-fetch RERANK_CANDIDATES, keep the best RAG_K
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "0") == "1"
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "8"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "150"))  # else retriever order is kept
+RERANK_WORKERS = int(os.getenv("RERANK_WORKERS", "1"))  # concurrent scoring passes
+RERANK_TORCH_THREADS = int(os.getenv("RERANK_TORCH_THREADS", "0")) or None
+# Context packing (see src/context_packer.py): dedup + MMR + whole sentences up to a token budget.
+# CONTEXT_PACKER=0 restores the old 800-character slices.
+CONTEXT_PACKER = os.getenv("CONTEXT_PACKER", "1") == "1"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "512"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))  # 1 = retriever order only
+CONTEXT_MAX_CHUNK_TOKENS = int(os.getenv("CONTEXT_MAX_CHUNK_TOKENS", "0")) or None
+
+# Semantic answer cache (near-duplicate questions skip retrieval + LLM)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.92"))  # cosine similarity
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2048"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))  # seconds
+
+# EMBED_BACKEND=onnx|onnx-int8 (src/helper.py): re-embedded index chunks must match stored vectors (local index)
+EMBED_PARITY_MIN = float(os.getenv("EMBED_PARITY_MIN", "0.98"))  # min cosine; 0 disables the check
+
+# Intent: keyword rules always; embedding nearest-centroid for messages the rules leave as "other"
+INTENT_EMBEDDINGS = os.getenv("INTENT_EMBEDDINGS", "0") == "1"
+INTENT_CENTROID_THRESHOLD = float(os.getenv("INTENT_CENTROID_THRESHOLD", "0.45"))  # cosine
+
+# Single-flight: identical questions arriving while one is being answered wait for it
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1") == "1"
+
+# Request tracing (see src/tracing.py): span tree per request; slow ones are logged with the tree
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "50"))  # slow traces kept for /api/traces/slow
+# Sampling profiles (folded stacks) written to PROFILE_DIR for a random PROFILE_SAMPLE_RATE of
+# requests and for requests sent with "X-Profile: <PROFILE_TOKEN>" (no header trigger without a token)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+# OCR process pool (see src/ocr_service.py)
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 2)))
+OCR_QUEUE_SIZE = int(os.getenv("OCR_QUEUE_SIZE", str(OCR_WORKERS * 4)))  # queued + running jobs
+OCR_DEADLINE = float(os.getenv("OCR_DEADLINE", "20"))  # seconds per job, from submission
+OCR_SUBMIT_TIMEOUT = float(os.getenv("OCR_SUBMIT_TIMEOUT", "2"))  # wait for a queue slot
+OCR_START_METHOD = os.getenv("OCR_START_METHOD", "spawn")  # workers only import src/ocr_service.py
+# image preprocessing (see src/ocr_preprocess.py); OCR_PREPROCESS=legacy restores the old path
+if os.getenv("OCR_PREPROCESS", "adaptive").lower() == "legacy":
+    OCR_PREPROCESS_OPTIONS = {"mode": "legacy"}
+else:
+    OCR_PREPROCESS_OPTIONS = {
+        "max_side": int(os.getenv("OCR_MAX_SIDE", "2200")),      # px, when the file has no DPI
+        "target_dpi": int(os.getenv("OCR_TARGET_DPI", "300")),
+        "crop": os.getenv("OCR_CROP", "1") == "1",
+        "deskew": os.getenv("OCR_DESKEW", "1") == "1",
+        "auto_psm": os.getenv("OCR_AUTO_PSM", "1") == "1",
+    }
+
+# PDFs: page batches run in parallel; pages without a text layer are rasterised and OCR'd
+OCR_PDF_MAX_PAGES = int(os.getenv("OCR_PDF_MAX_PAGES", "50"))
+OCR_PDF_MAX_BYTES = int(os.getenv("OCR_PDF_MAX_BYTES", "200000"))  # extracted text
+OCR_PDF_PAGES_PER_JOB = int(os.getenv("OCR_PDF_PAGES_PER_JOB", "2"))
+OCR_PDF_DEADLINE = float(os.getenv("OCR_PDF_DEADLINE", "90"))  # seconds for the whole document
+OCR_PDF_RASTER_DPI = int(os.getenv("OCR_PDF_RASTER_DPI", "200"))
+# WhatsApp: a PDF still being read after this many seconds gets one progress message (0 = never)
+OCR_PROGRESS_AFTER = float(os.getenv("OCR_PROGRESS_AFTER", "5"))
+
+# OCR result cache keyed by file hash (see src/ocr_cache.py)
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "1") == "1"
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", "ocr_cache.db")  # shared by workers on the host
+OCR_CACHE_MAX_MB = float(os.getenv("OCR_CACHE_MAX_MB", "64"))  # stored text
+OCR_CACHE_MODE = os.getenv("OCR_CACHE_MODE", "content")  # content | perceptual (also matches re-compressed copies)
+OCR_CACHE_PHASH_DISTANCE = int(os.getenv("OCR_CACHE_PHASH_DISTANCE", "4"))  # max differing bits of 256
+
+# Text-to-speech: sentences synthesized in parallel, cached per sentence (see src/tts.py)
+TTS_ENGINE = os.getenv("TTS_ENGINE", "gtts")  # gtts | silent (offline) | package.module:Class
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))  # concurrent syntheses per process
+TTS_SEGMENT_CHARS = int(os.getenv("TTS_SEGMENT_CHARS", "200"))  # sentences are packed up to this length
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "30"))  # seconds per segment
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE_ENABLED", "1") == "1"
+TTS_CACHE_PATH = os.getenv("TTS_CACHE_PATH", "tts_cache.db")  # shared by workers on the host
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "128"))  # stored audio
+
+# "answer in Kannada" translates the sender's last answer (see src/translation.py)
+TRANSLATE_BACKEND = os.getenv("TRANSLATE_BACKEND", "llm")  # llm | google | stub (offline) | package.module:Class
+TRANSLATE_CACHE_SIZE = int(os.getenv("TRANSLATE_CACHE_SIZE", "4096"))  # translated lines
+TRANSLATE_MAX_TOKENS = int(os.getenv("TRANSLATE_MAX_TOKENS", "2000"))  # llm backend, per call
 
 # caches for HF
 os.environ["HF_HOME"] = os.getenv("HF_HOME", "./hf_cache")
 os.environ["TRANSFORMERS_CACHE"] = os.getenv("TRANSFORMERS_CACHE", "./hf_cache")
 os.environ["HF_DATASETS_CACHE"] = os.getenv("HF_DATASETS_CACHE", "./hf_cache")
 
-# Tesseract (adjust path on Windows)
-tess_path = os.getenv("TESSERACT_PATH")
-if tess_path:
-    pytesseract.pytesseract.tesseract_cmd = tess_path
+# Tesseract (adjust path on Windows); only the OCR pool workers load pytesseract
+TESSERACT_CMD = os.getenv("TESSERACT_PATH") or "/usr/bin/tesseract"
+
+# RAG init (embeddings + index): "eager" at import, "background" thread at import (the port opens
+# right away; requests wait up to RAG_INIT_WAIT), "lazy" on the first request that needs it.
+# Preloaded gunicorn masters (gunicorn.conf.py sets APP_PRELOAD=1) always load eagerly so the
+# workers share the loaded model pages copy-on-write.
+APP_PRELOAD = os.getenv("APP_PRELOAD", "0") == "1"
+RAG_INIT_MODE = "eager" if APP_PRELOAD else os.getenv("RAG_INIT_MODE", "background").lower()
+RAG_INIT_WAIT = float(os.getenv("RAG_INIT_WAIT", "60"))  # seconds
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
 logger = logging.getLogger("medical-chatbot")
@@ -115,17 +247,145 @@ def make_requests_session(total_retries=3, backoff_factor=0.5, status_forcelist=
 
 requests_session = make_requests_session()
 
+# ---------------- metrics (src/metrics.py, served at /metrics) ----------------
+metrics = MetricsRegistry(prefix="medibot_")
+metrics.describe("stage_seconds", "histogram", "Latency of one pipeline stage.")
+metrics.describe("request_seconds", "histogram", "Time to response headers by route.")
+metrics.describe("requests_total", "counter", "Requests by route and channel.")
+metrics.describe("request_errors_total", "counter", "Failed requests, including errors answered with a message.")
+metrics.describe("retries_total", "counter", "Retried upstream calls by kind.")
+metrics.describe("executor_queue_depth", "gauge", "Jobs waiting for a worker thread or process.")
+STAGES = ("intent", "embed", "retrieve", "context", "llm", "llm_first_token", "translate", "ocr", "tts",
+          "chat_store")
+stage_timers = {name: metrics.histogram("stage_seconds", stage=name) for name in STAGES}
+
+
+def _observe_stage(name: str, seconds: float):
+    hist = stage_timers.get(name)
+    if hist is not None:
+        hist.observe(seconds)
+
+
+# every tracer.span/record also feeds the stage histogram of the same name
+tracer = Tracer(
+    slow_seconds=TRACE_SLOW_MS / 1000.0,
+    keep=TRACE_KEEP,
+    enabled=TRACE_ENABLED,
+    on_span=_observe_stage,
+    profiler=SamplingProfiler(PROFILE_DIR, interval=PROFILE_INTERVAL_MS / 1000.0),
+)
+
+
+def should_profile(header_value: Optional[str]) -> bool:
+    if PROFILE_TOKEN and header_value and hmac.compare_digest(header_value, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def request_channel(route: str) -> str:
+    if route.startswith("/whatsapp"):
+        return "whatsapp"
+    if route.startswith("/sms"):
+        return "sms"
+    return "web"
+
+
+def record_request(route: str, status: int, seconds: float, error: bool = False):
+    channel = request_channel(route)
+    metrics.inc("requests_total", route=route, channel=channel)
+    metrics.observe("request_seconds", seconds, route=route, channel=channel)
+    if error or status >= 500:
+        metrics.inc("request_errors_total", route=route, channel=channel)
+
+
+def mark_request_error(route: Optional[str] = None):
+    """Count a failure that was answered with a message (HTTP 200) or happened after the response."""
+    if route is None and has_request_context():
+        g.metrics_error = True
+    elif route is not None:
+        metrics.inc("request_errors_total", route=route, channel=request_channel(route))
+
 # ---------------- RAG lazy init (thread-safe singletons) ----------------
 # NOTE: we initialize once at startup. We DO NOT re-initialize on each request.
 _rag_lock = threading.Lock()
 _rag_initialized = False
+_rag_ready = threading.Event()  # set once the first init attempt finished (ok or failed)
+_rag_thread: Optional[threading.Thread] = None
 _rag_init_error: Optional[str] = None
 rag_retriever = None
 embeddings = None
 pinecone_index_name = os.getenv("PINECONE_INDEX", "medical-chatbot")
+# "pinecone" (remote) | "local" (in-process index built by store_index.py, see src/vector_index.py)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone").lower()
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "vector_index")
+
+conversation_state = create_state_store(
+    STATE_STORE,
+    STATE_STORE_PATH,
+    max_senders=STATE_MAX_SENDERS,
+    max_bytes=int(STATE_MAX_MB * (1 << 20)),
+    ttl=STATE_TTL,
+)
+
+answer_cache = SemanticAnswerCache(
+    threshold=ANSWER_CACHE_THRESHOLD,
+    max_entries=ANSWER_CACHE_SIZE,
+    ttl=ANSWER_CACHE_TTL,
+)
+rag_singleflight = SingleFlight()
+intent_classifier = None  # CentroidIntentClassifier, set once embeddings are loaded
+reranker = None  # CrossEncoderReranker when RERANK_ENABLED
+context_packer = ContextPacker(
+    budget=CONTEXT_TOKEN_BUDGET,
+    mmr_lambda=CONTEXT_MMR_LAMBDA,
+    max_chunk_tokens=CONTEXT_MAX_CHUNK_TOKENS,
+)  # token counter switches to the chat model's tokenizer in initialize_rag_once
+
+
+def _vector_index_fingerprint():
+    """Identifies the index contents so cached answers are dropped after a re-index."""
+    if VECTOR_BACKEND == "local":
+        try:
+            st = os.stat(os.path.join(LOCAL_INDEX_DIR, "meta.json"))
+            return f"local:{os.path.abspath(LOCAL_INDEX_DIR)}:{st.st_mtime_ns}"
+        except OSError:
+            return f"local:{LOCAL_INDEX_DIR}"
+    return f"pinecone:{pinecone_index_name}"
+
+
+def _hybrid_enabled():
+    if HYBRID_SEARCH == "auto":
+        return os.path.exists(os.path.join(LEXICAL_INDEX_DIR, "meta.json"))
+    return HYBRID_SEARCH in ("1", "true", "on")
 
-conversation_topic = {}
-last_user_query = {}
+
+def _lexical_index_fingerprint():
+    if not _hybrid_enabled():
+        return "dense"
+    try:
+        return f"hybrid:{os.stat(os.path.join(LEXICAL_INDEX_DIR, 'meta.json')).st_mtime_ns}:{HYBRID_CANDIDATES}"
+    except OSError:
+        return "hybrid"
+
+
+def _check_embedding_parity(index):
+    """Non-torch embedding backends must reproduce the vectors the local index was built with."""
+    if EMBED_BACKEND == "torch" or EMBED_PARITY_MIN <= 0:
+        return
+    from src.onnx_embeddings import index_parity
+    try:
+        parity = index_parity(embeddings, index)
+    except Exception as e:
+        logger.warning("Embedding parity check failed to run: %s", e)
+        return
+    if parity is None:
+        return
+    if parity["min"] < EMBED_PARITY_MIN:
+        logger.error("Embedding backend %s does not match the index (min cosine %.4f < %.4f); "
+                     "re-index with this backend or switch EMBED_BACKEND", EMBED_BACKEND, parity["min"],
+                     EMBED_PARITY_MIN)
+    else:
+        logger.info("Embedding parity with the index: min cosine %.4f, mean %.4f", parity["min"], parity["mean"])
 
 
 def initialize_rag_once(force=False):
@@ -133,7 +393,7 @@ def initialize_rag_once(force=False):
     Lazy, thread-safe initialization of embeddings and retriever.
     Use force=True to reinitialize (for debugging).
     """
-    global _rag_initialized, _rag_init_error, embeddings, rag_retriever
+    global _rag_initialized, _rag_init_error, embeddings, rag_retriever, intent_classifier, reranker
 
     if _rag_initialized and not force:
         return
@@ -141,35 +401,166 @@ def initialize_rag_once(force=False):
     with _rag_lock:
         if _rag_initialized and not force:
             return
+        t0 = time.perf_counter()
+        components.set("rag", "loading")
         try:
             logger.info("🔥 Initializing RAG components...")
             if download_hugging_face_embeddings is None:
                 raise RuntimeError("Embeddings loader not available. Ensure src.helper.download_hugging_face_embeddings exists.")
 
             # Load cached embeddings (thread-safe inside helper)
-            embeddings = download_hugging_face_embeddings()
+            t = time.perf_counter()
+            with startup_timer.phase("embeddings"):
+                embeddings = download_hugging_face_embeddings()
             if embeddings is None:
                 raise RuntimeError("Embeddings loader returned None")
-
-            if PineconeVectorStore is None:
-                raise RuntimeError("PineconeVectorStore not available. Check your imports and environment.")
-
-            # Create/attach to existing Pinecone index
-            docsearch = PineconeVectorStore.from_existing_index(index_name=pinecone_index_name, embedding=embeddings)
-            # Use a small k by default for speed (configurable by RAG_K)
-            rag_retriever = docsearch.as_retriever(search_type="similarity", search_kwargs={"k": RAG_K})
+            embeddings = TimedProxy(embeddings, lambda: tracer.span("embed"),
+                                    methods=("embed_query", "embed_documents"))
+            components.set("embeddings", "warm", EMBED_BACKEND, time.perf_counter() - t)
+            if CONTEXT_PACKER:
+                with startup_timer.phase("tokenizer"):
+                    context_packer.count_tokens = make_token_counter(CHAT_MODEL)
+            if INTENT_EMBEDDINGS:
+                with startup_timer.phase("intent_centroids"):
+                    intent_classifier = CentroidIntentClassifier(embeddings, threshold=INTENT_CENTROID_THRESHOLD)
+
+            t = time.perf_counter()
+            if VECTOR_BACKEND == "local":
+                if LocalVectorStore is None:
+                    raise RuntimeError("Local vector index not available (numpy missing?).")
+                with startup_timer.phase("vector_index"):
+                    docsearch = LocalVectorStore.from_existing_index(LOCAL_INDEX_DIR, embedding=embeddings)
+                with startup_timer.phase("embedding_parity"):
+                    _check_embedding_parity(docsearch.index)
+            else:
+                if PineconeVectorStore is None:
+                    raise RuntimeError("PineconeVectorStore not available. Check your imports and environment.")
+
+                # Create/attach to existing Pinecone index
+                with startup_timer.phase("vector_index"):
+                    docsearch = PineconeVectorStore.from_existing_index(index_name=pinecone_index_name,
+                                                                        embedding=embeddings)
+            components.set("vector_index", "warm", VECTOR_BACKEND, time.perf_counter() - t)
+            # Use a small k by default for speed (configurable by RAG_K); the reranker needs more candidates
+            fetch_k = max(RAG_K, RERANK_CANDIDATES) if RERANK_ENABLED else RAG_K
+            if _hybrid_enabled() and LexicalIndex is not None:
+                # one dense query for a few extra candidates; BM25 catches exact drug/dose tokens
+                candidates = max(fetch_k, HYBRID_CANDIDATES)
+                dense = docsearch.as_retriever(search_type="similarity", search_kwargs={"k": candidates})
+                t = time.perf_counter()
+                with startup_timer.phase("lexical_index"):
+                    lexical = LexicalIndex.load(LEXICAL_INDEX_DIR)
+                components.set("lexical_index", "warm", LEXICAL_INDEX_DIR, time.perf_counter() - t)
+                retriever = HybridRetriever(dense, lexical, k=fetch_k,
+                                            candidates=candidates, rrf_k=HYBRID_RRF_K,
+                                            lexical_weight=HYBRID_LEXICAL_WEIGHT)
+                logger.info("Hybrid retrieval enabled (%s)", LEXICAL_INDEX_DIR)
+            else:
+                retriever = docsearch.as_retriever(search_type="similarity", search_kwargs={"k": fetch_k})
+            if RERANK_ENABLED:
+                if reranker is None:
+                    reranker = CrossEncoderReranker(RERANK_MODEL, budget=RERANK_BUDGET_MS / 1000.0,
+                                                    workers=RERANK_WORKERS, torch_threads=RERANK_TORCH_THREADS)
+                    if APP_PRELOAD:
+                        with startup_timer.phase("reranker"):
+                            reranker.load()  # in the master: forked workers inherit the loaded model
+                    else:
+                        reranker.load_async()  # retriever order is used until the model is ready
+                retriever = RerankingRetriever(retriever, reranker, k=RAG_K)
+            rag_retriever = retriever
 
             _rag_initialized = True
             _rag_init_error = None
+            answer_cache.set_version(fingerprint(_vector_index_fingerprint(), _lexical_index_fingerprint(),
+                                                 RERANK_MODEL if RERANK_ENABLED else "",
+                                                 CONTEXT_TOKEN_BUDGET if CONTEXT_PACKER else 0,
+                                                 system_prompt, CHAT_MODEL, RAG_K))
+            components.set("rag", "warm", None, time.perf_counter() - t0)
             logger.info("✅ RAG initialized successfully.")
         except Exception as e:
             _rag_init_error = str(e)
             _rag_initialized = False
+            components.set("rag", "failed", str(e), time.perf_counter() - t0)
             logger.exception("RAG initialization failed: %s", e)
-            
+        finally:
+            _rag_ready.set()
+        startup_timer.log("RAG init")
+
+
+def start_rag_init():
+    """Start ``initialize_rag_once`` on a background thread (once per process)."""
+    global _rag_thread
+    with _rag_lock:
+        if _rag_initialized or (_rag_thread is not None and _rag_thread.is_alive()):
+            return
+        _rag_thread = threading.Thread(target=initialize_rag_once, name="rag-init", daemon=True)
+        _rag_thread.start()
+
+
+def wait_for_rag(timeout: Optional[float] = None) -> bool:
+    """Make sure RAG init has run in this process (per RAG_INIT_MODE); True when it is usable."""
+    if _rag_initialized:
+        return True
+    if not _rag_ready.is_set():  # a failed attempt is reported, not retried per request
+        if RAG_INIT_MODE == "lazy":
+            initialize_rag_once()
+        else:
+            start_rag_init()
+            _rag_ready.wait(RAG_INIT_WAIT if timeout is None else timeout)
+    return _rag_initialized
+
+
 # ---------------- GitHub Model caller (no OpenAI) ----------------
-with app.app_context():
-    initialize_rag_once()
+# OCR pool workers started with "spawn" re-import the main module (python app.py);
+# they only need src/ocr_service.py, so skip the model/index load there.
+if multiprocessing.parent_process() is None:
+    if RAG_INIT_MODE == "eager":
+        with app.app_context():
+            initialize_rag_once()
+    elif RAG_INIT_MODE == "background":
+        start_rag_init()
+    else:
+        components.set("rag", "cold", "loads on first request")
+
+
+def extract_chat_content(j):
+    """Pull the answer text out of a chat-completions style JSON response."""
+    # Common shapes:
+    # 1) { "choices": [ { "message": {"content": "..."}} ] }
+    # 2) { "answer": "..." }
+    # 3) provider-specific fields
+    if isinstance(j, dict):
+        if "choices" in j and isinstance(j["choices"], list) and len(j["choices"]) > 0:
+            c = j["choices"][0]
+            # try nested message.content
+            if isinstance(c, dict):
+                msg = c.get("message") or c.get("delta") or {}
+                if isinstance(msg, dict) and "content" in msg:
+                    return msg["content"]
+                # sometimes choice has "text"
+                if "text" in c:
+                    return c["text"]
+            # fallback: dump the choice
+            try:
+                return json.dumps(c)
+            except Exception:
+                return str(c)
+        if "answer" in j:
+            return j["answer"]
+        # some providers return 'data' or direct 'result'
+        if "result" in j:
+            return j["result"]
+        # otherwise return stringified JSON
+        return json.dumps(j)
+    # fallback
+    return str(j)
+
+
+def _count_http_retries(resp, kind: str):
+    """Retries urllib3 made inside requests_session (429/5xx, connection errors) for this response."""
+    history = getattr(getattr(resp.raw, "retries", None), "history", None)
+    if history:
+        metrics.inc("retries_total", len(history), kind=kind)
 
 
 def call_github_chat_model(system_message: str, user_message: str, model: str = CHAT_MODEL,
@@ -204,7 +595,9 @@ def call_github_chat_model(system_message: str, user_message: str, model: str =
     }
 
     try:
-        resp = requests_session.post(url, headers=headers, json=payload, timeout=timeout)
+        with tracer.span("llm"):
+            resp = requests_session.post(url, headers=headers, json=payload, timeout=timeout)
+        _count_http_retries(resp, "llm_http")
         # Try to parse JSON
         j = {}
         try:
@@ -212,50 +605,145 @@ def call_github_chat_model(system_message: str, user_message: str, model: str =
         except Exception:
             logger.warning("GitHub model response not JSON; returning raw text")
             return resp.text
-
-        # Common shapes:
-        # 1) { "choices": [ { "message": {"content": "..."}} ] }
-        # 2) { "answer": "..." }
-        # 3) provider-specific fields
-        if isinstance(j, dict):
-            if "choices" in j and isinstance(j["choices"], list) and len(j["choices"]) > 0:
-                c = j["choices"][0]
-                # try nested message.content
-                if isinstance(c, dict):
-                    msg = c.get("message") or c.get("delta") or {}
-                    if isinstance(msg, dict) and "content" in msg:
-                        return msg["content"]
-                    # sometimes choice has "text"
-                    if "text" in c:
-                        return c["text"]
-                # fallback: dump the choice
-                try:
-                    return json.dumps(c)
-                except Exception:
-                    return str(c)
-            if "answer" in j:
-                return j["answer"]
-            # some providers return 'data' or direct 'result'
-            if "result" in j:
-                return j["result"]
-            # otherwise return stringified JSON
-            return json.dumps(j)
-        # fallback
-        return str(j)
+        return extract_chat_content(j)
     except requests.RequestException as re:
         logger.exception("HTTP error calling GitHub model: %s", re)
         raise
-    
-def is_follow_up_question(text: str):
-    followups = [
-        "that", "it", "them", "those",
-        "cause for that", "symptoms for that",
-        "what about it", "tell me more",
-        "more info", "explain more",
-        "why does that happen", "how to treat that"
-    ]
-    t = text.lower().strip()
-    return any(word in t for word in followups)
+
+
+def call_github_chat_model_stream(system_message: str, user_message: str, model: str = CHAT_MODEL,
+                                  temperature: float = CHAT_TEMPERATURE, max_tokens: int = CHAT_MAX_TOKENS,
+                                  timeout: int = 30):
+    """
+    Streaming variant of call_github_chat_model: yields content deltas from the
+    provider's SSE stream ("data: {...}" lines, terminated by "data: [DONE]").
+    Closing the generator closes the HTTP response, so the provider stops generating.
+    """
+    if not GITHUB_TOKEN:
+        raise RuntimeError("GITHUB_TOKEN not set in environment.")
+
+    url = os.getenv("GITHUB_MODELS_URL", "https://models.github.ai/inference/chat/completions")
+    headers = {
+        "Authorization": f"Bearer {GITHUB_TOKEN}",
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+        "User-Agent": "medical-chatbot-gh-model/1.0"
+    }
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_message}
+        ],
+        "temperature": float(temperature),
+        "max_tokens": int(max_tokens),
+        "stream": True,
+    }
+
+    resp = requests_session.post(url, headers=headers, json=payload, timeout=timeout, stream=True)
+    _count_http_retries(resp, "llm_http")
+    try:
+        resp.raise_for_status()
+        ctype = resp.headers.get("Content-Type", "")
+        if "text/event-stream" not in ctype:
+            # provider ignored "stream": reuse the non-streaming response parser
+            yield extract_chat_content(resp.json())
+            return
+        for raw in resp.iter_lines(decode_unicode=False):
+            if not raw:
+                continue
+            line = raw.decode("utf-8", errors="replace")
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                j = json.loads(data)
+            except ValueError:
+                continue
+            for c in j.get("choices") or []:
+                delta = c.get("delta") or {}
+                piece = delta.get("content") if isinstance(delta, dict) else None
+                if piece:
+                    yield piece
+    finally:
+        resp.close()
+
+
+class LineFramer:
+    """
+    Default SSE framing of /stream: one event per answer line, as before. A line
+    still open after STREAM_FLUSH_MS, or longer than STREAM_FLUSH_CHARS, is sent
+    up to its last space, so short and single-paragraph answers get an early
+    first byte too. Such a fragment ends with that space and the rest of its
+    line follows; complete lines never end with a space.
+    """
+
+    def __init__(self, max_chars: int = STREAM_FLUSH_CHARS, max_wait: float = STREAM_FLUSH_MS / 1000):
+        self.max_chars = max_chars
+        self.max_wait = max_wait
+        self.pending = ""
+        self.last = time.monotonic()
+
+    def feed(self, piece: str) -> List[str]:
+        self.pending += piece
+        out = []
+        while "\n" in self.pending:
+            line, self.pending = self.pending.split("\n", 1)
+            out.append(line.rstrip(" "))
+        if self.pending and (len(self.pending) >= self.max_chars or time.monotonic() - self.last >= self.max_wait):
+            cut = self.pending.rfind(" ") + 1
+            if cut:
+                out.append(self.pending[:cut])
+                self.pending = self.pending[cut:]
+        if out:
+            self.last = time.monotonic()
+        return out
+
+    def flush(self) -> List[str]:
+        rest, self.pending = self.pending.rstrip(" "), ""
+        return [rest] if rest else []
+
+
+# ---------------- Translation ----------------
+def _translation_completion(system_message: str, user_message: str, max_tokens: int) -> str:
+    return call_github_chat_model(system_message=system_message, user_message=user_message, model=CHAT_MODEL,
+                                  temperature=0.3, max_tokens=max_tokens)
+
+
+translator = Translator(
+    load_translation_backend(TRANSLATE_BACKEND, complete=_translation_completion, max_tokens=TRANSLATE_MAX_TOKENS),
+    max_entries=TRANSLATE_CACHE_SIZE,
+)
+
+
+def translate_answer(answer: str, lang: Optional[str]) -> str:
+    target = parse_language(lang)
+    if target is None:
+        return "Which language should I answer in? For example: answer in Kannada."
+    try:
+        with tracer.span("translate", lang=target):
+            return translator.translate(answer, target)
+    except Exception as e:
+        logger.exception("Translation to %s failed: %s", target, e)
+        return "⚠ Translation failed. Please try again."
+
+
+def remember_answer(sender_id: Optional[str], answer: Optional[str]):
+    """Keep the sender's last generated answer; "answer in <language>" translates it."""
+    if sender_id and answer and not answer.startswith("⚠"):
+        conversation_state.update(sender_id, last_answer=answer)
+
+
+def chat_sender_id(chat_id: str) -> str:
+    """Conversation-state key of a web chat: topic and last answer never cross chats."""
+    return f"web:{chat_id}"
+
+
+def sender_state(sender_id: Optional[str], field: str):
+    """A request without a sender (legacy /get) has no conversation state."""
+    return conversation_state.get(sender_id, field) if sender_id else None
 
 # ---------------- Intent Detection ----------------
 
@@ -279,84 +767,31 @@ def detect_tts_lang(text: str) -> str:
 
 
 def detect_intent(text: str):
-    t = text.lower().strip()
-
-    greetings = ["hi", "hello", "hey", "hii"]
-    if t in greetings or t.startswith(tuple(greetings)):
-        return ("greeting", None)
-
-    # translation
-    if "translate" in t or "answer in" in t:
-        lang = t.replace("answer in", "").replace("translate to", "").strip()
-        return ("translate", lang)
-
-    # disease-only
-    diseases = [
-        "typhoid", "diabetes", "dengue", "malaria", "cholera",
-        "tuberculosis", "tb", "covid", "asthma", "cancer",
-        "hypertension", "bp"
-    ]
-    if t in diseases:
-        return ("medical", None)
-    # medicine / tablet questions (PRIMARY medical)
-    medicine_keywords = [
-        "tablet", "capsule", "medicine", "drug", "syrup",
-        "injection", "b-complex", "paracetamol", "crocin",
-        "azithromycin", "vitamin"
-        ]
-    if any(m in t for m in medicine_keywords):
-        return ("medical", None)
-
-    # follow-ups (ONLY contextual)
-    followups = [
-        "side effects", "sideeffect", "dose", "dosage",
-        "how many", "continue", "more", "why", "safe",
-        "pregnant", "children", "elderly","how to", "recover", "cure", "overcome","get rid", "treat this", "fix this"
-    ]
-    for f in followups:
-        if f in t:
-            return ("followup", None)
-    
-
-    # medical questions
-    medical_words = [
-        "symptom", "symptoms", "pain", "fever", "cough", "infection",
-        "disease", "treatment", "cause", "diagnosis", "medicine",
-        "tablet", "drug", "rash", "diarrhea", "asthma",
-        "diabetes", "heart", "skin", "typhoid","mental", "lifestyle", "health", "wellness",
-        "interaction", "interactions", "side effect",
-        "exercise", "diet", "stress"
-        ]
-    if any(w in t for w in medical_words) or t.startswith(("what is", "explain")):
-        return ("medical", None)
-
-        # identity / chatbot info
-    identity_phrases = [
-        "who created you",
-        "who made you",
-        "who built you",
-        "who are you",
-        "what are you",
-        "are you a doctor",
-        "are you human",
-        "your creator",
-        "your owner"
-    ]
-
-    for p in identity_phrases:
-        if p in t:
-            return ("identity", None)
-
-    return ("other", None)
-
-
-
+    """
+    Compiled keyword rules (src/intent.py); messages they cannot place are
+    optionally classified by nearest intent centroid over the query embedding.
+    """
+    with tracer.span("intent"):
+        intent, lang = detect_rule_intent(text)
+        if intent == "other" and intent_classifier is not None:
+            try:
+                label, score = intent_classifier.classify(text)
+                if label in ("medical", "followup", "greeting"):
+                    logger.info("Intent %s by embedding centroid (%.2f)", label, score)
+                    return (label, None)
+            except Exception as e:
+                logger.warning("Embedding intent classifier failed: %s", e)
+        return (intent, lang)
 
 
 # ---------------- RAG query (fast path) ----------------
-def call_rag_with_retry(text, retries=3, delay=1.0, sender_id="whatsapp"):
-    global conversation_topic, last_user_query
-
+def resolve_rag_query(text, sender_id=None, use_cache=True):
+    """
+    Intent handling and per-sender conversation state (none when sender_id is None).
+    Returns (answer, None, None, None) when the reply needs no retrieval, otherwise
+    (None, rag_text, intent, use_cache) where rag_text is the (possibly rewritten)
+    question. Everything after this step depends only on its return value.
+    """
     intent, lang = detect_intent(text)
     
     if intent == "identity":
@@ -381,47 +816,34 @@ def call_rag_with_retry(text, retries=3, delay=1.0, sender_id="whatsapp"):
                 # ✅ If user asked to translate identity answer
             if "answer in" in t or "translate" in t:
                 lang = t.replace("answer in", "").replace("translate to", "").strip()
-                translated_prompt = f"Translate this to {lang}:\n{base_answer}"
-                return call_github_chat_model(
-                    system_message="You are a translator.",
-                    user_message=translated_prompt,
-                    model=CHAT_MODEL,
-                    temperature=0.3,
-                    max_tokens=300,
-                )
-            return base_answer
+                return translate_answer(base_answer, lang), None, None, None
+            return base_answer, None, None, None
     # --------------------------  
     # 1️⃣ GREETING  
     # --------------------------
     if intent == "greeting":
-        return "👋 Hello! How can I assist you today?"
+        return "👋 Hello! How can I assist you today?", None, None, None
 
     # --------------------------  
     # 2️⃣ TRANSLATION REQUEST  
     # User says: "Answer in Kannada", "Kannada alli heli", "Translate to Hindi"
     # --------------------------
     if intent == "translate":
-        prev_q = last_user_query.get(sender_id)
-        if not prev_q:
-            return "Please ask a medical question first."
-
-        translated_query = f"Answer this in {lang}:\n{prev_q}"
-        return call_rag_with_retry(
-            translated_query,
-            retries=retries,
-            delay=delay,
-            sender_id=sender_id
-        )
+        prev_answer = sender_state(sender_id, "last_answer")
+        if not prev_answer:
+            return "Please ask a medical question first.", None, None, None
+        # the answer is translated as it is: no retrieval, no regeneration
+        return translate_answer(prev_answer, lang), None, None, None
 
     # --------------------------  
     # 3️⃣ FOLLOW-UP QUESTION  
     # User says: "What is cause for that?", "Symptoms for that?", "Why does it happen?"
     # --------------------------
     if intent == "followup":
-        topic = conversation_topic.get(sender_id)
+        topic = sender_state(sender_id, "topic")
 
         if not topic:
-            return "Please ask a medical question first."
+            return "Please ask a medical question first.", None, None, None
 
         followup_query = (
             f"The user previously asked about '{topic}'. "
@@ -429,67 +851,93 @@ def call_rag_with_retry(text, retries=3, delay=1.0, sender_id="whatsapp"):
             f"Provide a detailed medical explanation."
         )
 
-        last_user_query[sender_id] = followup_query
         text = followup_query  # continue with RAG using rewritten text
 
     # --------------------------  
     # 4️⃣ MEDICAL MAIN QUESTION  
     # --------------------------
     if intent == "medical":
-        conversation_topic[sender_id] = text         # Store topic for future follow-ups
-        last_user_query[sender_id] = text            # Store for translation
+        # topic for future follow-ups (the answer is kept for translation, see remember_answer)
+        if sender_id:
+            conversation_state.update(sender_id, topic=text)
         
     # 🧠 Contextual follow-up fallback
     if intent == "other":
-        topic = conversation_topic.get(sender_id)
+        topic = sender_state(sender_id, "topic")
         if topic:
             followup_query = (
                 f"The user previously asked about '{topic}'. "
                 f"Now they are asking: {text}. "
                 f"Explain treatment, recovery, and prevention."
             )
-            last_user_query[sender_id] = followup_query
             text = followup_query
             intent = "followup"
         else:
-            return "I'm here to help with medical questions. Please describe your symptoms or condition."
+            return "I'm here to help with medical questions. Please describe your symptoms or condition.", None, None, None
 
     # --------------------------  
     # 5️⃣ NON-MEDICAL  
     # --------------------------
     if intent == "other":
-        return "I'm here to help with medical questions. Please describe your symptoms or condition."
+        return "I'm here to help with medical questions. Please describe your symptoms or condition.", None, None, None
+
+    return None, text, intent, use_cache
 
+
+def prepare_rag_prompt(text, intent, use_cache=True):
+    """
+    Answer-cache lookup, retrieval and prompt building for a resolved query.
+    Returns (answer, None, None) when no LLM generation is needed, otherwise
+    (None, final_prompt, cache_key).
+    """
     # --------------------------
     # 6️⃣ NORMAL RAG PROCESS  
     # --------------------------
     global _rag_initialized, _rag_init_error, rag_retriever
 
-    if not _rag_initialized:
+    if not wait_for_rag():
         if _rag_init_error:
-            return f"⚠ RAG initialization failed: {_rag_init_error}"
-        return "⚠ RAG is loading. Try again."
+            return f"⚠ RAG initialization failed: {_rag_init_error}", None, None
+        return "⚠ RAG is loading. Try again.", None, None
+
+    # Semantic answer cache: only for standalone medical questions; follow-ups and
+    # translations depend on per-sender state and always go through the pipeline.
+    cache_key = None
+    if ANSWER_CACHE_ENABLED and use_cache and intent == "medical" and embeddings is not None:
+        try:
+            cache_key = answer_cache.key(embeddings.embed_query(text), text)
+            cached = answer_cache.get(cache_key)
+            if cached:
+                logger.info("Answer cache hit")
+                return cached, None, None
+        except Exception as e:
+            logger.warning("Answer cache lookup failed: %s", e)
+            cache_key = None
+    elif ANSWER_CACHE_ENABLED:
+        answer_cache.record_bypass()
 
     # RAG Document Retrieval
     docs = []
     try:
-        if hasattr(rag_retriever, "get_relevant_documents"):
-            docs = rag_retriever.get_relevant_documents(text)
-        elif hasattr(rag_retriever, "retrieve"):
-            docs = rag_retriever.retrieve(text)
-        else:
-            docs = rag_retriever(text)
+        with tracer.span("retrieve"):
+            if hasattr(rag_retriever, "get_relevant_documents"):
+                docs = rag_retriever.get_relevant_documents(text)
+            elif hasattr(rag_retriever, "retrieve"):
+                docs = rag_retriever.retrieve(text)
+            else:
+                docs = rag_retriever(text)
     except Exception as e:
         logger.exception("Retriever error: %s", e)
 
     # Build context
-    context_chunks = []
-    for d in docs[:RAG_K]:
-        c = getattr(d, "page_content", "") or getattr(d, "content", "")
-        if c:
-            context_chunks.append(c[:800])
+    texts = [getattr(d, "page_content", "") or getattr(d, "content", "") for d in docs[:RAG_K]]
+    with tracer.span("context"):
+        if CONTEXT_PACKER:
+            context_chunks = context_packer.pack(texts)
+        else:
+            context_chunks = [c[:800] for c in texts if c]
 
-    context_text = "\n\n---\n\n".join(context_chunks)
+    context_text = CONTEXT_SEPARATOR.join(context_chunks)
 
     if context_text:
         final_prompt = (
@@ -500,11 +948,32 @@ def call_rag_with_retry(text, retries=3, delay=1.0, sender_id="whatsapp"):
     else:
         final_prompt = text
 
+    return None, final_prompt, cache_key
+
+
+def build_rag_request(text, sender_id=None, use_cache=True):
+    """
+    Intent handling, cache lookup, retrieval and prompt building shared by the
+    blocking and streaming paths.
+    Returns (answer, None, None) when no LLM generation is needed, otherwise
+    (None, final_prompt, cache_key).
+    """
+    answer, rag_text, intent, use_cache = resolve_rag_query(text, sender_id=sender_id, use_cache=use_cache)
+    if answer is not None:
+        return answer, None, None
+    answer, final_prompt, cache_key = prepare_rag_prompt(rag_text, intent, use_cache=use_cache)
+    remember_answer(sender_id, answer)  # an answer-cache hit
+    return answer, final_prompt, cache_key
+
+
+def generate_with_retry(final_prompt, cache_key=None, retries=3, delay=1.0):
     # --------------------------
     # 7️⃣ LLM Call with Retry  
     # --------------------------
     cur_delay = delay
     for attempt in range(1, retries + 1):
+        if attempt > 1:
+            metrics.inc("retries_total", kind="llm")
         try:
             ans = call_github_chat_model(
                 system_message=system_prompt,
@@ -518,7 +987,10 @@ def call_rag_with_retry(text, retries=3, delay=1.0, sender_id="whatsapp"):
             if not ans or not str(ans).strip():
                 logger.warning("LLM returned empty response on attempt %d", attempt)
                 continue
-            return str(ans).strip()
+            ans = str(ans).strip()
+            if cache_key is not None:
+                answer_cache.put(cache_key, ans)
+            return ans
         except Exception as e:
             logger.warning("RAG attempt %d failed: %s", attempt, e)
             if "rate" in str(e).lower() or "429" in str(e):
@@ -526,60 +998,156 @@ def call_rag_with_retry(text, retries=3, delay=1.0, sender_id="whatsapp"):
                 cur_delay *= 2
                 continue
             return "⚠ Error generating response. Please try again."
-        #✅ FINAL FALLBACK — NEVER EMPTY
-        return "⚠ I could not generate a response. Please rephrase your question."
+    #✅ FINAL FALLBACK — NEVER EMPTY
+    return "⚠ I could not generate a response. Please rephrase your question."
 
 
+def call_rag_with_retry(text, retries=3, delay=1.0, sender_id=None, use_cache=True):
+    answer, rag_text, intent, use_cache = resolve_rag_query(text, sender_id=sender_id, use_cache=use_cache)
+    if answer is not None:
+        return answer
 
+    def compute():
+        answer, final_prompt, cache_key = prepare_rag_prompt(rag_text, intent, use_cache=use_cache)
+        if answer is not None:
+            return answer
+        return generate_with_retry(final_prompt, cache_key, retries=retries, delay=delay)
 
-# ---------------- OCR / PDF utilities ----------------
-def preprocess_image_for_ocr(image_path: str):
-    img = cv2.imread(image_path)
-    if img is None:
-        raise FileNotFoundError(f"Image not found: {image_path}")
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.GaussianBlur(gray, (3, 3), 0)
-    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-    return thresh
+    if not COALESCE_ENABLED:
+        answer = compute()
+    else:
+        # identical in-flight questions (same rewritten text/intent) share one retrieval + LLM call
+        answer = rag_singleflight.do(make_key(rag_text, intent, use_cache), compute)
+    remember_answer(sender_id, answer)
+    return answer
 
-def extract_text_from_image(image_path: str):
-    try:
-        processed = preprocess_image_for_ocr(image_path)
-        config = "--oem 3 --psm 6"
-        text = pytesseract.image_to_string(processed, config=config)
-        return text.strip()
-    except Exception:
-        try:
-            img = Image.open(image_path)
-            text = pytesseract.image_to_string(img, config="--oem 3 --psm 6")
-            return text.strip()
-        except Exception as e:
-            logger.exception("OCR fallback failed: %s", e)
-            return ""
 
-def extract_text_from_pdf(file_path: str):
+def stream_rag_answer(text, sender_id=None, use_cache=True):
+    """
+    Streaming variant of call_rag_with_retry: yields answer text as the model
+    produces it. Closing the generator (client disconnect) closes the upstream
+    HTTP stream, which cancels generation.
+    """
+    answer, final_prompt, cache_key = build_rag_request(text, sender_id=sender_id, use_cache=use_cache)
+    if answer is not None:
+        yield answer
+        return
+
+    parts = []
+    started = time.perf_counter()
+    upstream = call_github_chat_model_stream(
+        system_message=system_prompt,
+        user_message=final_prompt,
+        model=CHAT_MODEL,
+        temperature=CHAT_TEMPERATURE,
+        max_tokens=CHAT_MAX_TOKENS,
+        timeout=25
+    )
     try:
-        reader = PdfReader(file_path)
-        pages = [page.extract_text() or "" for page in reader.pages]
-        return "\n".join(pages).strip()
+        for delta in upstream:
+            if not parts:
+                tracer.record("llm_first_token", started)
+            parts.append(delta)
+            yield delta
+        tracer.record("llm", started)
     except Exception as e:
-        logger.exception("PDF text extraction failed: %s", e)
-        return ""
+        logger.warning("Streaming LLM call failed: %s", e)
+        if not parts:
+            # nothing sent yet: fall back to the blocking path (with its retries)
+            ans = generate_with_retry(final_prompt, cache_key)
+            remember_answer(sender_id, ans)
+            yield ans
+            return
+        yield "\n⚠ Response interrupted. Please try again."
+        return
+    finally:
+        upstream.close()
 
-def extract_text_from_any(path: str) -> str:
+    ans = "".join(parts).strip()
+    if not ans:
+        ans = generate_with_retry(final_prompt, cache_key)
+        yield ans
+    elif cache_key is not None:
+        answer_cache.put(cache_key, ans)
+    remember_answer(sender_id, ans)
+
+
+
+
+# ---------------- OCR / PDF utilities ----------------
+# Tesseract/OpenCV run in a process pool (src/ocr_service.py), not on request threads.
+ocr_cache = None
+if OCR_CACHE_ENABLED:
     try:
-        low = path.lower()
-        if low.endswith((".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".tif")):
-            return extract_text_from_image(path)
-        if low.endswith(".pdf"):
-            return extract_text_from_pdf(path)
-        try:
-            return extract_text_from_image(path)
-        except Exception:
-            return ""
+        ocr_cache = OCRCache(
+            OCR_CACHE_PATH,
+            max_bytes=int(OCR_CACHE_MAX_MB * 1024 * 1024),
+            mode=OCR_CACHE_MODE,
+            phash_distance=OCR_CACHE_PHASH_DISTANCE,
+            version=fingerprint(OCR_PIPELINE_VERSION, TESSERACT_CONFIG, sorted(OCR_PREPROCESS_OPTIONS.items()),
+                                OCR_PDF_RASTER_DPI),
+        )
     except Exception as e:
-        logger.exception("extract_text_from_any error: %s", e)
-        return ""
+        logger.warning("OCR cache disabled (%s): %s", OCR_CACHE_PATH, e)
+
+ocr_service = OCRService(
+    workers=OCR_WORKERS,
+    max_queue=OCR_QUEUE_SIZE,
+    deadline=OCR_DEADLINE,
+    submit_timeout=OCR_SUBMIT_TIMEOUT,
+    tesseract_cmd=TESSERACT_CMD,
+    start_method=OCR_START_METHOD,
+    cache=ocr_cache,
+    preprocess=OCR_PREPROCESS_OPTIONS,
+    pdf_max_pages=OCR_PDF_MAX_PAGES,
+    pdf_max_bytes=OCR_PDF_MAX_BYTES,
+    pdf_pages_per_job=OCR_PDF_PAGES_PER_JOB,
+    pdf_deadline=OCR_PDF_DEADLINE,
+    pdf_raster_dpi=OCR_PDF_RASTER_DPI,
+)
+
+def extract_text_from_image(image_path: str):
+    with tracer.span("ocr"):
+        return ocr_service.extract(image_path)
+
+def extract_text_from_any(path: str) -> str:
+    with tracer.span("ocr"):
+        return ocr_service.extract(path)
+
+def extract_with_progress(path: str, notify: Callable[[int], None]) -> str:
+    """
+    ``extract`` for chat uploads: a PDF is read page by page through
+    ``ocr_service.extract_stream``, and once it has taken OCR_PROGRESS_AFTER
+    seconds ``notify(pages_read)`` is called (once), so a long report does not
+    leave the user waiting in silence for the final reply.
+    """
+    if not is_pdf(path):
+        return ocr_service.extract(path)
+    started = time.time()
+    parts = []
+    for text in ocr_service.extract_stream(path):
+        parts.append(text)
+        if notify and OCR_PROGRESS_AFTER and time.time() - started >= OCR_PROGRESS_AFTER:
+            try:
+                notify(len(parts))
+            except Exception as e:
+                logger.warning("OCR progress message failed: %s", e)
+            notify = None
+    return "\n".join(parts).strip()
+
+def ocr_progress_notifier(send: Callable[[str], object]) -> Callable[[int], None]:
+    """notify() for extract_with_progress that sends at most one message per incoming message."""
+    lock = threading.Lock()
+    sent = []
+
+    def notify(pages: int):
+        with lock:
+            if sent:
+                return
+            sent.append(pages)
+        send(f"📄 Still reading your document ({pages} page{'s' if pages != 1 else ''} so far)…")
+
+    return notify
 
 # ---------------- Email helper ----------------
 def send_email(to_email, subject, message):
@@ -599,30 +1167,19 @@ def send_email(to_email, subject, message):
         logger.exception("Email send error: %s", e)
         return False
 
-# ---------------- chats.json helpers (with lock) ----------------
-chats_lock = threading.Lock()
-
-def _ensure_chats_file():
-    if not os.path.exists(CHATS_FILE):
-        with open(CHATS_FILE, "w", encoding="utf-8") as f:
-            json.dump([], f)
+# ---------------- chat store helpers ----------------
+# Appends are O(1) and readers don't block writers (see src/chat_store.py).
+# Existing chats.json data is migrated into the store on first start.
+chat_store = TimedProxy(create_chat_store(CHAT_STORE, CHATS_FILE, CHAT_STORE_PATH),
+                        lambda: tracer.span("chat_store"))
 
 def load_chats():
-    with chats_lock:
-        _ensure_chats_file()
-        try:
-            with open(CHATS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            logger.exception("Corrupt chats.json; resetting")
-            return []
+    """Full dump of every chat (legacy helper; avoid on hot paths)."""
+    return chat_store.load_all()
 
 def save_chats(data):
-    with chats_lock:
-        tmp = CHATS_FILE + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, CHATS_FILE)
+    """Replace every chat (legacy helper; avoid on hot paths)."""
+    chat_store.replace_all(data)
 
 def find_chat(chats, chat_id):
     for c in chats:
@@ -630,6 +1187,15 @@ def find_chat(chats, chat_id):
             return c
     return None
 
+def new_message(msg_type, text, image_url=None):
+    return {
+        "id": str(uuid.uuid4()),
+        "type": msg_type,
+        "text": text,
+        "image_url": image_url,
+        "time": datetime.datetime.utcnow().isoformat()
+    }
+
 
 # ---------------- Web UI routes (unchanged) ----------------
 @app.route("/",methods=["GET", "POST"])
@@ -670,13 +1236,32 @@ def chat_web_ui():
         if not final_input.strip():
             return "⚠ Please send a message or upload an image."
 
-        answer = call_rag_with_retry(final_input)
+        # no chat id to keep state under: no follow-ups or translation of earlier answers
+        answer = call_rag_with_retry(final_input, sender_id=None)
         return answer
     except Exception as e:
         logger.exception("/get error: %s", e)
+        mark_request_error()
         return "⚠ Server error."
     
 # ---------------- Text-to-Speech (TTS) ----------------
+tts_cache = None
+if TTS_CACHE_ENABLED:
+    try:
+        tts_cache = AudioCache(TTS_CACHE_PATH, max_bytes=int(TTS_CACHE_MAX_MB * 1024 * 1024))
+    except Exception as e:
+        logger.warning("TTS cache disabled (%s): %s", TTS_CACHE_PATH, e)
+
+tts_service = TTSService(
+    load_engine(TTS_ENGINE),
+    cache=tts_cache,
+    workers=TTS_WORKERS,
+    max_chars=TTS_SEGMENT_CHARS,
+    timeout=TTS_TIMEOUT,
+    timer=lambda: tracer.span("tts"),
+)
+
+
 @app.route("/tts", methods=["POST"])
 def text_to_speech():
     data = request.get_json() or {}
@@ -687,60 +1272,53 @@ def text_to_speech():
 
     try:
         lang = detect_tts_lang(text)
-
-        tts = gTTS(text=text, lang=lang)
-
-        import tempfile
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-        tts.save(tmp.name)
-
-        return send_file(
-            tmp.name,
-            mimetype="audio/mpeg",
-            as_attachment=False
-        )
+        audio = tts_service.stream(text, lang)
+        first = next(audio, b"")  # a failing engine still gets a JSON error, not a broken stream
+        components.set("tts", "warm", tts_service.engine.name)
     except Exception as e:
         logger.exception("TTS error: %s", e)
         return jsonify({"error": "TTS failed"}), 500
 
+    def generate():
+        try:
+            yield first
+            yield from audio
+        except Exception as e:
+            logger.exception("TTS stream error: %s", e)
+            mark_request_error("/tts")  # the response already started
+        finally:
+            audio.close()
+
+    # later sentences are sent as they are synthesized (MP3 frames concatenate)
+    return Response(tracer.bind_iter(generate(), name="tts.stream"), mimetype="audio/mpeg",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
 # ---------------- API: Chats management (unchanged) ----------------
 @app.route("/api/chats", methods=["GET", "POST"])
 def api_chats():
-    chats = load_chats()
     if request.method == "GET":
-        view = [{"id": c["id"], "title": c.get("title", "New chat"), "created_at": c.get("created_at")} for c in chats]
-        return jsonify(view)
-    new_chat = {
-        "id": str(uuid.uuid4()),
-        "title": request.json.get("title", "New chat") if request.is_json else "New chat",
-        "created_at": datetime.datetime.utcnow().isoformat(),
-        "messages": []
-    }
-    chats.insert(0, new_chat)
-    save_chats(chats)
+        return jsonify(chat_store.list_chats())
+    title = request.json.get("title", "New chat") if request.is_json else "New chat"
+    new_chat = chat_store.create_chat(title)
     return jsonify(new_chat)
 
 @app.route("/api/chats/<chat_id>", methods=["GET", "DELETE"])
 def api_chat(chat_id):
-    chats = load_chats()
-    chat = find_chat(chats, chat_id)
-    if not chat:
-        return jsonify({"error": "Chat not found"}), 404
     if request.method == "DELETE":
-        chats = [c for c in chats if c.get("id") != chat_id]
-        save_chats(chats)
+        if not chat_store.delete_chat(chat_id):
+            return jsonify({"error": "Chat not found"}), 404
         return jsonify({"ok": True})
+    chat = chat_store.get_chat(chat_id)
+    if not chat:
+        return jsonify({"error": "Chat not found"}), 404
     return jsonify(chat)
 
 # ---------------- Add message (non-streaming fallback) ----------------
 @app.route("/api/chats/<chat_id>/messages", methods=["POST"])
 def api_add_message(chat_id):
     try:
-        chats = load_chats()
-        chat = find_chat(chats, chat_id)
-
-        if not chat:
+        if not chat_store.chat_exists(chat_id):
             return jsonify({"error": "Chat not found"}), 404
 
         text = request.form.get("msg", "").strip()
@@ -762,42 +1340,26 @@ def api_add_message(chat_id):
             image_url = f"/uploads/{filename}"
             logger.info("Saved uploaded image for chat %s -> %s", chat_id, filepath)
 
-        # 1️⃣ Append user message FIRST
-        user_msg = {
-            "id": str(uuid.uuid4()),
-            "type": "user",
-            "text": text,
-            "image_url": image_url,
-            "time": datetime.datetime.utcnow().isoformat()
-        }
-        chat["messages"].append(user_msg)
-
-        # 2️⃣ Set title on first message
-        if len(chat["messages"]) == 1 and text:
-            chat["title"] = text[:35] + "..." if len(text) > 35 else text
+        # 1️⃣ Append user message FIRST (2️⃣ title is set on first message)
+        user_msg = new_message("user", text, image_url)
+        if not chat_store.append_message(chat_id, user_msg, first_title=make_title(text) if text else None):
+            return jsonify({"error": "Chat not found"}), 404
 
         # 3️⃣ Generate response USING HISTORY
-        answer = process_message_for_chat_history(text,local_image_path)
+        answer = process_message_for_chat_history(text, local_image_path, sender_id=chat_sender_id(chat_id))
 
         # 4️⃣ Append bot message
-        bot_msg = {
-            "id": str(uuid.uuid4()),
-            "type": "bot",
-            "text": answer,
-            "image_url": None,
-            "time": datetime.datetime.utcnow().isoformat()
-        }
-        chat["messages"].append(bot_msg)
-
-        save_chats(chats)
-        return jsonify({"chat": chat})
+        bot_msg = new_message("bot", answer)
+        chat_store.append_message(chat_id, bot_msg)
+
+        return jsonify({"chat": chat_store.get_chat(chat_id)})
 
     except Exception as e:
         logger.exception("api_add_message error")
         return jsonify({"error": "Internal server error"}), 500
 
 # ---------------- Helper used by both endpoints ----------------
-def process_message_for_chat_history(text, image_path=None):
+def process_message_for_chat_history(text, image_path=None, sender_id=None):
     extracted = ""
     if image_path:
         try:
@@ -807,22 +1369,154 @@ def process_message_for_chat_history(text, image_path=None):
     final_input = text or ""
     if extracted:
         final_input = (final_input + "\n\nExtracted from image:\n" + extracted) if final_input else extracted
-    return call_rag_with_retry(final_input)
+    return call_rag_with_retry(final_input, sender_id=sender_id)
+
+# ---------------- Cache stats ----------------
+def cache_stats():
+    """Every cache and coalescing layer in this process (also served by asgi.py)."""
+    stats = {
+        "answer_cache": answer_cache.stats(),
+        "singleflight": rag_singleflight.stats(),
+        "conversation_state": conversation_state.stats(),
+        "context_packer": context_packer.stats(),
+    }
+    if hasattr(embeddings, "stats"):
+        stats["embedding_cache"] = embeddings.stats()
+    if ocr_cache is not None:
+        stats["ocr_cache"] = ocr_cache.stats()
+    stats["tts"] = tts_service.stats()
+    stats["translation"] = translator.stats()
+    return stats
+
+@app.route("/api/cache/stats", methods=["GET"])
+def api_cache_stats():
+    return jsonify(cache_stats())
+
+@app.route("/api/rerank/stats", methods=["GET"])
+def api_rerank_stats():
+    if reranker is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, "candidates": RERANK_CANDIDATES, **reranker.stats()})
+
+@app.route("/api/ocr/stats", methods=["GET"])
+def api_ocr_stats():
+    return jsonify({**ocr_service.stats(), "cache": ocr_service.cache_stats()})
+
+# ---------------- Health / readiness ----------------
+def component_states():
+    """Warm/cold state of every subsystem in this process."""
+    states = components.snapshot()
+    states.setdefault("rag", {"state": "loading" if not _rag_ready.is_set() else "cold"})
+    if RERANK_ENABLED:
+        if reranker is None:
+            states["reranker"] = {"state": "cold"}
+        elif reranker.load_error:
+            states["reranker"] = {"state": "failed", "detail": reranker.load_error}
+        else:
+            states["reranker"] = {"state": "warm" if reranker.model is not None else "loading"}
+    else:
+        states["reranker"] = {"state": "disabled"}
+    states["ocr_pool"] = {"state": "warm" if ocr_service.stats()["pool_started"] else "cold"}
+    states.setdefault("tts", {"state": "cold"})
+    states.setdefault("twilio", {"state": "cold"})
+    return states
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Liveness: the process serves requests (models may still be loading)."""
+    return jsonify({"status": "ok", "pid": os.getpid(), "uptime_s": round(time.perf_counter() - _IMPORT_START, 3)})
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """Readiness: 200 once retrieval can answer, else 503; lists what is warm."""
+    body = {
+        "ready": _rag_initialized,
+        "rag_init_mode": RAG_INIT_MODE,
+        "preloaded": APP_PRELOAD,
+        "error": _rag_init_error,
+        "components": component_states(),
+        "startup": startup_timer.summary(),
+    }
+    return jsonify(body), 200 if _rag_initialized else 503
+
+# ---------------- Metrics ----------------
+UNMETERED_ROUTES = {"/metrics", "/healthz", "/readyz", "/api/traces/slow"}  # probes and scrapes
+
+
+def _route() -> str:
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def _metrics_start():
+    g.metrics_start = time.perf_counter()
+    route = _route()
+    if route not in UNMETERED_ROUTES:
+        g.trace = tracer.start(f"{request.method} {route}", profile=should_profile(request.headers.get("X-Profile")),
+                               channel=request_channel(route))
+
+
+@app.after_request
+def _metrics_record(response):
+    start = g.get("metrics_start")
+    route = _route()
+    if start is not None and route not in UNMETERED_ROUTES:
+        record_request(route, response.status_code, time.perf_counter() - start, g.get("metrics_error", False))
+    handle = g.pop("trace", None)
+    if handle is not None:
+        response.headers["X-Trace-Id"] = handle[0].id
+        tracer.finish(handle, status=response.status_code)
+    return response
+
+
+metrics.gauge("executor_queue_depth", lambda: executor_queue_depth(executor), executor="webhook")
+metrics.gauge("executor_queue_depth", lambda: ocr_service.stats()["queue_depth"], executor="ocr")
+metrics.gauge("executor_queue_depth", lambda: executor_queue_depth(tts_service.executor), executor="tts")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus text format; ?format=json for a JSON summary (per-bucket quantile bounds)."""
+    if request.args.get("format") == "json":
+        return jsonify(metrics.snapshot())
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/api/traces/slow", methods=["GET"])
+def api_slow_traces():
+    """Span trees of the most recent requests slower than TRACE_SLOW_MS (newest first)."""
+    return jsonify({**tracer.stats(), "traces": list(reversed(tracer.slow_traces))})
 
 # ---------------- Serve uploaded images ----------------
 @app.route("/uploads/<path:filename>")
 def serve_file(filename):
     return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
 
+def save_base64_image(chat_id, image_b64):
+    """Decode a (data-URL or bare) base64 image into the upload folder; returns the path."""
+    import base64, re
+    m = re.match(r"data:(image/\w+);base64,(.*)", image_b64)
+    if m:
+        b64 = m.group(2)
+        ext = m.group(1).split('/')[1]
+    else:
+        b64 = image_b64
+        ext = "png"
+    raw = base64.b64decode(b64)
+    filename = secure_filename(f"{chat_id}_{uuid.uuid4().hex}.{ext}")
+    filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    with open(filepath, "wb") as f:
+        f.write(raw)
+    return filepath
+
 # ---------------- Streaming endpoint (SSE) - updated to accept files & base64 ----------------
 @app.route("/api/chats/<chat_id>/stream", methods=["POST"])
 def api_chat_stream(chat_id):
     try:
         logger.info("Incoming stream request: content_type=%s", request.content_type)
 
-        chats = load_chats()
-        chat = find_chat(chats, chat_id)
-        if not chat:
+        if not chat_store.chat_exists(chat_id):
             return jsonify({"error": "Chat not found"}), 404
 
         extracted_text = None
@@ -850,20 +1544,8 @@ def api_chat_stream(chat_id):
             text = (payload.get("message") or payload.get("msg") or payload.get("text") or "").strip()
             image_b64 = payload.get("image_base64") or payload.get("imageBase64")
             if image_b64 and not extracted_text:
-                import base64, re
-                m = re.match(r"data:(image/\w+);base64,(.*)", image_b64)
-                if m:
-                    b64 = m.group(2)
-                    ext = m.group(1).split('/')[1]
-                else:
-                    b64 = image_b64
-                    ext = "png"
                 try:
-                    raw = base64.b64decode(b64)
-                    filename = secure_filename(f"{chat_id}_{uuid.uuid4().hex}.{ext}")
-                    filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-                    with open(filepath, "wb") as f:
-                        f.write(raw)
+                    filepath = save_base64_image(chat_id, image_b64)
                     saved_local_image = filepath
                     logger.info("Saved JSON-base64 image: %s", filepath)
                     extracted_text = extract_text_from_image(filepath)
@@ -881,58 +1563,61 @@ def api_chat_stream(chat_id):
         if not final_input.strip():
             return jsonify({"error": "Message or image required"}), 400
 
-        user_msg = {
-            "id": str(uuid.uuid4()),
-            "type": "user",
-            "text": text if text else (extracted_text or ""),
-            "image_url": (f"/uploads/{os.path.basename(saved_local_image)}" if saved_local_image else None),
-            "time": datetime.datetime.utcnow().isoformat()
-        }
-        chat["messages"].append(user_msg)
-        if len(chat["messages"]) == 1 and user_msg["text"]:
-            chat["title"] = user_msg["text"][:35] + ("..." if len(user_msg["text"]) > 35 else "")
-        save_chats(chats)
-
-        # Generate the answer (blocking call) and save to chat before streaming
-        answer = call_rag_with_retry(final_input or text)
-
-        bot_msg = {
-            "id": str(uuid.uuid4()),
-            "type": "bot",
-            "text": answer,
-            "image_url": None,
-            "time": datetime.datetime.utcnow().isoformat()
-        }
-
-        chats_after = load_chats()
-        existing_chat = find_chat(chats_after, chat_id)
-        if existing_chat is not None:
-            existing_chat["messages"].append(bot_msg)
-            save_chats(chats_after)
-        else:
-            chat["messages"].append(bot_msg)
-            save_chats(chats)
+        user_msg = new_message(
+            "user",
+            text if text else (extracted_text or ""),
+            f"/uploads/{os.path.basename(saved_local_image)}" if saved_local_image else None,
+        )
+        if not chat_store.append_message(chat_id, user_msg,
+                                         first_title=make_title(user_msg["text"]) if user_msg["text"] else None):
+            return jsonify({"error": "Chat not found"}), 404
+
+        # Stream the answer as the model generates it; persist it once the stream ends.
+        # Default framing is one SSE event per answer line (see LineFramer); ?mode=tokens
+        # sends every model delta as JSON: data: {"delta": "..."}
+        token_mode = request.args.get("mode") == "tokens"
+        rag_input = final_input or text
 
         def generate():
+            stream = stream_rag_answer(rag_input, sender_id=chat_sender_id(chat_id))
+            parts = []
+            completed = False
             try:
-                for line in answer.split("\n"):
+                framer = LineFramer()
+                for piece in stream:
+                    parts.append(piece)
+                    if token_mode:
+                        yield f"data: {json.dumps({'delta': piece}, ensure_ascii=False)}\n\n"
+                        continue
+                    for line in framer.feed(piece):
+                        yield f"data: {line}\n\n"
+                for line in framer.flush():
                     yield f"data: {line}\n\n"
-                    time.sleep(0.01)
+                completed = True
                 yield "data: [DONE]\n\n"
+            except GeneratorExit:
+                logger.info("Stream client disconnected for chat %s; cancelling generation", chat_id)
+                raise
             except Exception as e:
                 logger.exception("Stream generator exception: %s", e)
+                mark_request_error("/api/chats/<chat_id>/stream")  # the response already started
                 yield f"data: ⚠ Streaming error: {str(e)}\n\n"
                 yield "data: [DONE]\n\n"
+            finally:
+                stream.close()
+                answer = "".join(parts).strip()
+                if completed and answer:
+                    chat_store.append_message(chat_id, new_message("bot", answer))
 
-        headers = {"Cache-Control": "no-cache", "Connection": "keep-alive"}
-        return Response(generate(), mimetype="text/event-stream", headers=headers)
+        headers = {"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Accel-Buffering": "no"}
+        # the body is generated after the view returns; keep it in this request's trace
+        return Response(tracer.bind_iter(generate(), name="stream"), mimetype="text/event-stream", headers=headers)
 
     except Exception as e:
         logger.exception("/stream error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # ---------------- WhatsApp webhook (async ack + background reply) ----------------
-connected_users = set()
 _twilio_client = None
 # increase workers for concurrency
 executor = ThreadPoolExecutor(max_workers=int(os.getenv("WEBHOOK_WORKERS", "20")))
@@ -943,16 +1628,23 @@ def get_twilio_client():
         if not TWILIO_SID or not TWILIO_AUTH_TOKEN:
             logger.warning("Twilio SID/Auth not configured")
             return None
+        from twilio.rest import Client as TwilioClient
+
         _twilio_client = TwilioClient(TWILIO_SID, TWILIO_AUTH_TOKEN)
+        components.set("twilio", "warm")
     return _twilio_client
 
 # Safe send wrapper to avoid Twilio 21619 errors (empty body) and transient failures
 def safe_send_message(client, to, from_, body, max_retries=3):
+    from twilio.base.exceptions import TwilioRestException
+
     if not body or not isinstance(body, str) or not body.strip():
         body = "(response is being prepared)"  # fallback safe text
 
     attempt = 0
     while attempt < max_retries:
+        if attempt:
+            metrics.inc("retries_total", kind="twilio_send")
         try:
             msg = client.messages.create(body=body, from_=from_, to=to)
             return msg
@@ -972,6 +1664,8 @@ def safe_send_message(client, to, from_, body, max_retries=3):
 
 @app.route("/whatsapp", methods=["POST"])
 def whatsapp_webhook():
+    from twilio.twiml.messaging_response import MessagingResponse
+
     twilio_resp = MessagingResponse()
 
     try:
@@ -995,8 +1689,7 @@ def whatsapp_webhook():
         first_msg = incoming_msg.lower().strip()
         greetings = ["hi", "hello", "hey", "hii", "hiii", "hola"]
 
-        if sender not in connected_users and first_msg in greetings:
-            connected_users.add(sender)
+        if first_msg in greetings and conversation_state.claim(sender, "welcomed"):
             welcome = (
                 "👋 Welcome to Medical Chatbot!\n\n"
                 "Ask health questions or send medical images/PDFs."
@@ -1025,7 +1718,8 @@ def whatsapp_webhook():
                     if not url:
                         continue
                     try:
-                        r = requests_session.get(url, auth=(TWILIO_SID, TWILIO_AUTH_TOKEN), timeout=15)
+                        with tracer.span("media_download", idx=idx):
+                            r = requests_session.get(url, auth=(TWILIO_SID, TWILIO_AUTH_TOKEN), timeout=15)
                         if r.status_code == 200:
                             ctype = media_content_types_local[idx] if idx < len(media_content_types_local) else None
                             if ctype:
@@ -1047,14 +1741,23 @@ def whatsapp_webhook():
                     except Exception as e:
                         logger.exception("Exception downloading media in background: %s", e)
 
-                # OCR
-                for fp in saved_files:
-                    try:
-                        txt = extract_text_from_any(fp)
-                        if txt and txt.strip():
-                            extracted_texts.append(txt.strip())
-                    except Exception as e:
-                        logger.exception("Background OCR error: %s", e)
+                # OCR (images in parallel on the OCR pool; PDFs page by page, with a progress message)
+                try:
+                    if saved_files:
+                        notify = ocr_progress_notifier(
+                            lambda body: safe_send_message(client, sender_local, twilio_from, body))
+                        images = [fp for fp in saved_files if not is_pdf(fp)]
+                        with tracer.span("ocr"):
+                            by_path = dict(zip(images, ocr_service.extract_many(images)))
+                            for fp in saved_files:
+                                if fp not in by_path:
+                                    by_path[fp] = extract_with_progress(fp, notify)
+                        results = [by_path[fp] for fp in saved_files]
+                        for txt in results:
+                            if txt and txt.strip():
+                                extracted_texts.append(txt.strip())
+                except Exception as e:
+                    logger.exception("Background OCR error: %s", e)
 
                 # prepare input
                 body_for_rag = " ".join(extracted_texts).strip() if extracted_texts else incoming_msg_local
@@ -1062,26 +1765,56 @@ def whatsapp_webhook():
                 if not body_for_rag:
                     reply_text = "⚠ I couldn't read any text from the message."
                 else:
-                    reply_text = call_rag_with_retry(body_for_rag, sender_id=sender_local)
+                    with tracer.span("rag"):
+                        reply_text = call_rag_with_retry(body_for_rag, sender_id=sender_local)
 
                 # send final message (single final reply)
                 try:
-                    safe_send_message(client, sender_local, twilio_from, reply_text)
+                    with tracer.span("twilio_send"):
+                        safe_send_message(client, sender_local, twilio_from, reply_text)
                     logger.info("Final reply sent to %s", sender_local)
                 except Exception as e:
                     logger.exception("Failed to send final reply: %s", e)
+                    mark_request_error("/whatsapp")
 
             except Exception:
                 logger.exception("Error in background_process_and_reply")
+                mark_request_error("/whatsapp")
 
-        executor.submit(background_process_and_reply, sender, incoming_msg, media_urls, media_content_types)
+        executor.submit(tracer.bind(background_process_and_reply, "whatsapp.reply"),
+                        sender, incoming_msg, media_urls, media_content_types)
         return resp_immediate
 
     except Exception as e:
         logger.exception("WhatsApp webhook error: %s", e)
+        mark_request_error()
         twilio_resp.message("⚠ Server error. Please try again later.")
         return Response(str(twilio_resp), content_type="application/xml; charset=utf-8")
 
+# ---------------- preloaded workers ----------------
+def reset_after_fork():
+    """
+    Called in every gunicorn worker forked from a preloaded master (gunicorn.conf.py).
+    The loaded models stay shared copy-on-write; sockets, SQLite connections and
+    remote index clients must not be shared across processes, so they are recreated.
+    """
+    global requests_session, startup_timer
+    requests_session = make_requests_session()
+    for store in (chat_store, conversation_state, ocr_cache, tts_cache):
+        store = getattr(store, "target", store)  # chat_store is wrapped in a TimedProxy
+        if store is not None and hasattr(store, "_local"):
+            store._local = threading.local()  # drop the master's SQLite connections
+    startup_timer = StartupTimer()
+    if VECTOR_BACKEND != "local" and _rag_initialized:
+        # reuses the embedding model already in memory; only the Pinecone client is new
+        initialize_rag_once(force=True)
+    startup_timer.log("Worker ready")
+
+
+startup_timer.mark("app_module")
+if multiprocessing.parent_process() is None:
+    startup_timer.log()
+
 # ---------------- run ----------------
 if __name__ == "__main__":
     # if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
@@ -0,0 +1,521 @@
+"""
+ASGI entry point: web, SMS and WhatsApp channels served from one asyncio app.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+The message routes (/get, /api/chats/<id>/messages, /api/chats/<id>/stream,
+/sms, /whatsapp) run on the event loop:
+
+- LLM calls go through one pooled keep-alive AsyncGitHubModelsClient.
+- Embedding + retrieval (build_rag_request) run in a dedicated executor; OCR goes
+  to the process pool of src/ocr_service.py.
+- Twilio sends run in their own small executor.
+- Each upstream has its own concurrency cap.
+- Requests, stage latencies and retries go to the same registry as the Flask
+  routes (core.metrics, served at /metrics).
+
+A slow model call therefore holds a coroutine, not a thread. Every other route
+(chat CRUD, /tts, /uploads, ...) is the unchanged Flask app mounted via WSGI.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.middleware.wsgi import WSGIMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from werkzeug.utils import secure_filename
+
+import app as core  # Flask app module: config, chat store, RAG pipeline helpers
+from src.async_llm import AsyncGitHubModelsClient
+from src.chat_store import make_title
+from src.metrics import executor_queue_depth
+from src.singleflight import AsyncSingleFlight, make_key
+
+logger = logging.getLogger("medical-chatbot")
+
+# ---------------- concurrency limits ----------------
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "64"))
+RAG_EXECUTOR_WORKERS = int(os.getenv("RAG_EXECUTOR_WORKERS", "8"))
+TWILIO_WORKERS = int(os.getenv("TWILIO_WORKERS", "8"))
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", "16"))
+
+rag_executor = ThreadPoolExecutor(max_workers=RAG_EXECUTOR_WORKERS, thread_name_prefix="rag")
+twilio_executor = ThreadPoolExecutor(max_workers=TWILIO_WORKERS, thread_name_prefix="twilio")
+media_semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+
+llm = AsyncGitHubModelsClient(core.GITHUB_TOKEN, max_concurrency=LLM_CONCURRENCY,
+                              parse_response=core.extract_chat_content)
+media_client = httpx.AsyncClient(timeout=15.0, follow_redirects=True,
+                                 limits=httpx.Limits(max_connections=MEDIA_CONCURRENCY))
+rag_singleflight = AsyncSingleFlight()
+tracer = core.tracer
+core.metrics.gauge("executor_queue_depth", lambda: executor_queue_depth(rag_executor), executor="rag")
+core.metrics.gauge("executor_queue_depth", lambda: executor_queue_depth(twilio_executor), executor="twilio")
+
+_background_tasks = set()
+
+
+async def run_in(executor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()  # spans opened in the executor thread join the request trace
+    return await loop.run_in_executor(executor, lambda: ctx.run(fn, *args, **kwargs))
+
+
+def spawn(coro):
+    """Fire-and-forget task that is kept referenced until it finishes (and keeps its trace open)."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    release = tracer.hold_current()
+    task.add_done_callback(lambda _: release())
+    return task
+
+
+async def in_span(name: str, coro):
+    with tracer.span(name):
+        return await coro
+
+
+# ---------------- async RAG pipeline ----------------
+async def generate_with_retry_async(final_prompt, cache_key=None, retries=3, delay=1.0):
+    cur_delay = delay
+    for attempt in range(1, retries + 1):
+        if attempt > 1:
+            core.metrics.inc("retries_total", kind="llm")
+        try:
+            with tracer.span("llm"):
+                ans = await llm.chat(core.system_prompt, final_prompt, core.CHAT_MODEL,
+                                     core.CHAT_TEMPERATURE, core.CHAT_MAX_TOKENS, timeout=25)
+            if not ans or not str(ans).strip():
+                logger.warning("LLM returned empty response on attempt %d", attempt)
+                continue
+            ans = str(ans).strip()
+            if cache_key is not None:
+                core.answer_cache.put(cache_key, ans)
+            return ans
+        except Exception as e:
+            logger.warning("RAG attempt %d failed: %s", attempt, e)
+            if "rate" in str(e).lower() or "429" in str(e):
+                await asyncio.sleep(cur_delay)
+                cur_delay *= 2
+                continue
+            return "⚠ Error generating response. Please try again."
+    return "⚠ I could not generate a response. Please rephrase your question."
+
+
+async def call_rag_async(text, sender_id=None, retries=3, delay=1.0):
+    answer, rag_text, intent, use_cache = await run_in(rag_executor, core.resolve_rag_query, text,
+                                                       sender_id=sender_id)
+    if answer is not None:
+        return answer
+
+    async def compute():
+        answer, final_prompt, cache_key = await run_in(rag_executor, core.prepare_rag_prompt, rag_text, intent,
+                                                       use_cache=use_cache)
+        if answer is not None:
+            return answer
+        return await generate_with_retry_async(final_prompt, cache_key, retries=retries, delay=delay)
+
+    if not core.COALESCE_ENABLED:
+        answer = await compute()
+    else:
+        answer = await rag_singleflight.do(make_key(rag_text, intent, use_cache), compute)
+    await run_in(rag_executor, core.remember_answer, sender_id, answer)
+    return answer
+
+
+async def stream_rag_async(text, sender_id=None):
+    answer, final_prompt, cache_key = await run_in(rag_executor, core.build_rag_request, text, sender_id=sender_id)
+    if answer is not None:
+        yield answer
+        return
+    parts = []
+    started = time.perf_counter()
+    try:
+        async for delta in llm.chat_stream(core.system_prompt, final_prompt, core.CHAT_MODEL,
+                                           core.CHAT_TEMPERATURE, core.CHAT_MAX_TOKENS, timeout=25):
+            if not parts:
+                tracer.record("llm_first_token", started)
+            parts.append(delta)
+            yield delta
+        tracer.record("llm", started)
+    except Exception as e:
+        logger.warning("Streaming LLM call failed: %s", e)
+        if not parts:
+            ans = await generate_with_retry_async(final_prompt, cache_key)
+            await run_in(rag_executor, core.remember_answer, sender_id, ans)
+            yield ans
+            return
+        yield "\n⚠ Response interrupted. Please try again."
+        return
+    ans = "".join(parts).strip()
+    if not ans:
+        ans = await generate_with_retry_async(final_prompt, cache_key)
+        yield ans
+    elif cache_key is not None:
+        core.answer_cache.put(cache_key, ans)
+    await run_in(rag_executor, core.remember_answer, sender_id, ans)
+
+
+async def ocr_async(path: str, notify: Optional[Callable[[int], None]] = None) -> str:
+    try:
+        with tracer.span("ocr"):
+            if notify and core.is_pdf(path):
+                return await asyncio.to_thread(core.extract_with_progress, path, notify) or ""
+            return await core.ocr_service.extract_async(path) or ""
+    except Exception as e:
+        logger.exception("OCR error: %s", e)
+        return ""
+
+
+def combine_input(text: str, extracted: Optional[str]) -> str:
+    final_input = text or ""
+    if extracted:
+        final_input = (final_input + "\n\nExtracted from image:\n" + extracted) if final_input else extracted
+    return final_input
+
+
+async def save_upload(upload, prefix: str) -> str:
+    filename = secure_filename(f"{prefix}_{upload.filename}")
+    filepath = os.path.join(core.UPLOAD_FOLDER, filename)
+    data = await upload.read()
+    await asyncio.to_thread(_write_file, filepath, data)
+    return filepath
+
+
+def _write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class MetricsMiddleware:
+    """
+    Request count / latency (to response headers) / errors and the request trace
+    for the routes served here. Requests that fall through to the mounted Flask
+    app are counted and traced by its own hooks.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        recorded = False
+        headers = dict(scope.get("headers") or [])
+        profile = core.should_profile(headers.get(b"x-profile", b"").decode("latin-1") or None)
+        trace = tracer.start(f"{scope.get('method', 'GET')} {scope.get('path', '')}", profile=profile)
+
+        def record(status: int):
+            nonlocal recorded
+            route = scope.get("route")  # set by FastAPI routing; absent for the Flask mount
+            if not recorded and route is not None:
+                recorded = True
+                error = bool(scope.get("state", {}).get("metrics_error"))
+                core.record_request(route.path, status, time.perf_counter() - start, error)
+
+        async def send_timed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                record(status)
+                if trace is not None and scope.get("route") is not None:
+                    message.setdefault("headers", []).append((b"x-trace-id", trace[0].id.encode()))
+            await send(message)
+
+        status = 500
+        try:
+            await self.app(scope, receive, send_timed)
+        except Exception:
+            record(500)
+            raise
+        finally:
+            route = scope.get("route")
+            if route is None:
+                tracer.discard(trace)  # Flask mount: traced by the Flask hooks
+            else:
+                if trace is not None:
+                    trace[0].root.name = f"{scope.get('method', 'GET')} {route.path}"
+                    trace[0].root.attrs["channel"] = core.request_channel(route.path)
+                tracer.finish(trace, status=status)
+
+
+def mark_error(request: Request):
+    """Count a failure answered with a message (the routes below reply 200 with a warning)."""
+    request.state.metrics_error = True
+
+
+# ---------------- app ----------------
+app = FastAPI(title="Medibot")
+app.add_middleware(MetricsMiddleware)
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await llm.aclose()
+    await media_client.aclose()
+    for ex in (rag_executor, twilio_executor):
+        ex.shutdown(wait=False)
+    core.ocr_service.shutdown()
+
+
+# ---------------- web channel ----------------
+@app.post("/get")
+async def chat_web_ui(request: Request):
+    try:
+        form = await request.form()
+        msg = (form.get("msg") or "").strip()
+        image = form.get("image")
+        extracted_text = None
+        if image is not None and getattr(image, "filename", None):
+            savepath = await save_upload(image, uuid.uuid4().hex)
+            extracted_text = await ocr_async(savepath)
+            logger.info("OCR preview: %s", extracted_text[:200])
+        final_input = combine_input(msg, extracted_text)
+        if not final_input.strip():
+            return PlainTextResponse("⚠ Please send a message or upload an image.")
+        return PlainTextResponse(await call_rag_async(final_input, sender_id=None))  # stateless, as in app.py
+    except Exception as e:
+        logger.exception("/get error: %s", e)
+        mark_error(request)
+        return PlainTextResponse("⚠ Server error.")
+
+
+@app.post("/api/chats/{chat_id}/messages")
+async def api_add_message(chat_id: str, request: Request):
+    try:
+        store = core.chat_store
+        if not await asyncio.to_thread(store.chat_exists, chat_id):
+            return JSONResponse({"error": "Chat not found"}, status_code=404)
+        form = await request.form()
+        text = (form.get("msg") or "").strip()
+        file = form.get("image")
+        if not getattr(file, "filename", None):
+            file = None
+        if not text and not file:
+            return JSONResponse({"error": "Empty message"}, status_code=400)
+
+        local_image_path = image_url = None
+        if file:
+            local_image_path = await save_upload(file, f"{chat_id}_{int(time.time())}")
+            image_url = f"/uploads/{os.path.basename(local_image_path)}"
+
+        user_msg = core.new_message("user", text, image_url)
+        if not await asyncio.to_thread(store.append_message, chat_id, user_msg,
+                                       make_title(text) if text else None):
+            return JSONResponse({"error": "Chat not found"}, status_code=404)
+
+        extracted = await ocr_async(local_image_path) if local_image_path else ""
+        answer = await call_rag_async(combine_input(text, extracted), sender_id=core.chat_sender_id(chat_id))
+        await asyncio.to_thread(store.append_message, chat_id, core.new_message("bot", answer))
+        return JSONResponse({"chat": await asyncio.to_thread(store.get_chat, chat_id)})
+    except Exception:
+        logger.exception("api_add_message (async) error")
+        return JSONResponse({"error": "Internal server error"}, status_code=500)
+
+
+@app.post("/api/chats/{chat_id}/stream")
+async def api_chat_stream(chat_id: str, request: Request):
+    try:
+        store = core.chat_store
+        if not await asyncio.to_thread(store.chat_exists, chat_id):
+            return JSONResponse({"error": "Chat not found"}, status_code=404)
+
+        text = ""
+        saved_local_image = None
+        extracted_text = None
+        ctype = request.headers.get("content-type", "")
+        if ctype.startswith("application/json"):
+            payload = await request.json() or {}
+            text = (payload.get("message") or payload.get("msg") or payload.get("text") or "").strip()
+            image_b64 = payload.get("image_base64") or payload.get("imageBase64")
+            if image_b64:
+                try:
+                    saved_local_image = await asyncio.to_thread(core.save_base64_image, chat_id, image_b64)
+                except Exception as e:
+                    logger.exception("Failed to decode/save OCR image from JSON: %s", e)
+        else:
+            form = await request.form()
+            text = (form.get("msg") or form.get("message") or "").strip()
+            uploads = [v for v in form.values() if getattr(v, "filename", None)]
+            upload = form.get("image") or form.get("file") or (uploads[0] if uploads else None)
+            if getattr(upload, "filename", None):
+                saved_local_image = await save_upload(upload, f"{chat_id}_{int(time.time())}")
+        if saved_local_image:
+            extracted_text = await ocr_async(saved_local_image)
+
+        final_input = combine_input(text, extracted_text)
+        if not final_input.strip():
+            return JSONResponse({"error": "Message or image required"}, status_code=400)
+
+        user_msg = core.new_message(
+            "user",
+            text if text else (extracted_text or ""),
+            f"/uploads/{os.path.basename(saved_local_image)}" if saved_local_image else None,
+        )
+        if not await asyncio.to_thread(store.append_message, chat_id, user_msg,
+                                       make_title(user_msg["text"]) if user_msg["text"] else None):
+            return JSONResponse({"error": "Chat not found"}, status_code=404)
+
+        token_mode = request.query_params.get("mode") == "tokens"
+
+        async def generate():
+            parts = []
+            try:
+                framer = core.LineFramer()
+                async for piece in stream_rag_async(final_input, sender_id=core.chat_sender_id(chat_id)):
+                    parts.append(piece)
+                    if token_mode:
+                        yield f"data: {json.dumps({'delta': piece}, ensure_ascii=False)}\n\n"
+                        continue
+                    for line in framer.feed(piece):
+                        yield f"data: {line}\n\n"
+                for line in framer.flush():
+                    yield f"data: {line}\n\n"
+                # saved before [DONE] and off the event loop; a finally block cannot await once
+                # the generator is being closed
+                answer = "".join(parts).strip()
+                if answer:
+                    await asyncio.to_thread(store.append_message, chat_id, core.new_message("bot", answer))
+                yield "data: [DONE]\n\n"
+            except asyncio.CancelledError:
+                logger.info("Stream client disconnected for chat %s; cancelling generation", chat_id)
+                raise
+            except Exception as e:
+                logger.exception("Stream generator exception: %s", e)
+                core.mark_request_error("/api/chats/{chat_id}/stream")  # the response already started
+                yield f"data: ⚠ Streaming error: {str(e)}\n\n"
+                yield "data: [DONE]\n\n"
+
+        headers = {"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Accel-Buffering": "no"}
+        return StreamingResponse(generate(), media_type="text/event-stream", headers=headers)
+    except Exception as e:
+        logger.exception("/stream error: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+# ---------------- SMS / WhatsApp channels ----------------
+def twiml(message: Optional[str] = None) -> Response:
+    from twilio.twiml.messaging_response import MessagingResponse
+    resp = MessagingResponse()
+    if message:
+        resp.message(message)
+    return Response(str(resp), media_type="application/xml; charset=utf-8")
+
+
+async def download_media(sender: str, idx: int, url: str, ctype: Optional[str]) -> Optional[str]:
+    try:
+        async with media_semaphore:
+            r = await media_client.get(url, auth=(core.TWILIO_SID, core.TWILIO_AUTH_TOKEN))
+        if r.status_code != 200:
+            logger.warning("Failed to download media %s status=%d", url, r.status_code)
+            return None
+        if ctype:
+            ext = ctype.split('/')[-1]
+        else:
+            ext = url.split('.')[-1].split('?')[0][:6] or "bin"
+        filename = secure_filename(f"{sender.replace(':', '')}_{uuid.uuid4().hex}_{idx}.{ext}")
+        fp = os.path.join(core.UPLOAD_FOLDER, filename)
+        await asyncio.to_thread(_write_file, fp, r.content)
+        logger.info("Saved media: %s", fp)
+        return fp
+    except Exception as e:
+        logger.exception("Exception downloading media: %s", e)
+        return None
+
+
+async def process_and_reply(sender: str, twilio_from: str, incoming_msg: str, media, route: str):
+    try:
+        client = core.get_twilio_client()
+        if not client or not twilio_from:
+            logger.error("Twilio not configured.")
+            return
+        with tracer.span("media_download"):
+            saved = await asyncio.gather(*(download_media(sender, i, url, ct)
+                                           for i, (url, ct) in enumerate(media) if url))
+        notify = core.ocr_progress_notifier(
+            lambda body: twilio_executor.submit(core.safe_send_message, client, sender, twilio_from, body))
+        texts = await asyncio.gather(*(ocr_async(fp, notify) for fp in saved if fp))
+        extracted = [t.strip() for t in texts if t and t.strip()]
+        body_for_rag = " ".join(extracted).strip() if extracted else incoming_msg
+        if not body_for_rag:
+            reply_text = "⚠ I couldn't read any text from the message."
+        else:
+            with tracer.span("rag"):
+                reply_text = await call_rag_async(body_for_rag, sender_id=sender)
+        try:
+            with tracer.span("twilio_send"):
+                await run_in(twilio_executor, core.safe_send_message, client, sender, twilio_from, reply_text)
+            logger.info("Final reply sent to %s", sender)
+        except Exception as e:
+            logger.exception("Failed to send final reply: %s", e)
+            core.mark_request_error(route)
+    except Exception:
+        logger.exception("Error in process_and_reply")
+        core.mark_request_error(route)
+
+
+async def _messaging_webhook(request: Request, default_from: str):
+    try:
+        form = await request.form()
+        sender = form.get("From", "")
+        incoming_msg = (form.get("Body", "") or "").strip()
+        try:
+            num_media = int(form.get("NumMedia", 0))
+        except Exception:
+            num_media = 0
+        media = [(form.get(f"MediaUrl{i}"), form.get(f"MediaContentType{i}")) for i in range(num_media)]
+        logger.info("Message from %s: '%s' media=%d", sender, incoming_msg[:120], num_media)
+
+        first_msg = incoming_msg.lower().strip()
+        greetings = ["hi", "hello", "hey", "hii", "hiii", "hola"]
+        if first_msg in greetings and await asyncio.to_thread(core.conversation_state.claim, sender, "welcomed"):
+            return twiml(
+                "👋 Welcome to Medical Chatbot!\n\n"
+                "Ask health questions or send medical images/PDFs."
+            )
+
+        # immediate empty TwiML ack; the answer is sent through the REST API
+        route = request.url.path
+        spawn(in_span(f"{core.request_channel(route)}.reply",
+                      process_and_reply(sender, form.get("To") or default_from, incoming_msg, media, route)))
+        return twiml()
+    except Exception as e:
+        logger.exception("Messaging webhook error: %s", e)
+        mark_error(request)
+        return twiml("⚠ Server error. Please try again later.")
+
+
+@app.post("/whatsapp")
+async def whatsapp_webhook(request: Request):
+    return await _messaging_webhook(request, core.TWILIO_WHATSAPP_NUMBER)
+
+
+@app.post("/sms")
+async def sms_webhook(request: Request):
+    return await _messaging_webhook(request, os.getenv("TWILIO_SMS_NUMBER", ""))
+
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    stats = await asyncio.to_thread(core.cache_stats)  # the SQLite-backed stores count rows
+    stats["singleflight_async"] = rag_singleflight.stats()  # this event loop; "singleflight" is the Flask routes'
+    return stats
+
+
+# Everything else (chat CRUD, /tts, /uploads, ...) -> Flask
+app.mount("/", WSGIMiddleware(core.app))
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
@@ -0,0 +1,123 @@
+"""
+Embedding backend benchmark: torch (sentence-transformers) vs ONNX Runtime fp32 / int8.
+
+    python bench_embeddings.py                              # all backends, built-in sample texts
+    python bench_embeddings.py --texts questions.txt        # one text per line
+    python bench_embeddings.py --backends onnx,onnx-int8 --threads 2
+    python bench_embeddings.py --quantize onnx_model/       # write onnx_model/model_int8.onnx from model.onnx
+
+Each backend runs in a fresh process, so load time and peak RSS are measured
+per backend. Vectors of every backend are compared with the first one
+(cosine min/mean); the index stays usable when the minimum is ~0.99 or more.
+"""
+import os
+import time
+import argparse
+import resource
+import multiprocessing
+
+SAMPLE_TEXTS = [
+    "What are the symptoms of dengue fever?",
+    "Can I take paracetamol 500mg with azithromycin?",
+    "How to reduce high blood pressure naturally",
+    "Side effects of B-complex tablets",
+    "My child has diarrhea and vomiting since morning, what should I do?",
+    "Typhoid fever is a bacterial infection caused by Salmonella Typhi. It spreads through contaminated food and "
+    "water. Symptoms include prolonged fever, weakness, abdominal pain and headache. Treatment is with antibiotics.",
+    "Diabetes mellitus is a group of metabolic disorders characterised by high blood sugar over a prolonged period.",
+    "Asthma is a long-term inflammatory disease of the airways of the lungs.",
+]
+
+
+def _run_backend(backend: str, texts, threads, repeat: int, batch: int, conn):
+    if threads:
+        os.environ["EMBED_THREADS"] = str(threads)
+        os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+    from src.helper import load_base_embeddings
+
+    t = time.perf_counter()
+    emb = load_base_embeddings(backend)
+    if backend == "torch" and threads:
+        import torch
+        torch.set_num_threads(threads)
+    emb.embed_query("warm up")
+    load_s = time.perf_counter() - t
+
+    query_ms = []
+    for _ in range(repeat):
+        for text in texts[:8]:
+            t = time.perf_counter()
+            emb.embed_query(text)
+            query_ms.append((time.perf_counter() - t) * 1000)
+
+    docs = (texts * (batch // len(texts) + 1))[:batch]
+    t = time.perf_counter()
+    emb.embed_documents(docs)
+    docs_per_s = len(docs) / (time.perf_counter() - t)
+
+    vectors = emb.embed_documents(texts)
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    conn.send((load_s, query_ms, docs_per_s, rss_mb, vectors))
+    conn.close()
+
+
+def run_backend(backend: str, texts, threads, repeat: int, batch: int):
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_backend, args=(backend, texts, threads, repeat, batch, child))
+    proc.start()
+    try:
+        return parent.recv()
+    except EOFError:
+        return None
+    finally:
+        proc.join()
+
+
+def pct(values, q):
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark embedding backends (latency, throughput, RSS, parity).")
+    parser.add_argument("--backends", default="torch,onnx,onnx-int8")
+    parser.add_argument("--texts", help="file with one text per line")
+    parser.add_argument("--threads", type=int, default=0, help="intra-op threads (0 = library default)")
+    parser.add_argument("--repeat", type=int, default=20, help="passes over the query set")
+    parser.add_argument("--batch", type=int, default=256, help="documents for the throughput run")
+    parser.add_argument("--quantize", metavar="DIR", help="write DIR/model_int8.onnx from DIR/model.onnx and exit")
+    args = parser.parse_args()
+
+    if args.quantize:
+        from src.onnx_embeddings import quantize_model
+        out = quantize_model(os.path.join(args.quantize, "model.onnx"), os.path.join(args.quantize, "model_int8.onnx"))
+        print(f"wrote {out} (use EMBED_MODEL={args.quantize} EMBED_ONNX_FILE=model_int8.onnx EMBED_BACKEND=onnx)")
+        return
+
+    texts = SAMPLE_TEXTS
+    if args.texts:
+        with open(args.texts, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    from src.onnx_embeddings import cosine_parity
+
+    print(f"{len(texts)} texts, {args.batch} docs for throughput, threads={args.threads or 'default'}")
+    print(f"{'backend':<10} {'load s':>7} {'q p50 ms':>9} {'q p95 ms':>9} {'docs/s':>8} {'RSS MB':>8} "
+          f"{'cos min':>8} {'cos mean':>9}")
+    reference = None
+    for backend in [b.strip() for b in args.backends.split(",") if b.strip()]:
+        result = run_backend(backend, texts, args.threads, args.repeat, args.batch)
+        if result is None:
+            print(f"{backend:<10} failed (see traceback above)")
+            continue
+        load_s, query_ms, docs_per_s, rss_mb, vectors = result
+        if reference is None:
+            reference = vectors
+        parity = cosine_parity(reference, vectors)
+        print(f"{backend:<10} {load_s:>7.2f} {pct(query_ms, 0.5):>9.2f} {pct(query_ms, 0.95):>9.2f} "
+              f"{docs_per_s:>8.1f} {rss_mb:>8.1f} {parity['min']:>8.4f} {parity['mean']:>9.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Intent detection benchmark: accuracy on intent_labels.tsv and ns/query.
+
+intent_labels_heldout.tsv is a held-out slice that is never used to tune the
+rules; it is reported separately, so a change that only fits the tuning set
+shows up as a held-out regression.
+
+    python bench_intent.py                 # legacy keyword scans vs compiled engine
+    python bench_intent.py --embeddings    # + nearest-centroid stage (loads the embedding model)
+    python bench_intent.py --errors        # list misclassified messages
+"""
+import os
+import time
+import argparse
+from collections import Counter
+
+from src.intent import CentroidIntentClassifier, detect_intent
+
+LABELS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_labels.tsv")
+HELDOUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_labels_heldout.tsv")
+
+
+def legacy_detect_intent(text: str):
+    """app.detect_intent before the compiled engine (kept here for comparison)."""
+    t = text.lower().strip()
+    greetings = ["hi", "hello", "hey", "hii"]
+    if t in greetings or t.startswith(tuple(greetings)):
+        return ("greeting", None)
+    if "translate" in t or "answer in" in t:
+        return ("translate", t.replace("answer in", "").replace("translate to", "").strip())
+    diseases = ["typhoid", "diabetes", "dengue", "malaria", "cholera", "tuberculosis", "tb", "covid", "asthma",
+                "cancer", "hypertension", "bp"]
+    if t in diseases:
+        return ("medical", None)
+    medicine_keywords = ["tablet", "capsule", "medicine", "drug", "syrup", "injection", "b-complex", "paracetamol",
+                         "crocin", "azithromycin", "vitamin"]
+    if any(m in t for m in medicine_keywords):
+        return ("medical", None)
+    followups = ["side effects", "sideeffect", "dose", "dosage", "how many", "continue", "more", "why", "safe",
+                 "pregnant", "children", "elderly", "how to", "recover", "cure", "overcome", "get rid", "treat this",
+                 "fix this"]
+    for f in followups:
+        if f in t:
+            return ("followup", None)
+    medical_words = ["symptom", "symptoms", "pain", "fever", "cough", "infection", "disease", "treatment", "cause",
+                     "diagnosis", "medicine", "tablet", "drug", "rash", "diarrhea", "asthma", "diabetes", "heart",
+                     "skin", "typhoid", "mental", "lifestyle", "health", "wellness", "interaction", "interactions",
+                     "side effect", "exercise", "diet", "stress"]
+    if any(w in t for w in medical_words) or t.startswith(("what is", "explain")):
+        return ("medical", None)
+    identity_phrases = ["who created you", "who made you", "who built you", "who are you", "what are you",
+                        "are you a doctor", "are you human", "your creator", "your owner"]
+    for p in identity_phrases:
+        if p in t:
+            return ("identity", None)
+    return ("other", None)
+
+
+def load_labels(path: str = LABELS_FILE):
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            text, label = line.rstrip("\n").split("\t")
+            rows.append((text, label))
+    return rows
+
+
+def evaluate(name: str, fn, rows, repeat: int, show_errors: bool):
+    errors = [(t, want, fn(t)[0]) for t, want in rows if fn(t)[0] != want]
+    texts = [t for t, _ in rows]
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        for t in texts:
+            fn(t)
+    ns = (time.perf_counter_ns() - start) / (repeat * len(texts))
+    acc = 1 - len(errors) / len(rows)
+    by_label = Counter(want for _, want, _ in errors)
+    print(f"{name:<12} accuracy {acc:6.1%}  {ns:>9.0f} ns/query  errors by label: {dict(by_label) or '-'}")
+    if show_errors:
+        for t, want, got in errors:
+            print(f"    {t!r}: expected {want}, got {got}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Intent detection accuracy and latency.")
+    parser.add_argument("--labels", default=LABELS_FILE)
+    parser.add_argument("--heldout", default=HELDOUT_FILE, help="held-out labels, reported separately ('' to skip)")
+    parser.add_argument("--repeat", type=int, default=2000, help="passes over the set for timing")
+    parser.add_argument("--embeddings", action="store_true", help="also evaluate rules + nearest centroid")
+    parser.add_argument("--errors", action="store_true")
+    args = parser.parse_args()
+
+    sets = [("tuning", load_labels(args.labels))]
+    if args.heldout:
+        sets.append(("held-out", load_labels(args.heldout)))
+    for name, rows in sets:
+        print(f"{name}: {len(rows)} labelled messages")
+        evaluate("legacy", legacy_detect_intent, rows, args.repeat, args.errors)
+        evaluate("compiled", detect_intent, rows, args.repeat, args.errors)
+
+    if args.embeddings:
+        from src.helper import download_hugging_face_embeddings
+
+        clf = CentroidIntentClassifier(download_hugging_face_embeddings())
+        texts = [t for _, rows in sets for t, _ in rows]
+        vectors = dict(zip(texts, clf.embeddings.embed_documents(texts)))
+
+        def combined(t):
+            intent, lang = detect_intent(t)
+            if intent == "other":
+                label, _ = clf.classify_vector(vectors[t])  # query vector is precomputed in the app too
+                if label in ("medical", "followup", "greeting"):
+                    return (label, None)
+            return (intent, lang)
+
+        for name, rows in sets:
+            print(f"{name}:")
+            evaluate("+centroid", combined, rows, max(1, args.repeat // 20), args.errors)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+"""
+Offline load test: replays a traffic mix against the app with every remote
+dependency replaced by a local stand-in (bench_stubs.py), and reports
+throughput, p50/p95/p99 latency and server RSS.
+
+    python bench_load.py                                  # flask, default mix, 30 s, 8 clients
+    python bench_load.py --server asgi --concurrency 32   # the uvicorn entry point
+    python bench_load.py --mix whatsapp --repeat 0        # every question is new (answer cache misses)
+    python bench_load.py --json out.json                  # save the report
+    python bench_load.py --baseline out.json              # exit 1 if p95 / throughput / RSS regressed
+
+Scenarios: get (/get), messages (/api/chats/<id>/messages), stream
+(/api/chats/<id>/stream, ?mode=tokens; also reports time to first token),
+whatsapp (/whatsapp ack; whatsapp_e2e is webhook -> reply delivered to the
+fake Twilio API) and tts (/tts; tts_first_audio is the time to the first
+audio bytes). The app, the fake upstreams and the load generator each run in
+their own process; no connection leaves 127.0.0.1.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import requests
+
+from bench_stubs import build_indexes, fresh_query, hot_queries, offline_env, run_app, run_upstreams
+
+SCENARIOS = ("get", "messages", "stream", "whatsapp", "tts")
+MIXES = {
+    "default": "get=25,messages=20,stream=25,whatsapp=20,tts=10",
+    "web": "get=30,messages=30,stream=40",
+    "whatsapp": "whatsapp=100",
+    "tts": "tts=100",
+}
+CHAT_ROTATE = 20  # messages per chat before a worker starts a new one (bounds history growth)
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    spec = MIXES.get(spec, spec)
+    weights = {}
+    for part in spec.split(","):
+        name, _, w = part.strip().partition("=")
+        if name not in SCENARIOS:
+            raise ValueError(f"unknown scenario {name!r} (expected one of {', '.join(SCENARIOS)})")
+        weights[name] = float(w or 1)
+    return weights
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[i]
+
+
+# ---------------- RSS ----------------
+def _children(pid: int) -> List[int]:
+    out = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                out.extend(int(c) for c in f.read().split())
+    except OSError:
+        pass
+    return out
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def tree_rss_kb(pid: int) -> int:
+    """RSS of ``pid`` plus all its descendants (OCR workers, ...)."""
+    total, stack, seen = 0, [pid], set()
+    while stack:
+        p = stack.pop()
+        if p in seen:
+            continue
+        seen.add(p)
+        total += _rss_kb(p)
+        stack.extend(_children(p))
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.2):
+        super().__init__(name="rss", daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.start_kb = tree_rss_kb(pid)
+        self.peak_kb = self.start_kb
+        self.end_kb = self.start_kb
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            kb = tree_rss_kb(self.pid)
+            if kb:
+                self.end_kb = kb
+                self.peak_kb = max(self.peak_kb, kb)
+
+    def stop(self) -> Dict:
+        self._done.set()
+        self.join()
+        self.end_kb = tree_rss_kb(self.pid) or self.end_kb
+        return {"start_mb": self.start_kb / 1024, "peak_mb": max(self.peak_kb, self.end_kb) / 1024,
+                "end_mb": self.end_kb / 1024}
+
+
+# ---------------- load generation ----------------
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.measuring = False
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.pending: Dict[str, float] = {}  # whatsapp To number -> webhook send time
+
+    def add(self, name: str, seconds: Optional[float], ok: bool = True):
+        if not self.measuring:
+            return
+        with self._lock:
+            if ok:
+                self.samples[name].append(seconds)
+            else:
+                self.errors[name] += 1
+
+
+class Worker(threading.Thread):
+    def __init__(self, idx: int, base: str, weights: Dict[str, float], repeat: float, rec: Recorder,
+                 stop: threading.Event, think: float, seed: int):
+        super().__init__(name=f"client-{idx}", daemon=True)
+        self.idx = idx
+        self.base = base
+        self.names = list(weights)
+        self.weights = [weights[n] for n in self.names]
+        self.repeat = repeat
+        self.rec = rec
+        self.stop_event = stop
+        self.think = think
+        self.rng = random.Random(seed * 1000 + idx)
+        self.hot = hot_queries()
+        self.session = requests.Session()
+        self.chat_id = None
+        self.chat_messages = 0
+        self.seq = 0
+
+    def question(self) -> str:
+        if self.rng.random() < self.repeat:
+            return self.rng.choice(self.hot)
+        return fresh_query(self.rng)
+
+    def chat(self) -> str:
+        if self.chat_id is None or self.chat_messages >= CHAT_ROTATE:
+            r = self.session.post(f"{self.base}/api/chats", json={"title": "bench"}, timeout=10)
+            r.raise_for_status()
+            self.chat_id, self.chat_messages = r.json()["id"], 0
+        self.chat_messages += 1
+        return self.chat_id
+
+    def run(self):
+        while not self.stop_event.is_set():
+            name = self.rng.choices(self.names, self.weights)[0]
+            t = time.perf_counter()
+            try:
+                ok = getattr(self, "do_" + name)()
+            except (requests.RequestException, ValueError):
+                ok = False
+            if ok is not None:
+                self.rec.add(name, time.perf_counter() - t, ok)
+            if self.think:
+                time.sleep(self.rng.expovariate(1 / self.think))
+
+    def do_get(self):
+        r = self.session.post(f"{self.base}/get", data={"msg": self.question()}, timeout=60)
+        return r.ok and not r.text.startswith("⚠")
+
+    def do_messages(self):
+        chat_id = self.chat()
+        t = time.perf_counter()
+        r = self.session.post(f"{self.base}/api/chats/{chat_id}/messages", data={"msg": self.question()},
+                              timeout=60)
+        self.rec.add("messages", time.perf_counter() - t, r.ok and "chat" in r.json())
+        return None  # timed without the chat creation
+
+    def do_stream(self):
+        chat_id = self.chat()
+        t = time.perf_counter()
+        first, ok = None, False
+        with self.session.post(f"{self.base}/api/chats/{chat_id}/stream", params={"mode": "tokens"},
+                               json={"message": self.question()}, stream=True, timeout=60) as r:
+            if r.ok:
+                for line in r.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    if data.startswith("⚠"):
+                        ok = False
+                        break
+                    if first is None:
+                        first = time.perf_counter() - t
+                    ok = True
+        self.rec.add("stream", time.perf_counter() - t, ok)
+        if first is not None:
+            self.rec.add("stream_ttft", first)
+        return None
+
+    def do_whatsapp(self):
+        self.seq += 1
+        to = f"whatsapp:+1999{self.idx:03d}{self.seq:07d}"
+        if self.rec.measuring:
+            with self.rec._lock:
+                self.rec.pending[to] = time.time()
+        r = self.session.post(f"{self.base}/whatsapp", data={"From": to, "Body": self.question(),
+                                                             "NumMedia": "0"}, timeout=30)
+        return r.ok and "<Response" in r.text
+
+    def do_tts(self):
+        text = " ".join(self.question() for _ in range(self.rng.randint(1, 4)))
+        t = time.perf_counter()
+        size = 0
+        with self.session.post(f"{self.base}/tts", json={"text": text}, stream=True, timeout=60) as r:
+            if not (r.ok and r.headers.get("Content-Type", "").startswith("audio/")):
+                return False
+            for chunk in r.iter_content(chunk_size=None):
+                if chunk and not size:
+                    self.rec.add("tts_first_audio", time.perf_counter() - t)
+                size += len(chunk)
+        return size > 0
+
+
+def collect_deliveries(deliveries, rec: Recorder, stop: threading.Event):
+    """Matches fake-Twilio deliveries to pending webhook sends (whatsapp_e2e)."""
+    while not stop.is_set() or rec.pending:
+        try:
+            to, t, _ = deliveries.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return
+            continue
+        with rec._lock:
+            sent = rec.pending.pop(to, None)
+            if sent is not None:
+                rec.samples["whatsapp_e2e"].append(t - sent)
+
+
+# ---------------- report ----------------
+def summarize(rec: Recorder, elapsed: float) -> Dict:
+    out = {}
+    for name in sorted(set(rec.samples) | set(rec.errors)):
+        values = sorted(rec.samples.get(name, []))
+        n, errors = len(values), rec.errors.get(name, 0)
+        out[name] = {
+            "count": n,
+            "errors": errors,
+            "error_rate": errors / (n + errors) if n + errors else 0.0,
+            "rps": n / elapsed if elapsed else 0.0,
+            "mean_ms": 1000 * sum(values) / n if n else None,
+            "p50_ms": _ms(percentile(values, 0.50)),
+            "p95_ms": _ms(percentile(values, 0.95)),
+            "p99_ms": _ms(percentile(values, 0.99)),
+            "max_ms": _ms(values[-1] if values else None),
+        }
+    return out
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else seconds * 1000
+
+
+def print_report(report: Dict):
+    cfg = report["config"]
+    print(f"\nserver={cfg['server']} mix={cfg['mix']} concurrency={cfg['concurrency']} "
+          f"duration={report['elapsed_s']:.1f}s repeat={cfg['repeat']}")
+    print(f"{'scenario':<16}{'count':>8}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}")
+    for name, s in report["scenarios"].items():
+        cols = [f"{s[k]:>10.1f}" if s[k] is not None else f"{'-':>10}" for k in ("p50_ms", "p95_ms", "p99_ms",
+                                                                                  "max_ms")]
+        print(f"{name:<16}{s['count']:>8}{s['errors']:>6}{s['rps']:>9.2f}" + "".join(cols))
+    print(f"{'total':<16}{report['total']['count']:>8}{report['total']['errors']:>6}{report['total']['rps']:>9.2f}")
+    rss = report["rss"]
+    print(f"server RSS (incl. children): start {rss['start_mb']:.1f} MB, peak {rss['peak_mb']:.1f} MB, "
+          f"end {rss['end_mb']:.1f} MB")
+    if report.get("answer_cache"):
+        print("answer cache:", json.dumps(report["answer_cache"]))
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Regressions of ``report`` against ``baseline``: p95 up, throughput down, errors up, peak RSS up."""
+    problems = []
+    for name, base in baseline.get("scenarios", {}).items():
+        cur = report["scenarios"].get(name)
+        if cur is None:
+            continue
+        if base["p95_ms"] and cur["p95_ms"] and cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p95 {cur['p95_ms']:.1f} ms > baseline {base['p95_ms']:.1f} ms")
+        if cur["error_rate"] > base["error_rate"] + 0.01:
+            problems.append(f"{name}: error rate {cur['error_rate']:.1%} > baseline {base['error_rate']:.1%}")
+    base_rps, cur_rps = baseline.get("total", {}).get("rps"), report["total"]["rps"]
+    if base_rps and cur_rps < base_rps * (1 - tolerance):
+        problems.append(f"throughput {cur_rps:.2f} rps < baseline {base_rps:.2f} rps")
+    base_rss = baseline.get("rss", {}).get("peak_mb")
+    if base_rss and report["rss"]["peak_mb"] > base_rss * (1 + tolerance):
+        problems.append(f"peak RSS {report['rss']['peak_mb']:.1f} MB > baseline {base_rss:.1f} MB")
+    return problems
+
+
+# ---------------- main ----------------
+def wait_ready(base: str, proc, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not proc.is_alive():
+            raise RuntimeError("app process exited during startup")
+        try:
+            if requests.get(f"{base}/readyz", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"app not ready after {timeout:.0f}s")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--server", choices=("flask", "asgi"), default="flask")
+    ap.add_argument("--mix", default="default", help=f"preset ({', '.join(MIXES)}) or e.g. get=3,tts=1")
+    ap.add_argument("--concurrency", type=int, default=8, help="closed-loop clients")
+    ap.add_argument("--duration", type=float, default=30, help="measured seconds")
+    ap.add_argument("--warmup", type=float, default=5, help="unmeasured seconds first")
+    ap.add_argument("--think-ms", type=float, default=0, help="mean pause between a client's requests")
+    ap.add_argument("--repeat", type=float, default=0.3, help="share of questions from a small hot set")
+    ap.add_argument("--answer-cache", choices=("on", "off"), default="on")
+    ap.add_argument("--hybrid", action="store_true", help="dense + BM25 retrieval")
+    ap.add_argument("--corpus", type=int, default=2000, help="chunks in the synthetic index")
+    ap.add_argument("--llm-first-token-ms", type=float, default=400)
+    ap.add_argument("--llm-token-ms", type=float, default=15)
+    ap.add_argument("--llm-tokens", type=int, default=60)
+    ap.add_argument("--llm-error-rate", type=float, default=0.0, help="share of 429 responses")
+    ap.add_argument("--embed-ms", type=float, default=5, help="per query embedding")
+    ap.add_argument("--vector-ms", type=float, default=0, help="per vector search (e.g. 40 ~ Pinecone)")
+    ap.add_argument("--tts-ms", type=float, default=150, help="per 100 characters")
+    ap.add_argument("--twilio-ms", type=float, default=60)
+    ap.add_argument("--drain", type=float, default=30, help="max seconds to wait for pending WhatsApp replies")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--workdir", help="indexes, stores and app.log (default: a temp dir, removed afterwards)")
+    ap.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app env (repeatable)")
+    ap.add_argument("--json", help="write the report here")
+    ap.add_argument("--baseline", help="report JSON to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = ap.parse_args()
+
+    weights = parse_mix(args.mix)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_load_")
+    os.makedirs(workdir, exist_ok=True)
+    t = time.perf_counter()
+    indexes = build_indexes(workdir, args.corpus, args.seed)
+    print(f"indexes ready in {workdir} ({time.perf_counter() - t:.1f}s)")
+
+    ctx = multiprocessing.get_context("spawn")
+    up_ready, deliveries, up_stop = ctx.Queue(), ctx.Queue(), ctx.Event()
+    llm_cfg = {"first_token": args.llm_first_token_ms / 1000, "token_delay": args.llm_token_ms / 1000,
+               "tokens": args.llm_tokens, "error_rate": args.llm_error_rate}
+    upstreams = ctx.Process(target=run_upstreams, name="upstreams", daemon=True,
+                            args=(llm_cfg, {"latency": args.twilio_ms / 1000}, up_ready, deliveries, up_stop))
+    upstreams.start()
+    urls = up_ready.get(timeout=30)
+
+    run_id = time.strftime("%Y%m%d%H%M%S")
+    env = offline_env(workdir)
+    env.update({
+        "GITHUB_MODELS_URL": urls["llm"],
+        "LOCAL_INDEX_DIR": indexes["vector"],
+        "LEXICAL_INDEX_DIR": indexes["lexical"],
+        "HYBRID_SEARCH": "1" if args.hybrid else "0",
+        "ANSWER_CACHE_ENABLED": "1" if args.answer_cache == "on" else "0",
+        "CHAT_STORE_PATH": os.path.join(workdir, f"chats_{run_id}.db"),
+        "STATE_STORE_PATH": os.path.join(workdir, f"conversation_state_{run_id}.db"),
+        "TTS_CACHE_PATH": os.path.join(workdir, f"tts_cache_{run_id}.db"),
+    })
+    env.update(dict(kv.split("=", 1) for kv in args.env))
+    stubs = {"embed_delay": args.embed_ms / 1000, "vector_delay": args.vector_ms / 1000,
+             "tts_delay": args.tts_ms / 1000}
+    log_path = os.path.join(workdir, "app.log")
+    app_ready = ctx.Queue()
+    server = ctx.Process(target=run_app, name="app", daemon=True,
+                         args=(args.server, env, stubs, urls["twilio"], log_path, app_ready))
+    server.start()
+    rec, stop, clients_stop = Recorder(), threading.Event(), threading.Event()
+    try:
+        info = app_ready.get(timeout=120)
+        base = f"http://127.0.0.1:{info['port']}"
+        t = time.perf_counter()
+        wait_ready(base, server, 120)
+        print(f"{args.server} app ready at {base} (pid {info['pid']}, {time.perf_counter() - t:.1f}s; log {log_path})")
+
+        rss = RssSampler(info["pid"])
+        rss.start()
+        collector = threading.Thread(target=collect_deliveries, args=(deliveries, rec, stop), daemon=True)
+        collector.start()
+        workers = [Worker(i, base, weights, args.repeat, rec, clients_stop, args.think_ms / 1000, args.seed)
+                   for i in range(args.concurrency)]
+        for w in workers:
+            w.start()
+        time.sleep(args.warmup)
+        rec.measuring = True
+        t = time.perf_counter()
+        time.sleep(args.duration)
+        rec.measuring = False
+        elapsed = time.perf_counter() - t
+        stop_clients = time.time()
+        clients_stop.set()  # in-flight requests finish, nothing new starts
+        for w in workers:
+            w.join(timeout=60)
+        while rec.pending and time.time() - stop_clients < args.drain:
+            time.sleep(0.1)
+        stop.set()
+        collector.join(timeout=5)
+        with rec._lock:
+            rec.errors["whatsapp_e2e"] += len(rec.pending)  # never delivered
+            if not rec.errors["whatsapp_e2e"]:
+                del rec.errors["whatsapp_e2e"]
+        rss_report = rss.stop()
+
+        cache_stats = None
+        try:
+            cache_stats = requests.get(f"{base}/api/cache/stats", timeout=5).json().get("answer_cache")
+        except (requests.RequestException, ValueError):
+            pass
+    finally:
+        stop.set()
+        clients_stop.set()
+        server.terminate()
+        server.join(timeout=10)
+        up_stop.set()
+        upstreams.join(timeout=5)
+
+    scenarios = summarize(rec, elapsed)
+    requests_only = {k: v for k, v in scenarios.items() if k in SCENARIOS}
+    total_n = sum(s["count"] for s in requests_only.values())
+    total_err = sum(s["errors"] for s in requests_only.values())
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "baseline", "workdir")},
+        "elapsed_s": elapsed,
+        "scenarios": scenarios,
+        "total": {"count": total_n, "errors": total_err, "rps": total_n / elapsed if elapsed else 0.0},
+        "rss": rss_report,
+        "answer_cache": cache_stats,
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differs = [k for k in ("server", "mix", "concurrency", "repeat", "corpus") if
+                   baseline.get("config", {}).get(k) != report["config"][k]]
+        if differs:
+            print("note: baseline was run with different", ", ".join(differs))
+        problems = compare(report, baseline, args.tolerance)
+        for p in problems:
+            print("REGRESSION:", p)
+        if problems:
+            sys.exit(1)
+        print(f"no regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+OCR preprocessing benchmark: legacy path vs the adaptive pipeline.
+
+    python bench_ocr.py --images uploads/            # your own photos
+    python bench_ocr.py --synthetic 8                # generated 12 MP "phone photos"
+    python bench_ocr.py --synthetic 8 --no-ocr       # preprocessing only
+
+Each mode runs in a fresh process so peak RSS is measured per mode (the
+Tesseract column is the peak of the tesseract child processes).
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import tempfile
+import resource
+import multiprocessing
+
+from src.ocr_preprocess import DEFAULT_PSM, OCRPreprocessor, legacy_preprocess
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.bmp", "*.tif", "*.tiff")
+
+
+def make_synthetic(out_dir: str, n: int, size=(4000, 3000)):
+    """Text on a paper-like background, slightly rotated, inside a larger noisy frame."""
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    words = ("Paracetamol 500 mg tablet twice daily after food for five days. "
+             "Hemoglobin 13.2 g/dL WBC 7400 /uL Platelets 2.1 lakh. Review after one week.").split()
+    paths = []
+    w, h = size
+    for i in range(n):
+        img = np.full((h, w), 90, np.uint8) + rng.integers(0, 30, (h, w), dtype=np.uint8)
+        page = np.full((h * 2 // 3, w // 2), 235, np.uint8)
+        y = 120
+        while y < page.shape[0] - 80:
+            line = " ".join(rng.choice(words, 6))
+            cv2.putText(page, line, (60, y), cv2.FONT_HERSHEY_SIMPLEX, 1.6, 20, 3, cv2.LINE_AA)
+            y += 90
+        ph, pw = page.shape
+        y0, x0 = (h - ph) // 2, (w - pw) // 2
+        img[y0:y0 + ph, x0:x0 + pw] = page
+        m = cv2.getRotationMatrix2D((w / 2, h / 2), float(rng.uniform(-6, 6)), 1.0)
+        img = cv2.warpAffine(img, m, (w, h), borderValue=90)
+        p = os.path.join(out_dir, f"synthetic_{i}.jpg")
+        cv2.imwrite(p, img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        paths.append(p)
+    return paths
+
+
+def _run_mode(mode: str, paths, ocr: bool, conn):
+    timings, out_px = [], []
+    pre = OCRPreprocessor()
+    for p in paths:
+        t = time.perf_counter()
+        if mode == "legacy":
+            image, psm = legacy_preprocess(p), DEFAULT_PSM
+        else:
+            image, psm = pre.process(p)
+        if ocr:
+            import pytesseract
+            pytesseract.image_to_string(image, config=f"--oem 3 --psm {psm}")
+        timings.append((time.perf_counter() - t) * 1000)
+        out_px.append(image.shape[0] * image.shape[1])
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    conn.send((timings, out_px, self_kb, child_kb))
+    conn.close()
+
+
+def run_mode(mode: str, paths, ocr: bool):
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_mode, args=(mode, paths, ocr, child))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+def pct(values, q):
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark OCR preprocessing (ms/image, peak RSS).")
+    parser.add_argument("--images", help="directory with sample images")
+    parser.add_argument("--synthetic", type=int, default=0, help="generate N 12 MP sample photos")
+    parser.add_argument("--modes", default="legacy,adaptive")
+    parser.add_argument("--no-ocr", action="store_true", help="time preprocessing only (no tesseract)")
+    args = parser.parse_args()
+
+    paths = []
+    if args.images:
+        for pattern in IMAGE_PATTERNS:
+            paths += glob.glob(os.path.join(args.images, pattern))
+        paths.sort()
+    tmp = None
+    if args.synthetic:
+        tmp = tempfile.TemporaryDirectory(prefix="bench_ocr_")
+        paths += make_synthetic(tmp.name, args.synthetic)
+    if not paths:
+        parser.error("no images: pass --images DIR and/or --synthetic N")
+
+    ocr = not args.no_ocr
+    if ocr:
+        import shutil
+        if not shutil.which(os.getenv("TESSERACT_PATH") or "tesseract"):
+            print("tesseract not found; timing preprocessing only", file=sys.stderr)
+            ocr = False
+
+    print(f"{len(paths)} images, {'preprocess + tesseract' if ocr else 'preprocess only'}")
+    print(f"{'mode':<10} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'out MPix':>9} {'RSS MB':>8} {'tess MB':>8}")
+    for mode in args.modes.split(","):
+        timings, out_px, self_kb, child_kb = run_mode(mode.strip(), paths, ocr)
+        print(f"{mode:<10} {sum(timings) / len(timings):>9.1f} {pct(timings, 0.5):>9.1f} {pct(timings, 0.95):>9.1f} "
+              f"{sum(out_px) / len(out_px) / 1e6:>9.2f} {self_kb / 1024:>8.1f} "
+              f"{(child_kb / 1024) if ocr else 0:>8.1f}")
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
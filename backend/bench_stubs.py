@@ -0,0 +1,394 @@
+"""
+Local stand-ins for every remote dependency, used by bench_load.py.
+
+- GitHub Models chat endpoint: FakeModelsHandler, JSON or SSE streaming, with
+  first-token latency, per-token delay and an injectable 429 rate.
+- Twilio REST API: FakeTwilioHandler, accepts Messages.json posts and reports
+  every delivery (To number, time) so WhatsApp replies can be timed end to end.
+- Embeddings: HashEmbeddings, deterministic hashed bag-of-words vectors (no
+  model download), with optional per-call latency.
+- Vector store: a local index (src/vector_index.py) built over a synthetic
+  corpus, with optional per-query latency to stand in for a Pinecone round trip.
+- TTS: BenchTTSEngine (TTS_ENGINE=bench_stubs:BenchTTSEngine), silent MP3
+  after a per-character delay.
+
+The upstream servers run in their own process (run_upstreams); the app runs in
+another (run_app) with the stubs patched in before ``import app``. Nothing here
+opens a connection outside 127.0.0.1.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+from src.tts import SilentEngine
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ---------------- synthetic corpus and queries ----------------
+CONDITIONS = [
+    "typhoid", "diabetes", "dengue", "malaria", "cholera", "tuberculosis", "asthma", "hypertension",
+    "migraine", "anemia", "jaundice", "pneumonia", "influenza", "gastritis", "arthritis", "eczema",
+    "bronchitis", "sinusitis", "thyroid disorder", "kidney stones", "chickenpox", "measles", "covid",
+    "food poisoning", "urinary tract infection", "conjunctivitis", "psoriasis", "vertigo", "scabies",
+    "appendicitis",
+]
+ASPECTS = {
+    "symptoms": "Common symptoms of {c} include fever, fatigue, pain and loss of appetite; severity varies "
+                "between patients and usually peaks within the first week.",
+    "causes": "{c} is caused by infection, inflammation or metabolic changes; risk rises with poor hygiene, "
+              "age, smoking and existing chronic disease.",
+    "treatment": "Treatment of {c} combines rest, fluids and medicines prescribed by a doctor, such as "
+                 "paracetamol 500 mg for fever; antibiotics only when a bacterial cause is confirmed.",
+    "diagnosis": "{c} is diagnosed from the history, a physical examination and tests such as a blood count, "
+                 "urine analysis or imaging when complications are suspected.",
+    "prevention": "To prevent {c}: wash hands, drink safe water, keep vaccinations current and see a doctor "
+                  "early when warning signs appear.",
+    "complications": "Untreated {c} can lead to dehydration, organ damage or secondary infections; seek urgent "
+                     "care for confusion, breathlessness or persistent vomiting.",
+    "diet": "During {c}, eat light meals, fruit, soups and plenty of fluids; avoid alcohol, oily food and "
+            "skipping meals.",
+    "children": "In children, {c} needs weight-based dosing and close watch for dehydration; do not give "
+                "aspirin to children under 16.",
+}
+QUESTIONS = {
+    "symptoms": "What are the symptoms of {c}?",
+    "causes": "What causes {c}?",
+    "treatment": "How is {c} treated?",
+    "diagnosis": "How do doctors diagnose {c}?",
+    "prevention": "How can I prevent {c}?",
+    "complications": "What complications can {c} cause?",
+    "diet": "What should I eat during {c}?",
+    "children": "Is {c} dangerous for children?",
+}
+POPULATIONS = ["", " in adults", " in elderly patients", " during pregnancy", " in a diabetic patient",
+               " after surgery"]
+
+
+def make_corpus(size: int, seed: int = 0) -> List[Dict]:
+    """``size`` chunks of {"text", "metadata"} cycling through condition x aspect."""
+    rng = random.Random(seed)
+    pairs = [(c, a) for c in CONDITIONS for a in ASPECTS]
+    out = []
+    for i in range(size):
+        c, a = pairs[i % len(pairs)]
+        text = ASPECTS[a].format(c=c)
+        if i >= len(pairs):  # later passes: paraphrase-ish variants, as a chunked book would repeat topics
+            extra = rng.sample(sorted(ASPECTS), 2)
+            text += " See also: " + ", ".join(f"{x} of {c}" for x in extra) + f" (section {i})."
+        out.append({"text": text, "metadata": {"source": f"synthetic/{c.replace(' ', '_')}.pdf", "page": i}})
+    return out
+
+
+def hot_queries() -> List[str]:
+    """A small fixed set: repeated traffic that the answer cache should absorb."""
+    return [QUESTIONS[a].format(c=c) for c, a in [
+        ("diabetes", "symptoms"), ("dengue", "treatment"), ("malaria", "prevention"), ("typhoid", "diet"),
+        ("asthma", "causes"), ("hypertension", "complications"), ("covid", "symptoms"), ("anemia", "diet"),
+    ]]
+
+
+def fresh_query(rng: random.Random) -> str:
+    """condition x aspect x population: distinct enough to miss the semantic answer cache."""
+    a = rng.choice(sorted(QUESTIONS))
+    q = QUESTIONS[a].format(c=rng.choice(CONDITIONS))
+    return q[:-1] + rng.choice(POPULATIONS) + "?"
+
+
+# ---------------- embeddings ----------------
+class HashEmbeddings:
+    """
+    Signed feature hashing of lower-cased word unigrams and bigrams, L2 normalised.
+    Same text -> same vector in every process; similar texts -> high cosine.
+    """
+
+    def __init__(self, dim: int = 384, delay: float = 0.0):
+        self.dim = dim
+        self.delay = delay
+
+    def _vec(self, text: str) -> List[float]:
+        import numpy as np
+
+        words = [w for w in "".join(ch if ch.isalnum() else " " for ch in text.lower()).split() if w]
+        v = np.zeros(self.dim, dtype=np.float32)
+        for feat in words + [a + " " + b for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feat.encode("utf-8"))
+            v[h % self.dim] += 1.0 if (h >> 16) & 1 else -1.0
+        n = float(np.linalg.norm(v))
+        if n:
+            v /= n
+        else:
+            v[0] = 1.0
+        return v.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.delay:
+            time.sleep(self.delay * len(texts))
+        return [self._vec(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.delay:
+            time.sleep(self.delay)
+        return self._vec(text)
+
+
+def build_indexes(workdir: str, size: int, seed: int = 0) -> Dict[str, str]:
+    """Local vector + lexical index over make_corpus(size) in ``workdir`` (reused when already built)."""
+    from src.vector_index import Document, LocalVectorStore
+    from src.lexical_index import LexicalIndexWriter
+
+    vec_dir = os.path.join(workdir, f"vector_index_{size}")
+    lex_dir = os.path.join(workdir, f"lexical_index_{size}")
+    corpus = None
+    if not os.path.exists(os.path.join(vec_dir, "meta.json")):
+        corpus = make_corpus(size, seed)
+        docs = [Document(page_content=c["text"], metadata=c["metadata"]) for c in corpus]
+        LocalVectorStore.from_documents(docs, HashEmbeddings(), vec_dir)
+    if not os.path.exists(os.path.join(lex_dir, "meta.json")):
+        corpus = corpus or make_corpus(size, seed)
+        writer = LexicalIndexWriter(lex_dir)
+        writer.add([c["text"] for c in corpus], [c["metadata"] for c in corpus])
+        writer.finalize()
+    return {"vector": vec_dir, "lexical": lex_dir}
+
+
+# ---------------- TTS ----------------
+class BenchTTSEngine(SilentEngine):
+    """Silent audio after ``delay`` seconds per 100 characters."""
+
+    name = "bench"
+    delay = 0.15
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        time.sleep(self.delay * (len(text) / 100.0))
+        return super().synthesize(text, lang)
+
+
+def install_app_stubs(embed_delay: float = 0.0, vector_delay: float = 0.0, tts_delay: float = 0.15):
+    """Patch the in-process dependencies; call before ``import app``."""
+    sys.path.insert(0, BACKEND_DIR)
+    import src.helper as helper
+
+    helper.load_base_embeddings = lambda backend="torch": HashEmbeddings(delay=embed_delay)
+
+    if vector_delay:
+        from src.vector_index import LocalVectorIndex
+
+        search = LocalVectorIndex.search_vector
+
+        def slow_search(self, *args, **kwargs):
+            time.sleep(vector_delay)
+            return search(self, *args, **kwargs)
+
+        LocalVectorIndex.search_vector = slow_search
+
+    BenchTTSEngine.delay = tts_delay
+
+
+# ---------------- GitHub Models ----------------
+ANSWER_WORDS = ("Based on the medical context, the main points are rest, fluids and a prescribed medicine. "
+                "Monitor the symptoms closely, keep a record of temperature and consult a doctor if they "
+                "worsen or last more than three days. This is general information, not a diagnosis.").split()
+
+
+class FakeModelsHandler(BaseHTTPRequestHandler):
+    """
+    POST <any path>: chat completion. ``server.config`` keys: first_token (s),
+    token_delay (s), tokens (answer length in words), error_rate (429 share).
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_POST(self):
+        cfg = self.server.config
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            payload = {}
+        if cfg.get("error_rate") and random.random() < cfg["error_rate"]:
+            self._send(429, b'{"error": {"code": "RateLimitReached"}}', "application/json")
+            return
+        user = next((m.get("content", "") for m in reversed(payload.get("messages") or [])
+                     if m.get("role") == "user"), "")
+        n = max(1, int(cfg.get("tokens", 60)))
+        offset = zlib.crc32(user.encode("utf-8")) % len(ANSWER_WORDS)
+        words = [ANSWER_WORDS[(offset + i) % len(ANSWER_WORDS)] for i in range(n)]
+        time.sleep(cfg.get("first_token", 0.3))
+        if not payload.get("stream"):
+            time.sleep(cfg.get("token_delay", 0.0) * (n - 1))
+            out = {"choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}}]}
+            self._send(200, json.dumps(out).encode("utf-8"), "application/json")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i, w in enumerate(words):
+                if i:
+                    time.sleep(cfg.get("token_delay", 0.0))
+                delta = {"choices": [{"index": 0, "delta": {"content": (" " if i else "") + w}}]}
+                self._chunk(f"data: {json.dumps(delta)}\n\n".encode("utf-8"))
+            self._chunk(b"data: [DONE]\n\n")
+            self._chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # the app cancelled the stream
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send(self, status: int, data: bytes, ctype: str):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# ---------------- Twilio ----------------
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    """
+    POST /2010-04-01/Accounts/<sid>/Messages.json. ``server.config["latency"]``
+    delays the reply; ``server.on_delivery(to, body, t)`` is called first.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_POST(self):
+        t = time.time()
+        form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8"))
+        to = (form.get("To") or [""])[0]
+        body = (form.get("Body") or [""])[0]
+        if self.server.on_delivery:
+            self.server.on_delivery(to, body, t)
+        time.sleep(self.server.config.get("latency", 0.05))
+        sid = "SM%032x" % random.getrandbits(128)
+        out = json.dumps({
+            "sid": sid, "status": "queued", "to": to, "from": (form.get("From") or [""])[0], "body": body,
+            "num_segments": "1", "direction": "outbound-api", "uri": self.path.replace(".json", f"/{sid}.json"),
+        }).encode("utf-8")
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, handler, config: Optional[Dict] = None, on_delivery=None):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.config = config or {}
+        self.on_delivery = on_delivery
+        self.thread = threading.Thread(target=self.serve_forever, name=handler.__name__, daemon=True)
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)  # clients dropping keep-alive sockets is normal
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+def run_upstreams(llm_config: Dict, twilio_config: Dict, ready, deliveries, stop):
+    """Process target: fake Models + Twilio servers; deliveries go to the ``deliveries`` queue."""
+    llm = StubServer(FakeModelsHandler, llm_config)
+    twilio = StubServer(FakeTwilioHandler, twilio_config,
+                        on_delivery=lambda to, body, t: deliveries.put((to, t, len(body))))
+    ready.put({"llm": llm.url + "/inference/chat/completions", "twilio": twilio.url})
+    stop.wait()
+    llm.shutdown()
+    twilio.shutdown()
+
+
+# ---------------- the app under test ----------------
+def offline_env(workdir: str) -> Dict[str, str]:
+    """Environment that keeps everything on disk in ``workdir`` and every connection on localhost."""
+    blackhole = "http://127.0.0.1:9"  # discard port: any call that escapes the stubs fails fast
+    return {
+        "HTTP_PROXY": blackhole, "HTTPS_PROXY": blackhole, "http_proxy": blackhole, "https_proxy": blackhole,
+        "NO_PROXY": "127.0.0.1,localhost", "no_proxy": "127.0.0.1,localhost",
+        "HF_HUB_OFFLINE": "1", "TRANSFORMERS_OFFLINE": "1",
+        "HF_HOME": os.path.join(workdir, "hf_cache"),
+        "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+        "CHATS_FILE": os.path.join(workdir, "chats.json"),
+        "CHAT_STORE_PATH": os.path.join(workdir, "chats.db"),
+        "STATE_STORE_PATH": os.path.join(workdir, "conversation_state.db"),
+        "OCR_CACHE_PATH": os.path.join(workdir, "ocr_cache.db"),
+        "TTS_CACHE_PATH": os.path.join(workdir, "tts_cache.db"),
+        "TTS_ENGINE": "bench_stubs:BenchTTSEngine",
+        "TRANSLATE_BACKEND": "stub",
+        "PROFILE_DIR": os.path.join(workdir, "profiles"),
+        "EMBED_CACHE_PATH": "",
+        "VECTOR_BACKEND": "local",
+        "EMBED_PARITY_MIN": "0",
+        "RAG_INIT_MODE": "eager",
+        "GITHUB_TOKEN": "bench-token",
+        "TWILIO_SID": "AC" + "0" * 32,
+        "TWILIO_AUTH_TOKEN": "bench",
+    }
+
+
+def run_app(server: str, env: Dict[str, str], stubs: Dict, twilio_url: str, log_path: str, ready):
+    """
+    Process target: install the stubs, import the app and serve it on 127.0.0.1
+    (``server``: "flask" = werkzeug threaded, "asgi" = uvicorn asgi:app).
+    Puts {"port", "pid"} on ``ready`` once the socket listens.
+    """
+    os.environ.update(env)
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    sys.stdout.reconfigure(line_buffering=True)
+    os.chdir(BACKEND_DIR)
+    install_app_stubs(**stubs)
+
+    import app as core
+    from twilio.rest import Client as TwilioClient
+
+    core.initialize_rag_once()  # app.py skips its startup init in multiprocessing children
+
+    client = TwilioClient(core.TWILIO_SID, core.TWILIO_AUTH_TOKEN)
+    client.api.base_url = twilio_url
+    core._twilio_client = client
+    logging.getLogger("medical-chatbot").setLevel(logging.WARNING)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    if server == "asgi":
+        import uvicorn
+        import asgi
+
+        sock.listen(512)
+        config = uvicorn.Config(asgi.app, log_level="warning", access_log=False)
+        ready.put({"port": port, "pid": os.getpid()})
+        uvicorn.Server(config).run(sockets=[sock])
+    else:
+        from werkzeug.serving import make_server
+
+        sock.listen(512)
+        httpd = make_server("127.0.0.1", port, core.app, threaded=True, fd=sock.fileno())
+        ready.put({"port": port, "pid": os.getpid()})
+        httpd.serve_forever()
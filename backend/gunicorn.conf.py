@@ -0,0 +1,41 @@
+"""
+gunicorn settings (gunicorn -c gunicorn.conf.py app:app, from backend/).
+
+With GUNICORN_PRELOAD=1 (default) the app -- embedding model, vector index,
+reranker -- is imported once in the master and the workers fork from it, so
+the model pages are shared copy-on-write instead of loaded once per worker.
+Each forked worker then recreates its sockets and SQLite connections
+(app.reset_after_fork). GUNICORN_PRELOAD=0 gives every worker its own
+import; RAG_INIT_MODE (see app.py) then decides when the model loads.
+"""
+import gc
+import os
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+if preload_app:
+    os.environ["APP_PRELOAD"] = "1"  # app.py loads the models eagerly in the master
+# tokenizers (Rust) would otherwise warn and disable its thread pool in every forked worker
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+
+def when_ready(server):
+    if preload_app:
+        # move everything allocated so far out of the collector's generations: gc passes
+        # in the workers then don't touch (and un-share) the master's objects
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    wsgi = getattr(server.app, "callable", None)  # the Flask app, imported in the master
+    module = sys.modules.get(getattr(wsgi, "import_name", ""))
+    if module is not None and hasattr(module, "reset_after_fork"):
+        module.reset_after_fork()
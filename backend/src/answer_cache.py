@@ -0,0 +1,187 @@
+"""
+Semantic answer cache.
+
+Answers are keyed by the (normalised) query embedding. A lookup returns the
+cached answer of the most similar stored query when the cosine similarity is at
+least ``threshold``. Entries expire after ``ttl`` seconds and the least recently
+used entry is evicted once ``max_entries`` is reached. The whole cache is
+dropped when its ``version`` (vector index + system prompt fingerprint) changes.
+
+Embeddings barely move when only a dose or a patient group changes ("paracetamol
+dose for adults" / "... for children", "500 mg" / "650 mg"), so each entry also
+carries the question's qualifiers (numbers with their units, population words).
+An entry only answers a question with exactly the same qualifiers.
+"""
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+
+def fingerprint(*parts) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+
+_NUMBER_RE = re.compile(
+    r"(\d+(?:[.,]\d+)?)\s*(mg|mcg|µg|ug|g|kg|ml|l|iu|units?|%|tabs?|tablets?|drops?|puffs?|"
+    r"years?|yrs?|months?|weeks?|days?|hours?|hrs?|lbs?)?(?![a-z])")
+_UNITS = {"µg": "mcg", "ug": "mcg", "unit": "iu", "units": "iu", "tab": "tablet", "tabs": "tablet",
+          "tablets": "tablet", "drops": "drop", "puffs": "puff", "years": "year", "yrs": "year", "yr": "year",
+          "months": "month", "weeks": "week", "days": "day", "hours": "hour", "hrs": "hour", "hr": "hour",
+          "lb": "lbs"}
+_POPULATIONS = {
+    "child": ("child", "children", "kid", "kids", "infant", "infants", "baby", "babies", "toddler", "toddlers",
+              "newborn", "newborns", "neonate", "neonates", "pediatric", "paediatric", "boy", "girl"),
+    "adolescent": ("teen", "teens", "teenager", "teenagers", "adolescent", "adolescents"),
+    "adult": ("adult", "adults"),
+    "elderly": ("elderly", "senior", "seniors", "geriatric", "aged"),
+    "pregnancy": ("pregnant", "pregnancy", "trimester", "expecting"),
+    "breastfeeding": ("breastfeeding", "lactating", "lactation", "nursing"),
+}
+_POPULATION_WORDS = {w: group for group, words in _POPULATIONS.items() for w in words}
+_WORD_RE = re.compile(r"[a-z]+")
+
+
+def qualifiers(text: str) -> str:
+    """Canonical signature of the doses, numbers and patient groups in ``text`` ("" if none)."""
+    t = (text or "").lower()
+    found = set()
+    for num, unit in _NUMBER_RE.findall(t):
+        num = num.replace(",", ".")
+        if "." in num:
+            num = num.rstrip("0").rstrip(".")
+        found.add(num + (_UNITS.get(unit, unit) if unit else ""))
+    found.update(_POPULATION_WORDS[w] for w in _WORD_RE.findall(t) if w in _POPULATION_WORDS)
+    return "|".join(sorted(found))
+
+
+class CacheKey(NamedTuple):
+    vec: np.ndarray  # normalised query embedding
+    qualifiers: str
+
+
+class SemanticAnswerCache:
+    def __init__(self, threshold: float = 0.92, max_entries: int = 2048, ttl: float = 86400.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version: Optional[str] = None
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None  # (max_entries, dim), row = slot
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._lru: "OrderedDict[int, None]" = OrderedDict()  # slot -> None, oldest first
+        self._answers: Dict[int, str] = {}
+        self._quals: Dict[int, str] = {}
+        self._qual_hash = np.zeros(max_entries, dtype=np.int64)
+        self._created = np.zeros(max_entries, dtype=np.float64)
+        self._free = list(range(max_entries - 1, -1, -1))
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.expired = 0
+
+    # ---- maintenance ----
+    def set_version(self, version: str):
+        """Drop every entry if the index/prompt fingerprint changed."""
+        with self._lock:
+            if version != self.version:
+                self._clear_locked()
+                self.version = version
+
+    def clear(self):
+        with self._lock:
+            self._clear_locked()
+
+    def _clear_locked(self):
+        self._valid[:] = False
+        self._lru.clear()
+        self._answers.clear()
+        self._quals.clear()
+        self._free = list(range(self.max_entries - 1, -1, -1))
+
+    def _drop_locked(self, slot: int):
+        self._valid[slot] = False
+        self._lru.pop(slot, None)
+        self._answers.pop(slot, None)
+        self._quals.pop(slot, None)
+        self._free.append(slot)
+
+    @staticmethod
+    def _normalize(vec: Sequence[float]) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32).ravel()
+        n = np.linalg.norm(v)
+        return v / n if n else v
+
+    # ---- API ----
+    def key(self, vec: Sequence[float], text: str) -> CacheKey:
+        """What get/put take: the query embedding plus the qualifiers of the query text."""
+        return CacheKey(self._normalize(vec), qualifiers(text))
+
+    def get(self, key: CacheKey) -> Optional[str]:
+        q, quals = key
+        with self._lock:
+            if self._matrix is None or not self._lru or self._matrix.shape[1] != q.shape[0]:
+                self.misses += 1
+                return None
+            expired = np.flatnonzero(self._valid & (time.time() - self._created > self.ttl))
+            for slot in expired:
+                self._drop_locked(int(slot))
+            self.expired += len(expired)
+            scores = self._matrix @ q
+            scores[~self._valid | (self._qual_hash != hash(quals))] = -1.0
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold or self._quals.get(slot) != quals:
+                self.misses += 1
+                return None
+            self._lru.move_to_end(slot)
+            self.hits += 1
+            return self._answers[slot]
+
+    def put(self, key: CacheKey, answer: str):
+        q, quals = key
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != q.shape[0]:
+                self._matrix = np.zeros((self.max_entries, q.shape[0]), dtype=np.float32)
+                self._clear_locked()
+            if not self._free:
+                oldest, _ = self._lru.popitem(last=False)
+                self._drop_locked(oldest)
+                self.evictions += 1
+            slot = self._free.pop()
+            self._matrix[slot] = q
+            self._valid[slot] = True
+            self._answers[slot] = answer
+            self._quals[slot] = quals
+            self._qual_hash[slot] = hash(quals)
+            self._created[slot] = time.time()
+            self._lru[slot] = None
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._lru),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "version": self.version,
+            }
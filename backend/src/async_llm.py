@@ -0,0 +1,112 @@
+"""
+Async GitHub Models client for the ASGI app (asgi.py).
+
+A single shared ``httpx.AsyncClient`` keeps connections to
+models.github.ai alive across requests; a semaphore caps concurrent upstream
+calls so a burst of chats queues in-process instead of tripping rate limits.
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Optional
+
+import httpx
+
+logger = logging.getLogger("medical-chatbot")
+
+
+class AsyncGitHubModelsClient:
+    def __init__(self, token: str, url: Optional[str] = None, max_concurrency: int = 64,
+                 max_connections: int = 100, max_keepalive: int = 20, timeout: float = 30.0,
+                 parse_response: Optional[Callable] = None):
+        self.token = token
+        # JSON body -> answer text (app.extract_chat_content)
+        self.parse_response = parse_response or (lambda j: j["choices"][0]["message"]["content"])
+        self.url = url or os.getenv("GITHUB_MODELS_URL", "https://models.github.ai/inference/chat/completions")
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout,
+                                             headers={"User-Agent": "medical-chatbot-gh-model/1.0"})
+        return self._client
+
+    def _request(self, system_message: str, user_message: str, model: str, temperature: float,
+                 max_tokens: int, stream: bool):
+        if not self.token:
+            raise RuntimeError("GITHUB_TOKEN not set in environment.")
+        headers = {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream" if stream else "application/json",
+        }
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": float(temperature),
+            "max_tokens": int(max_tokens),
+        }
+        if stream:
+            payload["stream"] = True
+        return headers, payload
+
+    async def chat(self, system_message: str, user_message: str, model: str, temperature: float,
+                   max_tokens: int, timeout: Optional[float] = None) -> str:
+        headers, payload = self._request(system_message, user_message, model, temperature, max_tokens, False)
+        async with self.semaphore:
+            resp = await self.client.post(self.url, headers=headers, json=payload, timeout=timeout or self.timeout)
+        if resp.status_code == 429:
+            raise RuntimeError("429 rate limited by GitHub Models")
+        try:
+            j = resp.json()
+        except ValueError:
+            logger.warning("GitHub model response not JSON; returning raw text")
+            return resp.text
+        return self.parse_response(j)
+
+    async def chat_stream(self, system_message: str, user_message: str, model: str, temperature: float,
+                          max_tokens: int, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """
+        Yields content deltas. Cancelling the consuming task (client disconnect)
+        closes the upstream response, which stops generation.
+        """
+        headers, payload = self._request(system_message, user_message, model, temperature, max_tokens, True)
+        async with self.semaphore:
+            async with self.client.stream("POST", self.url, headers=headers, json=payload,
+                                          timeout=timeout or self.timeout) as resp:
+                if resp.status_code == 429:
+                    raise RuntimeError("429 rate limited by GitHub Models")
+                resp.raise_for_status()
+                if "text/event-stream" not in resp.headers.get("Content-Type", ""):
+                    # provider ignored "stream"
+                    body = await resp.aread()
+                    yield self.parse_response(json.loads(body))
+                    return
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        j = json.loads(data)
+                    except ValueError:
+                        continue
+                    for c in j.get("choices") or []:
+                        delta = c.get("delta") or {}
+                        piece = delta.get("content") if isinstance(delta, dict) else None
+                        if piece:
+                            yield piece
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,521 @@
+"""
+Pluggable chat history storage.
+
+The original implementation kept every chat in a single ``chats.json`` that was
+parsed and rewritten (pretty-printed) on every message under one global lock.
+The stores below make appending a message O(1) and let readers proceed while
+writers append:
+
+- ``sqlite``: one SQLite database in WAL mode (default).
+- ``log``:    one append-only JSONL file per chat plus a tiny metadata sidecar.
+- ``json``:   the legacy single-file format (kept for debugging / rollback).
+
+Existing ``chats.json`` data is migrated once into the sqlite/log stores.
+
+Chat dicts keep the shape the frontend already expects::
+
+    {"id", "title", "created_at", "messages": [{"id", "type", "text", "image_url", "time"}]}
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import datetime
+import threading
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process dev server, the migration lock is a no-op
+    fcntl = None
+
+logger = logging.getLogger("medical-chatbot")
+
+
+def _now() -> str:
+    return datetime.datetime.utcnow().isoformat()
+
+
+def make_title(text: str, limit: int = 35) -> str:
+    text = text or ""
+    return text[:limit] + "..." if len(text) > limit else text
+
+
+class ChatStore:
+    """Interface every backend implements. All methods are thread-safe."""
+
+    def list_chats(self) -> List[Dict]:
+        """Chat summaries (id, title, created_at), newest first."""
+        raise NotImplementedError
+
+    def create_chat(self, title: str = "New chat") -> Dict:
+        raise NotImplementedError
+
+    def get_chat(self, chat_id: str) -> Optional[Dict]:
+        """Full chat including messages, or None."""
+        raise NotImplementedError
+
+    def chat_exists(self, chat_id: str) -> bool:
+        return self.get_chat(chat_id) is not None
+
+    def delete_chat(self, chat_id: str) -> bool:
+        raise NotImplementedError
+
+    def append_message(self, chat_id: str, message: Dict, first_title: Optional[str] = None) -> bool:
+        """
+        Append one message. If ``first_title`` is given and this is the first
+        message of the chat, the chat title is set to it.
+        Returns False if the chat does not exist.
+        """
+        raise NotImplementedError
+
+    # ---- bulk helpers (legacy load_chats/save_chats + migration) ----
+    def load_all(self) -> List[Dict]:
+        return [c for c in (self.get_chat(s["id"]) for s in self.list_chats()) if c]
+
+    def import_chats(self, chats: List[Dict]):
+        """Insert chats (oldest last in the list, as chats.json stored them)."""
+        raise NotImplementedError
+
+    def replace_all(self, chats: List[Dict]):
+        for s in self.list_chats():
+            self.delete_chat(s["id"])
+        self.import_chats(chats)
+
+    def is_empty(self) -> bool:
+        return not self.list_chats()
+
+    def close(self):
+        pass
+
+
+# ---------------- SQLite (WAL) backend ----------------
+class SQLiteChatStore(ChatStore):
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chats (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                title TEXT NOT NULL,
+                created_at TEXT,
+                n_messages INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                body TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, seq);
+            """
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def list_chats(self):
+        rows = self._conn().execute("SELECT id, title, created_at FROM chats ORDER BY seq DESC").fetchall()
+        return [{"id": r[0], "title": r[1], "created_at": r[2]} for r in rows]
+
+    def create_chat(self, title="New chat"):
+        chat = {"id": str(uuid.uuid4()), "title": title, "created_at": _now(), "messages": []}
+        self._conn().execute(
+            "INSERT INTO chats (id, title, created_at) VALUES (?, ?, ?)",
+            (chat["id"], chat["title"], chat["created_at"]),
+        )
+        return chat
+
+    def get_chat(self, chat_id):
+        conn = self._conn()
+        row = conn.execute("SELECT id, title, created_at FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        msgs = conn.execute("SELECT body FROM messages WHERE chat_id = ? ORDER BY seq", (chat_id,)).fetchall()
+        return {"id": row[0], "title": row[1], "created_at": row[2], "messages": [json.loads(m[0]) for m in msgs]}
+
+    def chat_exists(self, chat_id):
+        return self._conn().execute("SELECT 1 FROM chats WHERE id = ?", (chat_id,)).fetchone() is not None
+
+    def delete_chat(self, chat_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cur.rowcount > 0
+
+    def append_message(self, chat_id, message, first_title=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute("UPDATE chats SET n_messages = n_messages + 1 WHERE id = ?", (chat_id,))
+            if cur.rowcount == 0:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute(
+                "INSERT INTO messages (chat_id, body) VALUES (?, ?)",
+                (chat_id, json.dumps(message, ensure_ascii=False)),
+            )
+            if first_title:
+                conn.execute("UPDATE chats SET title = ? WHERE id = ? AND n_messages = 1", (first_title, chat_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def import_chats(self, chats):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # chats.json is newest-first; insert oldest first so seq ordering matches
+            for c in reversed(chats):
+                chat_id = c.get("id") or str(uuid.uuid4())
+                msgs = c.get("messages") or []
+                conn.execute(
+                    "INSERT OR REPLACE INTO chats (id, title, created_at, n_messages) VALUES (?, ?, ?, ?)",
+                    (chat_id, c.get("title", "New chat"), c.get("created_at"), len(msgs)),
+                )
+                conn.executemany(
+                    "INSERT INTO messages (chat_id, body) VALUES (?, ?)",
+                    [(chat_id, json.dumps(m, ensure_ascii=False)) for m in msgs],
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# ---------------- Per-chat append-log backend ----------------
+class AppendLogChatStore(ChatStore):
+    """
+    Layout (one directory)::
+
+        <chat_id>.meta.json   {"id", "title", "created_at", "seq"}  (rewritten atomically, rare)
+        <chat_id>.log         one JSON message per line (append-only, O_APPEND)
+
+    Readers never take a lock: a torn final line from a concurrent append is skipped.
+    Writers lock one of ``LOCK_STRIPES`` locks picked by chat id, so memory stays
+    bounded however many chats come and go; unrelated chats rarely share a stripe.
+    """
+
+    LOCK_STRIPES = 64
+
+    def __init__(self, directory: str):
+        self.dir = directory
+        os.makedirs(self.dir, exist_ok=True)
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    def _lock(self, chat_id: str) -> threading.Lock:
+        return self._locks[hash(chat_id) % self.LOCK_STRIPES]
+
+    @staticmethod
+    def _valid_id(chat_id: str) -> bool:
+        return bool(chat_id) and "/" not in chat_id and "\\" not in chat_id and not chat_id.startswith(".")
+
+    def _safe_id(self, chat_id: str) -> str:
+        if not self._valid_id(chat_id):
+            raise ValueError(f"Invalid chat id: {chat_id!r}")
+        return chat_id
+
+    def _meta_path(self, chat_id):
+        return os.path.join(self.dir, self._safe_id(chat_id) + ".meta.json")
+
+    def _log_path(self, chat_id):
+        return os.path.join(self.dir, self._safe_id(chat_id) + ".log")
+
+    def _read_meta(self, chat_id) -> Optional[Dict]:
+        try:
+            with open(self._meta_path(chat_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, meta: Dict):
+        path = self._meta_path(meta["id"])
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _read_log(self, chat_id) -> List[Dict]:
+        out = []
+        try:
+            with open(self._log_path(chat_id), "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # partial append in progress
+                    try:
+                        out.append(json.loads(line))
+                    except ValueError:
+                        logger.warning("Skipping corrupt chat log line in %s", chat_id)
+        except FileNotFoundError:
+            pass
+        return out
+
+    def list_chats(self):
+        metas = []
+        for name in os.listdir(self.dir):
+            if name.endswith(".meta.json"):
+                meta = self._read_meta(name[: -len(".meta.json")])
+                if meta:
+                    metas.append(meta)
+        metas.sort(key=lambda m: m.get("seq", 0), reverse=True)
+        return [{"id": m["id"], "title": m.get("title", "New chat"), "created_at": m.get("created_at")} for m in metas]
+
+    def _next_seq(self) -> float:
+        # time-based ordering works across workers without a shared counter
+        return time.time()
+
+    def create_chat(self, title="New chat"):
+        chat = {"id": str(uuid.uuid4()), "title": title, "created_at": _now(), "messages": []}
+        self._write_meta({"id": chat["id"], "title": title, "created_at": chat["created_at"], "seq": self._next_seq()})
+        return chat
+
+    # an id that cannot name a file is a chat that does not exist (404, not 500)
+    def get_chat(self, chat_id):
+        if not self._valid_id(chat_id):
+            return None
+        meta = self._read_meta(chat_id)
+        if meta is None:
+            return None
+        return {
+            "id": meta["id"],
+            "title": meta.get("title", "New chat"),
+            "created_at": meta.get("created_at"),
+            "messages": self._read_log(chat_id),
+        }
+
+    def chat_exists(self, chat_id):
+        return self._valid_id(chat_id) and os.path.exists(self._meta_path(chat_id))
+
+    def delete_chat(self, chat_id):
+        if not self._valid_id(chat_id):
+            return False
+        with self._lock(chat_id):
+            existed = False
+            for p in (self._meta_path(chat_id), self._log_path(chat_id)):
+                try:
+                    os.remove(p)
+                    existed = True
+                except FileNotFoundError:
+                    pass
+        return existed
+
+    def append_message(self, chat_id, message, first_title=None):
+        line = (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock(chat_id):
+            if not self.chat_exists(chat_id):
+                return False
+            log_path = self._log_path(chat_id)
+            first = not os.path.exists(log_path) or os.path.getsize(log_path) == 0
+            fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            if first and first_title:
+                meta = self._read_meta(chat_id)
+                if meta is not None:
+                    meta["title"] = first_title
+                    self._write_meta(meta)
+        return True
+
+    def import_chats(self, chats):
+        base = self._next_seq()
+        for i, c in enumerate(chats):
+            chat_id = c.get("id") or str(uuid.uuid4())
+            with self._lock(chat_id):
+                # log before meta: the chat only exists once it is complete, so a resumed import redoes it
+                with open(self._log_path(chat_id), "w", encoding="utf-8") as f:
+                    for m in c.get("messages") or []:
+                        f.write(json.dumps(m, ensure_ascii=False) + "\n")
+                self._write_meta({
+                    "id": chat_id,
+                    "title": c.get("title", "New chat"),
+                    "created_at": c.get("created_at"),
+                    "seq": base - i * 1e-6,  # keep newest-first order of chats.json
+                })
+
+
+# ---------------- Legacy single-file JSON backend ----------------
+class JsonFileChatStore(ChatStore):
+    """The original chats.json behaviour: whole-file read/rewrite under one lock."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            logger.exception("Corrupt %s; resetting", self.path)
+            return []
+
+    def _save(self, data):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    def _find(self, chats, chat_id):
+        for c in chats:
+            if c.get("id") == chat_id:
+                return c
+        return None
+
+    def list_chats(self):
+        with self._lock:
+            return [{"id": c["id"], "title": c.get("title", "New chat"), "created_at": c.get("created_at")}
+                    for c in self._load()]
+
+    def load_all(self):
+        with self._lock:
+            return self._load()
+
+    def create_chat(self, title="New chat"):
+        chat = {"id": str(uuid.uuid4()), "title": title, "created_at": _now(), "messages": []}
+        with self._lock:
+            chats = self._load()
+            chats.insert(0, chat)
+            self._save(chats)
+        return chat
+
+    def get_chat(self, chat_id):
+        with self._lock:
+            return self._find(self._load(), chat_id)
+
+    def delete_chat(self, chat_id):
+        with self._lock:
+            chats = self._load()
+            kept = [c for c in chats if c.get("id") != chat_id]
+            self._save(kept)
+            return len(kept) != len(chats)
+
+    def append_message(self, chat_id, message, first_title=None):
+        with self._lock:
+            chats = self._load()
+            chat = self._find(chats, chat_id)
+            if chat is None:
+                return False
+            chat.setdefault("messages", []).append(message)
+            if first_title and len(chat["messages"]) == 1:
+                chat["title"] = first_title
+            self._save(chats)
+        return True
+
+    def import_chats(self, chats):
+        with self._lock:
+            self._save(list(chats) + self._load())
+
+    def replace_all(self, chats):
+        with self._lock:
+            self._save(chats)
+
+
+# ---------------- factory + one-time migration ----------------
+class _MigrationLock:
+    """Exclusive lock on ``<chats.json>.lock`` so one process at a time migrates (or resumes)."""
+
+    def __init__(self, legacy_path: str):
+        self.path = legacy_path + ".lock"
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            os.close(self.fd)  # releases the lock
+
+
+def migrate_legacy_json(store: ChatStore, legacy_path: str) -> int:
+    """
+    Import ``legacy_path`` (chats.json) into ``store`` once and return the
+    number of chats imported. The file is renamed to ``<name>.migrated``
+    afterwards so the import never runs twice, or to ``<name>.skipped`` if the
+    store already had chats.
+
+    The file is claimed as ``<name>.migrating`` while importing. If a process
+    died mid-import, the next startup finds that file and resumes: chats that
+    already made it into the store are left alone, the rest are imported.
+    """
+    claimed = legacy_path + ".migrating"
+    if isinstance(store, JsonFileChatStore) or not (os.path.exists(legacy_path) or os.path.exists(claimed)):
+        return 0
+    with _MigrationLock(legacy_path):
+        resume = os.path.exists(claimed)
+        if not resume:
+            try:
+                os.replace(legacy_path, claimed)
+            except FileNotFoundError:
+                return 0  # another worker finished while we waited for the lock
+        try:
+            with open(claimed, "r", encoding="utf-8") as f:
+                chats = json.load(f)
+        except Exception:
+            logger.exception("Could not read legacy chats file %s; skipping migration", claimed)
+            os.replace(claimed, legacy_path + ".corrupt")
+            return 0
+        if not isinstance(chats, list):
+            chats = []
+        if resume:
+            logger.warning("Resuming interrupted migration of %d chats from %s", len(chats), claimed)
+            chats = [c for c in chats if not (c.get("id") and store.chat_exists(c["id"]))]
+        elif chats and not store.is_empty():
+            os.replace(claimed, legacy_path + ".skipped")
+            logger.warning("Chat store already has chats; skipped importing %d legacy chats (kept in %s.skipped)",
+                           len(chats), legacy_path)
+            return 0
+        if chats:
+            store.import_chats(chats)
+        os.replace(claimed, legacy_path + ".migrated")
+        logger.info("Migrated %d chats from %s", len(chats), legacy_path)
+        return len(chats)
+
+
+def create_chat_store(backend: str, chats_file: str, path: Optional[str] = None) -> ChatStore:
+    """
+    backend: "sqlite" | "log" | "json"
+    chats_file: legacy chats.json location (also the default base for store paths)
+    """
+    backend = (backend or "sqlite").lower()
+    base, _ = os.path.splitext(os.path.abspath(chats_file))
+    if backend == "json":
+        return JsonFileChatStore(chats_file)
+    if backend == "sqlite":
+        store = SQLiteChatStore(path or base + ".db")
+    elif backend in ("log", "append-log", "appendlog"):
+        store = AppendLogChatStore(path or base + ".d")
+    else:
+        raise ValueError(f"Unknown CHAT_STORE backend: {backend}")
+    migrate_legacy_json(store, chats_file)
+    return store
@@ -0,0 +1,212 @@
+"""
+Token-budgeted context packing for the RAG prompt.
+
+The old context builder cut every retrieved chunk at 800 characters and
+joined them. Chunks from ``text_split`` overlap (``chunk_overlap``), the same
+passage often appears in several PDFs, and character cuts end mid-sentence.
+``ContextPacker``:
+
+1. drops sentences already packed from an earlier chunk and strips the
+   prefix of a chunk that repeats the tail of an earlier one;
+2. orders chunks by maximal marginal relevance (retriever rank vs. word
+   overlap with the chunks already chosen), skipping near-duplicates;
+3. fills ``budget`` tokens with whole sentences (src/sentences.py: decimals and
+   abbreviations do not end one), measured with the chat model's tokenizer
+   (tiktoken) or, if that is unavailable, an estimate. Kept sentences keep the
+   whitespace that followed them in the chunk, so line breaks survive.
+"""
+import re
+import math
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from src.sentences import sentence_spans
+
+logger = logging.getLogger("medical-chatbot")
+
+SEPARATOR = "\n\n---\n\n"
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_ESTIMATE_RE = re.compile(r"[A-Za-z]+|[0-9]{1,3}|[^\sA-Za-z0-9]")
+
+
+def estimate_tokens(text: str) -> int:
+    """BPE-like estimate: ~1 token per 5 letters of a word, per 3 digits, per symbol."""
+    n = 0
+    for tok in _ESTIMATE_RE.findall(text):
+        n += math.ceil(len(tok) / 5) if tok[0].isalpha() else 1
+    return n
+
+
+def make_token_counter(model: str = "gpt-4o-mini") -> Callable[[str], int]:
+    """Exact counts with tiktoken when it is installed (and its encoding is cached/downloadable)."""
+    try:
+        import tiktoken
+
+        try:
+            enc = tiktoken.encoding_for_model(model)
+        except KeyError:
+            enc = tiktoken.get_encoding("o200k_base")
+        enc.encode("warm up")
+        return lambda text: len(enc.encode(text, disallowed_special=()))
+    except Exception as e:
+        logger.info("tiktoken unavailable (%s); context budget uses a token estimate", e)
+        return estimate_tokens
+
+
+def _norm(sentence: str) -> str:
+    return " ".join(_WORD_RE.findall(sentence.lower()))
+
+
+def _words(text: str) -> Set[str]:
+    return set(_WORD_RE.findall(text.lower()))
+
+
+def _overlap_prefix(previous: Sequence[str], text: str, min_chars: int = 12, max_chars: int = 200) -> int:
+    """Length of the longest prefix of ``text`` that is the tail of a previous chunk."""
+    best = 0
+    for prev in previous:
+        tail = prev[-max_chars:]
+        for n in range(min(len(tail), len(text)), max(best, min_chars - 1), -1):
+            if tail.endswith(text[:n]):
+                best = n
+                break
+    return best
+
+
+class ContextPacker:
+    def __init__(self, budget: int = 512, mmr_lambda: float = 0.7, duplicate_threshold: float = 0.85,
+                 max_chunk_tokens: Optional[int] = None, count_tokens: Optional[Callable[[str], int]] = None):
+        self.budget = budget
+        self.mmr_lambda = mmr_lambda
+        self.duplicate_threshold = duplicate_threshold
+        self.max_chunk_tokens = max_chunk_tokens
+        self.count_tokens = count_tokens or estimate_tokens
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.duplicate_chunks = 0
+        self.duplicate_sentences = 0
+        self.truncated_chunks = 0
+
+    def _mmr_order(self, texts: List[str]) -> Tuple[List[int], int]:
+        """(indices in MMR order, near-duplicates dropped)."""
+        n = len(texts)
+        words = [_words(t) for t in texts]
+        relevance = [1.0 - i / n for i in range(n)]  # retriever (or reranker) order
+
+        def sim(a: int, b: int) -> float:
+            if not words[a] or not words[b]:
+                return 0.0
+            return len(words[a] & words[b]) / min(len(words[a]), len(words[b]))
+
+        chosen: List[int] = []
+        dropped = 0
+        left = list(range(n))
+        while left:
+            best, best_score, best_sim = None, None, 0.0
+            for i in left:
+                s = max((sim(i, j) for j in chosen), default=0.0)
+                score = self.mmr_lambda * relevance[i] - (1 - self.mmr_lambda) * s
+                if best_score is None or score > best_score:
+                    best, best_score, best_sim = i, score, s
+            left.remove(best)
+            if best_sim >= self.duplicate_threshold:
+                dropped += 1
+                continue
+            chosen.append(best)
+        return chosen, dropped
+
+    def pack(self, texts: Sequence[str]) -> List[str]:
+        """Packed passages (best first); join them with ``SEPARATOR``."""
+        texts = [t.strip() for t in texts if t and t.strip()]
+        if not texts:
+            return []
+        count = self.count_tokens
+        order, duplicate_chunks = self._mmr_order(texts) if len(texts) > 1 else ([0], 0)
+        duplicate_sentences = truncated_chunks = 0
+
+        packed: List[str] = []
+        sources: List[str] = []  # original text of every packed chunk
+        seen: Set[str] = set()
+        used = 0
+        sep_cost = count(SEPARATOR)
+        for i in order:
+            text = texts[i]
+            text = text[_overlap_prefix(sources, text):] if sources else text
+            spans = sentence_spans(text)
+            sentences = []  # (sentence, whitespace that followed it in the chunk)
+            chunk_tokens = 0
+            limit = self.budget - used - (sep_cost if packed else 0)
+            if self.max_chunk_tokens:
+                limit = min(limit, self.max_chunk_tokens)
+            truncated = False
+            for k, (start, end) in enumerate(spans):
+                sentence = text[start:end]
+                key = _norm(sentence)
+                if key and key in seen:
+                    duplicate_sentences += 1
+                    continue
+                t = count(sentence) + 1  # + following whitespace
+                if chunk_tokens + t > limit:
+                    truncated = True
+                    break
+                sentences.append((sentence, text[end:spans[k + 1][0]] if k + 1 < len(spans) else ""))
+                chunk_tokens += t
+                if key:
+                    seen.add(key)
+            if truncated:
+                truncated_chunks += 1
+                if not packed and not sentences:
+                    # a first sentence longer than the whole budget: keep its leading words
+                    words = text[spans[0][0]:spans[0][1]].split()
+                    while words and count(" ".join(words) + " ...") + 1 > limit:
+                        words = words[:-max(1, len(words) // 8)]
+                    if words:
+                        sentences.append((" ".join(words) + " ...", ""))
+                        chunk_tokens = count(sentences[0][0]) + 1
+            if sentences:
+                packed.append("".join(s + gap for s, gap in sentences[:-1]) + sentences[-1][0])
+                sources.append(texts[i])
+                used += chunk_tokens + (sep_cost if len(packed) > 1 else 0)
+            if self.budget - used < 8:
+                break
+
+        tokens_in = sum(count(t) for t in texts)
+        with self._lock:
+            self.calls += 1
+            self.tokens_in += tokens_in
+            self.tokens_out += used
+            self.duplicate_chunks += duplicate_chunks
+            self.duplicate_sentences += duplicate_sentences
+            self.truncated_chunks += truncated_chunks
+        return packed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "calls": self.calls,
+                "tokens_in": self.tokens_in,
+                "tokens_out": self.tokens_out,
+                "saved_ratio": (1 - self.tokens_out / self.tokens_in) if self.tokens_in else 0.0,
+                "duplicate_chunks": self.duplicate_chunks,
+                "duplicate_sentences": self.duplicate_sentences,
+                "truncated_chunks": self.truncated_chunks,
+            }
+
+
+if __name__ == "__main__":
+    # self-check: python -m src.context_packer
+    chunks = [
+        "Adults: paracetamol 0.5-1 g every 4.5 to 6 hours.\nDo not exceed 4 g in 24 hours. Dr. Rao advises rest.",
+        "Do not exceed 4 g in 24 hours. Children: 12.5 mg/kg per dose.",
+    ]
+    packed = ContextPacker(budget=200).pack(chunks)
+    assert packed[0] == chunks[0], packed
+    assert packed[1] == "Children: 12.5 mg/kg per dose.", packed
+    tight = ContextPacker(budget=24).pack(chunks)
+    assert tight == ["Adults: paracetamol 0.5-1 g every 4.5 to 6 hours."], tight
+    print("context packer self-check passed")
@@ -0,0 +1,300 @@
+"""
+Per-sender conversation state (WhatsApp / SMS senders).
+
+Replaces the module-level ``conversation_topic`` / ``last_user_query`` dicts
+and the ``connected_users`` set, which were mutated by the webhook threads
+without a lock, grew for every number that ever wrote to us and were private
+to one gunicorn worker (a follow-up landing on another worker lost its topic).
+
+Each sender has one small record ``{"topic", "last_answer", "welcomed", ...}``.
+Records expire ``ttl`` seconds after their last update and the least recently
+used ones are evicted above ``max_senders`` / ``max_bytes``.
+
+- ``sqlite`` (default): one SQLite database in WAL mode shared by every worker
+  on the host;
+- ``memory``: an in-process LRU (single worker, tests).
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger("medical-chatbot")
+
+
+def _record_size(record: Dict) -> int:
+    return len(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+
+
+class ConversationStateStore:
+    """Interface every backend implements. All methods are thread-safe."""
+
+    def get(self, sender_id: str, field: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def update(self, sender_id: str, **fields):
+        """Set fields of the sender's record (refreshes its TTL)."""
+        raise NotImplementedError
+
+    def claim(self, sender_id: str, field: str) -> bool:
+        """Atomically set a flag; True only for the caller that set it first."""
+        raise NotImplementedError
+
+    def forget(self, sender_id: str):
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# ---------------- in-process backend ----------------
+class MemoryStateStore(ConversationStateStore):
+    def __init__(self, max_senders: int = 10000, max_bytes: int = 16 << 20, ttl: float = 6 * 3600):
+        self.max_senders = max_senders
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[str, Tuple[float, Dict, int]]" = OrderedDict()  # sender -> (updated, record, size)
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _live(self, sender_id: str, now: float) -> Optional[Dict]:
+        item = self._data.get(sender_id)
+        if item is None:
+            return None
+        updated, record, size = item
+        if self.ttl and now - updated > self.ttl:
+            del self._data[sender_id]
+            self._bytes -= size
+            self.expirations += 1
+            return None
+        self._data.move_to_end(sender_id)
+        return record
+
+    def _put(self, sender_id: str, record: Dict, now: float):
+        old = self._data.pop(sender_id, None)
+        if old is not None:
+            self._bytes -= old[2]
+        size = _record_size(record)
+        self._data[sender_id] = (now, record, size)
+        self._bytes += size
+        while self._data and (len(self._data) > self.max_senders or self._bytes > self.max_bytes):
+            _, (_, _, dropped) = self._data.popitem(last=False)
+            self._bytes -= dropped
+            self.evictions += 1
+
+    def get(self, sender_id, field, default=None):
+        with self._lock:
+            record = self._live(sender_id, time.time())
+            return default if record is None else record.get(field, default)
+
+    def update(self, sender_id, **fields):
+        now = time.time()
+        with self._lock:
+            record = dict(self._live(sender_id, now) or {})
+            record.update(fields)
+            self._put(sender_id, record, now)
+
+    def claim(self, sender_id, field):
+        now = time.time()
+        with self._lock:
+            record = dict(self._live(sender_id, now) or {})
+            if record.get(field):
+                return False
+            record[field] = True
+            self._put(sender_id, record, now)
+            return True
+
+    def forget(self, sender_id):
+        with self._lock:
+            item = self._data.pop(sender_id, None)
+            if item is not None:
+                self._bytes -= item[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "senders": len(self._data),
+                "bytes": self._bytes,
+                "max_senders": self.max_senders,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# ---------------- SQLite (WAL) backend ----------------
+class SQLiteStateStore(ConversationStateStore):
+    """
+    One row per sender (record as JSON). Updates are read-modify-write inside
+    ``BEGIN IMMEDIATE`` so concurrent workers never lose each other's fields.
+    Expired and surplus rows are swept every ``sweep_every`` writes.
+    """
+
+    def __init__(self, path: str, max_senders: int = 10000, max_bytes: int = 16 << 20, ttl: float = 6 * 3600,
+                 sweep_every: int = 200):
+        self.path = path
+        self.max_senders = max_senders
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_every = max(1, sweep_every)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.evictions = 0
+        self.expirations = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)) or ".", exist_ok=True)
+        self._conn().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                sender TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_conversation_state_updated ON conversation_state(updated);
+            """
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _cutoff(self, now: float) -> float:
+        return now - self.ttl if self.ttl else float("-inf")
+
+    def _load(self, conn: sqlite3.Connection, sender_id: str, now: float) -> Dict:
+        row = conn.execute("SELECT data FROM conversation_state WHERE sender = ? AND updated >= ?",
+                           (sender_id, self._cutoff(now))).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _write(self, sender_id: str, mutate) -> Any:
+        """Run ``mutate(record) -> (changed, result)`` atomically on the sender's record."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            record = self._load(conn, sender_id, now)
+            changed, result = mutate(record)
+            if changed:
+                data = json.dumps(record, ensure_ascii=False)
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversation_state (sender, data, size, updated) VALUES (?, ?, ?, ?)",
+                    (sender_id, data, len(data.encode("utf-8")), now),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if changed:
+            with self._lock:
+                self._writes += 1
+                sweep = self._writes % self.sweep_every == 0
+            if sweep:
+                self.sweep()
+        return result
+
+    def get(self, sender_id, field, default=None):
+        try:
+            return self._load(self._conn(), sender_id, time.time()).get(field, default)
+        except sqlite3.Error as e:
+            logger.warning("Conversation state read failed: %s", e)
+            return default
+
+    def update(self, sender_id, **fields):
+        def mutate(record):
+            record.update(fields)
+            return True, None
+
+        try:
+            self._write(sender_id, mutate)
+        except sqlite3.Error as e:
+            logger.warning("Conversation state write failed: %s", e)
+
+    def claim(self, sender_id, field):
+        def mutate(record):
+            if record.get(field):
+                return False, False
+            record[field] = True
+            return True, True
+
+        try:
+            return self._write(sender_id, mutate)
+        except sqlite3.Error as e:
+            logger.warning("Conversation state write failed: %s", e)
+            return False
+
+    def forget(self, sender_id):
+        self._conn().execute("DELETE FROM conversation_state WHERE sender = ?", (sender_id,))
+
+    def sweep(self):
+        """Drop expired rows, then least recently updated rows above the caps."""
+        conn = self._conn()
+        try:
+            expired = conn.execute("DELETE FROM conversation_state WHERE updated < ?",
+                                   (self._cutoff(time.time()),)).rowcount
+            count, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM conversation_state").fetchone()
+            victims = []
+            if count > self.max_senders or total > self.max_bytes:
+                # evict to 90% so the next few writes don't sweep again
+                target_n, target_b = int(self.max_senders * 0.9), int(self.max_bytes * 0.9)
+                for sender, size in conn.execute("SELECT sender, size FROM conversation_state ORDER BY updated"):
+                    if count <= target_n and total <= target_b:
+                        break
+                    victims.append((sender,))
+                    count -= 1
+                    total -= size
+                conn.executemany("DELETE FROM conversation_state WHERE sender = ?", victims)
+            with self._lock:
+                self.expirations += max(0, expired)
+                self.evictions += len(victims)
+        except sqlite3.Error as e:
+            logger.warning("Conversation state sweep failed: %s", e)
+
+    def stats(self):
+        count, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM conversation_state WHERE updated >= ?",
+            (self._cutoff(time.time()),)).fetchone()
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "senders": count,
+                "bytes": total,
+                "max_senders": self.max_senders,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "evictions": self.evictions,      # counted by this worker's sweeps
+                "expirations": self.expirations,
+            }
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_state_store(backend: str, path: str, **limits) -> ConversationStateStore:
+    """backend: "sqlite" | "memory"; limits: max_senders, max_bytes, ttl."""
+    backend = (backend or "sqlite").lower()
+    if backend == "memory":
+        return MemoryStateStore(**limits)
+    if backend == "sqlite":
+        return SQLiteStateStore(path, **limits)
+    raise ValueError(f"Unknown STATE_STORE backend: {backend}")
@@ -0,0 +1,259 @@
+"""
+Query-embedding cache.
+
+``CachedEmbeddings`` wraps the HuggingFace embeddings object:
+
+- in-memory LRU keyed by normalised query text (lowercased, whitespace collapsed;
+  all-MiniLM-L6-v2 is an uncased model so this does not change the vector);
+- optional ``DiskEmbeddingStore``: a fixed-size memory-mapped hash table shared by
+  every gunicorn worker on the host and surviving restarts. Its header records
+  which model produced the vectors (``model_id``: backend, model, weights file);
+  opening it with another model starts an empty store instead of serving stale
+  vectors.
+
+Only ``embed_query`` is cached; ``embed_documents`` (ingestion) passes through.
+"""
+import os
+import mmap
+import struct
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+try:
+    from langchain_core.embeddings import Embeddings as _EmbeddingsBase
+except Exception:
+    _EmbeddingsBase = object
+
+logger = logging.getLogger("medical-chatbot")
+
+
+def normalize_query(text: str) -> str:
+    return " ".join((text or "").lower().split())
+
+
+def _key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class DiskEmbeddingStore:
+    """
+    Open-addressing table in one file::
+
+        header: magic(8) dim(u32) slots(u32) model(16, hash of model_id)
+        slot:   key(16) vector(dim*float32) key(16)
+
+    Writers take an fcntl lock; readers are lock-free and accept a slot only if
+    both key copies match (a torn concurrent write reads as a miss).
+    Full probe sequences overwrite their first slot (cache semantics).
+    """
+
+    MAGIC = b"MBEMB002"
+    HEADER = struct.Struct("<8sII16s")
+    PROBES = 8
+
+    def __init__(self, path: str, dim: int, slots: int = 32768, model_id: str = ""):
+        self.path = path
+        self.dim = dim
+        self.slots = slots
+        self.model_id = model_id
+        self.vec_bytes = dim * 4
+        self.slot_size = 16 + self.vec_bytes + 16
+        self.size = self.HEADER.size + slots * self.slot_size
+        os.makedirs(os.path.dirname(os.path.abspath(path)) or ".", exist_ok=True)
+        self._thread_lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._pid = None
+        self._open()
+
+    def _open(self):
+        expected = self.HEADER.pack(self.MAGIC, self.dim, self.slots, _key(self.model_id))
+        while True:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with self._file_lock():
+                if os.pread(self._fd, self.HEADER.size, 0) == expected:
+                    break
+                # new file or incompatible layout (different model / size): start empty. Other
+                # workers may still have the old file mapped, and truncating it under them would
+                # SIGBUS them, so a fresh file replaces it; they keep the old inode until restart.
+                if os.fstat(self._fd).st_ino == os.stat(self.path).st_ino:  # not replaced meanwhile
+                    tmp = f"{self.path}.{os.getpid()}.tmp"
+                    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+                    try:
+                        os.ftruncate(fd, self.size)
+                        os.pwrite(fd, expected, 0)
+                    finally:
+                        os.close(fd)
+                    os.replace(tmp, self.path)
+            os.close(self._fd)  # open the replacement and check it under its own lock
+        self._mm = mmap.mmap(self._fd, self.size, access=mmap.ACCESS_WRITE)
+        self._pid = os.getpid()
+
+    def _ensure_own_fd(self):
+        """
+        flock() locks belong to the open file description, which a forked child
+        shares with its parent (e.g. workers forked from a preloaded gunicorn
+        master), so the lock would exclude nothing between them. Each process
+        reopens the file the first time it touches the store.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid != os.getpid():
+                inherited_fd, inherited_mm = self._fd, self._mm
+                self._open()
+                inherited_mm.close()  # only unmaps this process's copy
+                os.close(inherited_fd)
+
+    def _file_lock(self):
+        import fcntl
+
+        fd = self._fd
+
+        class _Lock:
+            def __enter__(self_inner):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+            def __exit__(self_inner, *exc):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+        return _Lock()
+
+    def _offset(self, slot: int) -> int:
+        return self.HEADER.size + slot * self.slot_size
+
+    def _probe(self, key: bytes):
+        start = int.from_bytes(key[:8], "little") % self.slots
+        for i in range(self.PROBES):
+            yield (start + i) % self.slots
+
+    def get(self, key: bytes) -> Optional[List[float]]:
+        self._ensure_own_fd()
+        mm = self._mm
+        for slot in self._probe(key):
+            off = self._offset(slot)
+            head = mm[off:off + 16]
+            if head == key:
+                vec = mm[off + 16:off + 16 + self.vec_bytes]
+                tail = mm[off + 16 + self.vec_bytes:off + self.slot_size]
+                if tail == key and mm[off:off + 16] == key:
+                    return np.frombuffer(vec, dtype=np.float32).tolist()
+                return None
+            if head == b"\0" * 16:
+                return None
+        return None
+
+    def put(self, key: bytes, vec: List[float]):
+        data = np.asarray(vec, dtype=np.float32).tobytes()
+        if len(data) != self.vec_bytes:
+            return
+        self._ensure_own_fd()
+        mm = self._mm
+        with self._thread_lock, self._file_lock():
+            target = None
+            for slot in self._probe(key):
+                off = self._offset(slot)
+                head = mm[off:off + 16]
+                if head == key or head == b"\0" * 16:
+                    target = slot
+                    break
+            if target is None:
+                target = next(self._probe(key))
+            off = self._offset(target)
+            mm[off:off + 16] = b"\xff" * 16  # invalidate while writing
+            mm[off + 16:off + 16 + self.vec_bytes] = data
+            mm[off + 16 + self.vec_bytes:off + self.slot_size] = key
+            mm[off:off + 16] = key
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+class CachedEmbeddings(_EmbeddingsBase):
+    def __init__(self, base, max_entries: int = 4096, disk_path: Optional[str] = None, disk_slots: int = 32768,
+                 model_id: str = ""):
+        self.base = base
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self.disk_slots = disk_slots
+        self._disk: Optional[DiskEmbeddingStore] = None
+        self._lru: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # model_name, client, ... of the wrapped object
+        if name == "base":
+            raise AttributeError(name)
+        return getattr(self.base, name)
+
+    def _disk_store(self, dim: int) -> Optional[DiskEmbeddingStore]:
+        if self._disk is None and self.disk_path:
+            try:
+                self._disk = DiskEmbeddingStore(self.disk_path, dim, self.disk_slots, self.model_id)
+            except Exception as e:
+                logger.warning("Disk embedding cache disabled (%s): %s", self.disk_path, e)
+                self.disk_path = None
+        return self._disk
+
+    def embed_query(self, text: str) -> List[float]:
+        key = _key(normalize_query(text))
+        with self._lock:
+            vec = self._lru.get(key)
+            if vec is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return vec
+        if self._disk is not None:
+            vec = self._disk.get(key)
+            if vec is not None:
+                self._remember(key, vec)
+                with self._lock:
+                    self.disk_hits += 1
+                return vec
+        vec = self.base.embed_query(text)
+        with self._lock:
+            self.misses += 1
+        self._remember(key, vec)
+        disk = self._disk_store(len(vec))
+        if disk is not None:
+            try:
+                disk.put(key, vec)
+            except Exception as e:
+                logger.warning("Disk embedding cache write failed: %s", e)
+        return vec
+
+    def _remember(self, key: bytes, vec: List[float]):
+        with self._lock:
+            self._lru[key] = vec
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.base.embed_documents(texts)
+
+    def warm_disk(self, dim: int):
+        """Open the disk store eagerly (so first queries can hit entries from other workers)."""
+        self._disk_store(dim)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._lru),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": ((self.hits + self.disk_hits) / lookups) if lookups else 0.0,
+                "disk_path": self.disk_path,
+            }
@@ -1,26 +1,62 @@
 from langchain_community.document_loaders import PyPDFLoader, DirectoryLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 # from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.embeddings import HuggingFaceEmbeddings
+# HuggingFaceEmbeddings (torch) is imported in load_base_embeddings, only for EMBED_BACKEND=torch
 
 from langchain.schema import Document
+import os
 import threading
 from typing import List
 
+from src.embedding_cache import CachedEmbeddings
+
+# Query-embedding cache (see src/embedding_cache.py)
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "1") == "1"
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "")  # e.g. ./hf_cache/query_embeddings.bin (shared by workers)
+EMBED_CACHE_DISK_SLOTS = int(os.getenv("EMBED_CACHE_DISK_SLOTS", "32768"))
+
+# Embedding backend: "torch" (sentence-transformers) | "onnx" | "onnx-int8" (see src/onnx_embeddings.py)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").lower()
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")  # hub id or local dir (onnx)
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE") or None  # override the file inside the model repo/dir
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0")) or None
+
 _embeddings = None
 _embeddings_lock = threading.Lock()
 
+def load_base_embeddings(backend: str = "torch"):
+    """Uncached embeddings object for ``backend`` (also used by bench_embeddings.py)."""
+    if backend == "torch":
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        return HuggingFaceEmbeddings(model_name=EMBED_MODEL)
+    if backend in ("onnx", "onnx-int8"):
+        from src.onnx_embeddings import OnnxEmbeddings
+
+        return OnnxEmbeddings(EMBED_MODEL, variant=backend, filename=EMBED_ONNX_FILE, threads=EMBED_THREADS,
+                              cache_dir=os.getenv("HF_HOME") or None)
+    raise ValueError(f"Unknown EMBED_BACKEND: {backend}")
+
 def get_embeddings():
     global _embeddings
     if _embeddings is None:
         with _embeddings_lock:
             if _embeddings is None:
-                print("🔵 Loading HuggingFace Embeddings (one-time)...")
-                _embeddings = HuggingFaceEmbeddings(
-                    model_name="sentence-transformers/all-MiniLM-L6-v2"
-                )
-                vec = _embeddings.embed_query("test")
+                print(f"🔵 Loading {EMBED_BACKEND} embeddings (one-time)...")
+                emb = load_base_embeddings(EMBED_BACKEND)
+                vec = emb.embed_query("test")
                 print("🧩 Embedding dimension:", len(vec))
+                if EMBED_CACHE_ENABLED:
+                    emb = CachedEmbeddings(
+                        emb,
+                        max_entries=EMBED_CACHE_SIZE,
+                        disk_path=EMBED_CACHE_PATH or None,
+                        disk_slots=EMBED_CACHE_DISK_SLOTS,
+                        model_id=f"{EMBED_BACKEND}:{EMBED_MODEL}:{EMBED_ONNX_FILE or ''}",
+                    )
+                    emb.warm_disk(len(vec))
+                _embeddings = emb
                 print("🟢 Embeddings loaded successfully.")
     return _embeddings
 
@@ -37,6 +73,9 @@ def filter_to_minimal_docs(docs: List[Document]) -> List[Document]:
         out.append(Document(page_content=doc.page_content, metadata={"source": doc.metadata.get("source")}))
     return out
 
+def get_text_splitter():
+    return RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=20)
+
 def text_split(docs: List[Document]):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=20)
+    splitter = get_text_splitter()
     return splitter.split_documents(docs)
@@ -0,0 +1,422 @@
+"""
+Streaming ingestion pipeline used by store_index.py.
+
+    PDFs --(process pool)--> pages --(lazy)--> chunks --(batched)--> embeddings --(bounded threads)--> sink
+
+Every stage is bounded (parse window, embed batch, in-flight upserts), so peak
+memory depends on the batch sizes and not on the corpus size.
+"""
+import os
+import glob
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from langchain.schema import Document
+
+from src.helper import get_embeddings, get_text_splitter
+from src.manifest import IngestManifest, PageTextCache, chunk_id, file_sha256
+
+logger = logging.getLogger("medical-chatbot")
+
+
+# ---------------- stage 1: PDF parsing (process pool) ----------------
+def parse_pdf_pages(path: str) -> Tuple[str, List[Tuple[int, str]], Optional[str]]:
+    """Runs in a worker process. Returns (path, [(page_no, text)], error)."""
+    try:
+        from pypdf import PdfReader
+        reader = PdfReader(path)
+        return path, [(i, page.extract_text() or "") for i, page in enumerate(reader.pages)], None
+    except Exception as e:
+        return path, [], str(e)
+
+
+def list_pdfs(data_path: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(data_path, "*.pdf")))
+
+
+def iter_parsed_files(items: List[Tuple[str, str, Optional[str]]], page_cache: Optional[PageTextCache] = None,
+                      workers: Optional[int] = None, window: Optional[int] = None,
+                      stats: Optional["ThroughputReporter"] = None):
+    """
+    items: [(key, path, sha256)] -> yields (key, path, sha256, [page texts] or None on failure), in order.
+    Files found in ``page_cache`` skip PyPDF entirely; the rest are parsed in a
+    process pool with at most ``window`` files in flight ahead of the consumer.
+    """
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    window = window or workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        it = iter(items)
+
+        def fill():
+            while len(pending) < window:
+                item = next(it, None)
+                if item is None:
+                    return
+                key, path, sha = item
+                cached = page_cache.get(sha) if (page_cache is not None and sha) else None
+                if cached is not None:
+                    if stats:
+                        stats.add(cached_files=1)
+                    pending.append((item, cached))
+                else:
+                    pending.append((item, pool.submit(parse_pdf_pages, path)))
+
+        fill()
+        while pending:
+            (key, path, sha), res = pending.popleft()
+            fill()
+            if isinstance(res, list):
+                pages = res
+            else:
+                _, parsed, err = res.result()
+                if err:
+                    logger.warning("Failed to parse %s: %s", path, err)
+                    yield key, path, sha, None
+                    continue
+                pages = [text for _, text in parsed]
+                if page_cache is not None and sha:
+                    page_cache.put(sha, pages)
+            if stats:
+                stats.add(files=1, pages=len(pages))
+            yield key, path, sha, pages
+
+
+# ---------------- stage 2: lazy chunking ----------------
+def iter_file_chunks(key: str, path: str, pages: List[str], splitter) -> Iterator[Tuple[str, Document]]:
+    """Chunks of one file with deterministic ids."""
+    seen: Dict[str, int] = {}
+    for text in pages:
+        for chunk in splitter.split_documents([Document(page_content=text, metadata={"source": path})]):
+            occurrence = seen[chunk.page_content] = seen.get(chunk.page_content, -1) + 1
+            yield chunk_id(key, chunk.page_content, occurrence), chunk
+
+
+def batched(items: Iterable, size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ---------------- sinks ----------------
+class PineconeSink:
+    """Upserts (id, vector, metadata) batches; metadata["text"] matches langchain_pinecone's text_key."""
+
+    def __init__(self, index, namespace: Optional[str] = None, upsert_batch: int = 100, delete_batch: int = 1000):
+        self.index = index
+        self.namespace = namespace
+        self.upsert_batch = upsert_batch
+        self.delete_batch = delete_batch
+
+    def write(self, ids: List[str], vectors: List[List[float]], chunks: List[Document]):
+        records = [
+            (ids[i], vectors[i], {**(chunks[i].metadata or {}), "text": chunks[i].page_content})
+            for i in range(len(ids))
+        ]
+        for part in batched(records, self.upsert_batch):
+            self.index.upsert(vectors=part, namespace=self.namespace)
+
+    def delete(self, ids: List[str]):
+        for part in batched(ids, self.delete_batch):
+            self.index.delete(ids=part, namespace=self.namespace)
+
+    def reset(self):
+        self.index.delete(delete_all=True, namespace=self.namespace)
+
+    def has_untracked_vectors(self) -> bool:
+        """Any vectors at all: without a manifest none of them can be matched to a chunk id."""
+        stats = self.index.describe_index_stats()
+        if self.namespace:
+            ns = (stats.namespaces or {}).get(self.namespace)
+            return bool(ns and ns.vector_count)
+        return bool(stats.total_vector_count)
+
+    def close(self, keep_ids: Optional[set] = None):
+        pass
+
+
+class LocalIndexSink:
+    """
+    Writes a fresh local index. With ``carry_over=True`` the rows of the existing
+    index whose ids are still wanted (``keep_ids`` passed to close()) are copied
+    across without re-embedding, so an incremental run only embeds new chunks.
+    """
+
+    def __init__(self, path: str, dtype: str = "float16", mode: str = "auto", carry_over: bool = False):
+        self.path = path
+        self.dtype = dtype
+        self.mode = mode
+        self.carry_over = carry_over
+        self.writer = None
+        self.written = set()
+        self._lock = threading.Lock()
+
+    def _writer(self, dim: int):
+        from src.vector_index import LocalIndexWriter
+        with self._lock:
+            if self.writer is None:
+                self.writer = LocalIndexWriter(self.path, dim=dim, dtype=self.dtype)
+        return self.writer
+
+    def write(self, ids, vectors, chunks):
+        self._writer(len(vectors[0])).add(vectors, [c.page_content for c in chunks],
+                                          [c.metadata for c in chunks], ids=ids)
+        with self._lock:
+            self.written.update(ids)
+
+    def delete(self, ids):
+        pass  # handled in close(): rows not in keep_ids are not carried over
+
+    def reset(self):
+        self.carry_over = False
+
+    def has_untracked_vectors(self) -> bool:
+        return False  # only rows in keep_ids are carried over, so old rows never linger
+
+    def close(self, keep_ids: Optional[set] = None):
+        from src.vector_index import LocalVectorIndex
+        old = None
+        if self.carry_over and keep_ids is not None and os.path.exists(os.path.join(self.path, "meta.json")):
+            old = LocalVectorIndex.load(self.path)
+        if old is not None:
+            old_ids = old.ids()
+            carry = [row for row, cid in enumerate(old_ids) if cid in keep_ids and cid not in self.written]
+            if self.writer is None and len(carry) == len(old_ids):
+                old.close()
+                logger.info("Local index unchanged: %s", self.path)
+                return
+            if carry:
+                writer = self._writer(old.dim)
+                for rows in batched(carry, 4096):
+                    recs = [old.chunk(r) for r in rows]
+                    writer.add(old.rows_float32(rows), [r["text"] for r in recs],
+                               [r.get("metadata") or {} for r in recs], ids=[r["id"] for r in recs])
+            elif self.writer is None:
+                self._writer(old.dim)
+            old.close()
+        if self.writer is not None:
+            self.writer.finalize(mode=self.mode)
+
+
+class LexicalIndexSink:
+    """
+    Builds the BM25 index (src/lexical_index.py) from the same chunks as the
+    vector sink it is paired with. Like ``LocalIndexSink(carry_over=True)``,
+    chunks of unchanged files are copied from the previous index.
+    """
+
+    def __init__(self, path: str, carry_over: bool = True):
+        self.path = path
+        self.carry_over = carry_over
+        self.written = set()
+        self._lock = threading.Lock()
+        from src.lexical_index import LexicalIndexWriter
+        self.writer = LexicalIndexWriter(path)
+
+    def write(self, ids, vectors, chunks):
+        self.writer.add([c.page_content for c in chunks], [c.metadata for c in chunks], ids=ids)
+        with self._lock:
+            self.written.update(ids)
+
+    def delete(self, ids):
+        pass  # handled in close(): rows not in keep_ids are not carried over
+
+    def reset(self):
+        self.carry_over = False
+
+    def has_untracked_vectors(self) -> bool:
+        return False  # rebuilt from keep_ids like LocalIndexSink
+
+    def close(self, keep_ids: Optional[set] = None):
+        from src.lexical_index import LexicalIndex
+        if self.carry_over and keep_ids is not None and os.path.exists(os.path.join(self.path, "meta.json")):
+            old = LexicalIndex.load(self.path)
+            carry = [row for row, cid in enumerate(old.ids()) if cid in keep_ids and cid not in self.written]
+            for rows in batched(carry, 4096):
+                recs = [old.chunk(r) for r in rows]
+                self.writer.add([r["text"] for r in recs], [r.get("metadata") or {} for r in recs],
+                                ids=[r["id"] for r in recs])
+            old.close()
+        if keep_ids is not None:
+            missing = len(keep_ids) - self.writer.count
+            if missing > 0:
+                logger.warning("Lexical index is missing %d chunks that are in the vector store; "
+                               "run store_index.py --full once to backfill it", missing)
+        self.writer.finalize()
+
+
+class MultiSink:
+    """Fans every sink call out to several sinks (vector store + lexical index)."""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, ids, vectors, chunks):
+        for s in self.sinks:
+            s.write(ids, vectors, chunks)
+
+    def delete(self, ids):
+        for s in self.sinks:
+            s.delete(ids)
+
+    def reset(self):
+        for s in self.sinks:
+            s.reset()
+
+    def has_untracked_vectors(self) -> bool:
+        return any(s.has_untracked_vectors() for s in self.sinks)
+
+    def close(self, keep_ids: Optional[set] = None):
+        for s in self.sinks:
+            s.close(keep_ids=keep_ids)
+
+
+# ---------------- progress ----------------
+class ThroughputReporter:
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self.start = time.time()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {"files": 0, "cached_files": 0, "pages": 0, "chunks": 0,
+                                       "skipped_chunks": 0, "vectors": 0, "deleted": 0}
+
+    def add(self, **kw):
+        with self._lock:
+            for k, v in kw.items():
+                self.counts[k] = self.counts.get(k, 0) + v
+            now = time.time()
+            if now - self._last_report >= self.interval:
+                self._last_report = now
+                self._log("progress")
+
+    def _log(self, label: str):
+        el = max(time.time() - self.start, 1e-9)
+        c = self.counts
+        logger.info(
+            "ingest %s: files=%d (cached %d) pages=%d (%.1f/s) chunks=%d (%.1f/s, %d unchanged) "
+            "vectors=%d (%.1f/s) deleted=%d elapsed=%.1fs",
+            label, c["files"], c["cached_files"], c["pages"], c["pages"] / el, c["chunks"], c["chunks"] / el,
+            c["skipped_chunks"], c["vectors"], c["vectors"] / el, c["deleted"], el,
+        )
+
+    def summary(self) -> Dict[str, float]:
+        self._log("done")
+        return {**self.counts, "elapsed": time.time() - self.start}
+
+
+# ---------------- driver ----------------
+class UntrackedIndexError(RuntimeError):
+    """The store has vectors but there is no manifest saying which chunks they are."""
+
+
+def run_ingestion(data_path: str, sink, parse_workers: Optional[int] = None, embed_batch: int = 256,
+                  upsert_workers: int = 4, max_inflight: Optional[int] = None,
+                  manifest: Optional[IngestManifest] = None, page_cache: Optional[PageTextCache] = None,
+                  full: bool = False, report_interval: float = 5.0) -> Dict[str, float]:
+    """
+    Stream every PDF under ``data_path`` into ``sink``.
+
+    embed_batch:    chunks per get_embeddings().embed_documents() call
+    upsert_workers: concurrent sink writes
+    max_inflight:   embedded batches allowed to wait for the sink (bounds memory)
+    manifest:       when given, only new/changed chunks are embedded and vectors of
+                    removed chunks/files are deleted; saved only after success
+    page_cache:     extracted page text by file hash (unchanged PDFs skip PyPDF)
+    full:           ignore the manifest and rebuild the whole store
+
+    Raises UntrackedIndexError when the manifest is empty (first run, or a lost
+    manifest) but the store already has vectors, e.g. an index built by the old
+    store_index.py with random ids. An incremental run would add every chunk a
+    second time and never delete the old ones; ``full=True`` rebuilds instead.
+    """
+    if manifest is not None and not full and not manifest.files and sink.has_untracked_vectors():
+        raise UntrackedIndexError(
+            "The vector store already has vectors but there is no ingest manifest for it, so an incremental "
+            "run would duplicate every chunk. Run once with --full to clear and rebuild it.")
+
+    embeddings = get_embeddings()
+    splitter = get_text_splitter()
+    stats = ThroughputReporter(report_interval)
+    max_inflight = max_inflight or upsert_workers * 2
+    slots = threading.BoundedSemaphore(max_inflight)
+    errors: List[BaseException] = []
+
+    paths = list_pdfs(data_path)
+    if manifest is None or full:
+        if full:
+            sink.reset()
+            if manifest is not None:
+                manifest.files = {}
+        hash_files = page_cache is not None or manifest is not None
+        items = [(os.path.relpath(p, data_path).replace(os.sep, "/"), p, file_sha256(p) if hash_files else None)
+                 for p in paths]
+        unchanged, removed = [], []
+    else:
+        items, unchanged, removed = manifest.plan(paths, data_path)
+    logger.info("Ingesting %s: %d new/changed PDFs, %d unchanged, %d removed",
+                data_path, len(items), len(unchanged), len(removed))
+
+    stale_ids: List[str] = []
+    parsed: List[Tuple[str, str, str, List[str]]] = []
+
+    def new_chunks() -> Iterator[Tuple[str, Document]]:
+        for key, path, sha, pages in iter_parsed_files(items, page_cache, workers=parse_workers, stats=stats):
+            if pages is None:
+                continue  # keep whatever the store has for this file; retried next run
+            old_ids = set(manifest.chunk_ids(key)) if manifest is not None else set()
+            ids = []
+            for cid, chunk in iter_file_chunks(key, path, pages, splitter):
+                ids.append(cid)
+                stats.add(chunks=1)
+                if cid in old_ids:
+                    stats.add(skipped_chunks=1)
+                    continue
+                yield cid, chunk
+            stale_ids.extend(old_ids.difference(ids))
+            parsed.append((key, path, sha, ids))
+
+    def write(ids, vectors, chunks):
+        try:
+            sink.write(ids, vectors, chunks)
+            stats.add(vectors=len(ids))
+        except BaseException as e:  # surfaced after the pool drains
+            errors.append(e)
+            logger.exception("Sink write failed: %s", e)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=upsert_workers) as pool:
+        for batch in batched(new_chunks(), embed_batch):
+            if errors:
+                break
+            vectors = embeddings.embed_documents([c.page_content for _, c in batch])
+            slots.acquire()
+            pool.submit(write, [cid for cid, _ in batch], vectors, [c for _, c in batch])
+    if errors:
+        raise errors[0]
+
+    if manifest is not None:
+        for key in removed:
+            stale_ids.extend(manifest.chunk_ids(key))
+            manifest.remove(key)
+        for key, path, sha, ids in parsed:
+            manifest.record(key, path, sha, ids)
+    if stale_ids:
+        sink.delete(stale_ids)
+        stats.add(deleted=len(stale_ids))
+    sink.close(keep_ids=manifest.all_chunk_ids() if manifest is not None else None)
+    if manifest is not None:
+        manifest.save()
+        if page_cache is not None:
+            page_cache.prune({e["sha256"] for e in manifest.files.values()})
+    return stats.summary()
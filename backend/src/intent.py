@@ -0,0 +1,223 @@
+"""
+Intent detection for incoming chat messages.
+
+``IntentEngine`` compiles every keyword phrase into one word-bounded regex
+trie at import time, so a message is scanned once (``finditer``) instead of
+once per keyword list, and substrings no longer match inside other words
+("hi" in "high", "cure" in "secure", "it" in "arthritis").
+
+Rules on top of the matches:
+
+- a follow-up cue ("why", "dosage", "tell me more", ...) or a bare pronoun
+  ("it", "that", ...) only makes a message a follow-up when it names no
+  disease, medicine or symptom of its own; "how to treat diabetes" is a
+  standalone medical question;
+- a generic medical word ("symptoms", "treatment", "causes", ...) is a
+  follow-up only when nothing else in the message could be the topic: "what
+  are the symptoms" asks about the last topic, "symptoms of kidney stones"
+  names one the keyword lists do not know;
+- greetings only count at the start of a message without medical content.
+
+``CentroidIntentClassifier`` is the optional second stage: nearest centroid
+over query embeddings for messages no rule recognises.
+"""
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+PHRASES: Dict[str, Sequence[str]] = {
+    "greeting": ("hi", "hii", "hello", "hey", "good morning", "good evening", "good afternoon", "namaste"),
+    "translate": ("translate", "answer in", "reply in"),
+    "disease": (
+        "typhoid", "diabetes", "dengue", "malaria", "cholera", "tuberculosis", "tb", "covid", "asthma",
+        "cancer", "hypertension", "bp", "migraine", "jaundice", "anemia", "anaemia", "thyroid", "arthritis",
+        "pneumonia", "flu", "influenza", "chickenpox", "measles",
+    ),
+    "medicine": (
+        "tablet", "tablets", "capsule", "capsules", "medicine", "medicines", "drug", "drugs", "syrup",
+        "injection", "b-complex", "paracetamol", "crocin", "dolo", "azithromycin", "vitamin", "vitamins",
+        "ibuprofen", "antibiotic", "antibiotics", "insulin", "metformin",
+    ),
+    # concrete body/symptom/topic words: make a message self-contained
+    "symptom": (
+        "pain", "fever", "cough", "cold", "infection", "rash", "diarrhea", "diarrhoea", "vomiting", "headache",
+        "heart", "skin", "mental", "stress", "lifestyle", "health", "wellness", "exercise", "diet", "sugar",
+        "blood pressure", "stomach", "chest", "throat", "allergy", "itching", "weight", "sleep", "anxiety",
+        "depression", "pregnancy", "sick", "hurt", "hurts", "swelling", "bleeding", "dizzy", "nausea",
+        "injury", "blood", "cholesterol",
+    ),
+    # question words of a medical conversation, meaningless without a topic
+    "medical_generic": (
+        "symptom", "symptoms", "disease", "treatment", "cause", "causes", "diagnosis", "side effect",
+        "interaction", "interactions", "prevention", "precautions",
+    ),
+    "followup": (
+        "side effects", "sideeffect", "dose", "dosage", "how many", "continue", "why", "safe", "pregnant",
+        "children", "elderly", "how to", "recover", "cure", "overcome", "get rid", "treat this", "fix this",
+        "tell me more", "explain more", "more info", "more about", "what about", "how about", "how long",
+        "what else",
+    ),
+    "pronoun": ("it", "that", "this", "them", "those", "they", "its"),
+    "identity": (
+        "who created you", "who made you", "who built you", "who are you", "what are you", "are you a doctor",
+        "are you human", "your creator", "your owner",
+    ),
+}
+
+STARTERS = ("what is", "explain")
+
+# words that never name a topic: question words, function words, vague modifiers
+FILLER = frozenset("""
+    a an the of for in on at to from with about and or is are was were be been do does did can could should
+    would will what whats s which who how when where why tell me my i we you your explain describe list give
+    show please know some any all main common usual typical early first possible major other sign signs
+""".split())
+_WORD_RE = re.compile(r"[a-z]+")
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """Regex alternation shaped as a character trie: shared prefixes are matched once."""
+    trie: Dict = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def emit(node: Dict) -> str:
+        end = "" in node
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        if end:
+            # the shorter word is the prefix; the longer ones are a greedy optional tail
+            return "(?:" + "|".join(branches) + ")?"
+        return branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+
+    return emit(trie)
+
+
+class IntentEngine:
+    def __init__(self, phrases: Dict[str, Sequence[str]] = PHRASES):
+        self.category: Dict[str, str] = {}
+        for cat, words in phrases.items():
+            for w in words:
+                self.category.setdefault(w, cat)  # first category listing a phrase owns it
+        self.diseases = frozenset(phrases.get("disease", ()))
+        self.known_words = FILLER.union(*(_WORD_RE.findall(w) for w in self.category))
+        self.pattern = re.compile(r"(?<![\w-])" + _trie_pattern(self.category) + r"(?![\w-])")
+
+    def matches(self, t: str) -> Dict[str, List[Tuple[int, str]]]:
+        """category -> [(offset, phrase)] for one lowercased message, in a single scan."""
+        found: Dict[str, List[Tuple[int, str]]] = {}
+        for m in self.pattern.finditer(t):
+            phrase = m.group(0)
+            found.setdefault(self.category[phrase], []).append((m.start(), phrase))
+        return found
+
+    def detect(self, text: str) -> Tuple[str, Optional[str]]:
+        """(intent, language) with intent in greeting|translate|medical|followup|identity|other."""
+        t = " ".join((text or "").lower().split())
+        if not t:
+            return ("other", None)
+        found = self.matches(t)
+
+        if "translate" in found:
+            lang = t.replace("answer in", "").replace("translate to", "").replace("reply in", "").strip()
+            return ("translate", lang)
+
+        entity = "disease" in found or "medicine" in found or "symptom" in found
+        cue = "followup" in found
+
+        if "greeting" in found and found["greeting"][0][0] == 0 and not (entity or cue or "medical_generic" in found):
+            return ("greeting", None)
+        if "identity" in found:
+            return ("identity", None)
+        if t in self.diseases or "medicine" in found:
+            return ("medical", None)
+        if not entity and (cue or "pronoun" in found):
+            return ("followup", None)
+        if not entity and "medical_generic" in found:
+            return ("medical", None) if self.has_topic(t) else ("followup", None)
+        if entity or t.startswith(STARTERS):
+            return ("medical", None)
+        return ("other", None)
+
+    def has_topic(self, t: str) -> bool:
+        """True if a word of ``t`` is neither filler nor a known keyword ("gout", "kidney", "psoriasis")."""
+        return any(w not in self.known_words for w in _WORD_RE.findall(t))
+
+    def is_follow_up(self, text: str) -> bool:
+        return self.detect(text)[0] == "followup"
+
+
+ENGINE = IntentEngine()
+
+
+def detect_intent(text: str) -> Tuple[str, Optional[str]]:
+    return ENGINE.detect(text)
+
+
+def is_follow_up_question(text: str) -> bool:
+    return ENGINE.is_follow_up(text)
+
+
+# ---------------- optional embedding stage ----------------
+SEED_EXAMPLES: Dict[str, Sequence[str]] = {
+    "medical": (
+        "my stomach hurts after eating", "I feel dizzy when I stand up", "my child has a high temperature",
+        "what should I do for a sprained ankle", "burning sensation while urinating", "my knee is swollen",
+        "I can't breathe properly at night", "there is blood in my stool", "how do I lower my cholesterol",
+    ),
+    "followup": (
+        "is it contagious", "how long does it last", "can I take it with food", "what happens if I ignore it",
+        "is that dangerous", "should I see a doctor for this", "what are the risks",
+    ),
+    "greeting": ("good night", "how are you", "thanks", "thank you so much", "ok bye"),
+    "other": (
+        "who won the cricket match", "tell me a joke", "what is the capital of france", "book a movie ticket",
+        "write a poem about the sea", "what's the weather today",
+    ),
+}
+
+
+class CentroidIntentClassifier:
+    """
+    Nearest-centroid intent over normalised query embeddings. Centroids are
+    built lazily (the embedding model loads in the background) and scored with
+    one matrix-vector product; below ``threshold`` cosine it abstains.
+    """
+
+    def __init__(self, embeddings, examples: Dict[str, Sequence[str]] = SEED_EXAMPLES, threshold: float = 0.45):
+        self.embeddings = embeddings
+        self.examples = examples
+        self.threshold = threshold
+        self.labels: List[str] = []
+        self.centroids: Optional[np.ndarray] = None
+
+    def _build(self):
+        labels, rows = [], []
+        for label, texts in self.examples.items():
+            vecs = np.asarray(self.embeddings.embed_documents(list(texts)), dtype=np.float32)
+            vecs /= np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-12
+            c = vecs.mean(axis=0)
+            rows.append(c / (np.linalg.norm(c) + 1e-12))
+            labels.append(label)
+        self.labels = labels
+        self.centroids = np.stack(rows)
+
+    def classify_vector(self, vec: Sequence[float]) -> Tuple[Optional[str], float]:
+        if self.centroids is None:
+            self._build()
+        q = np.asarray(vec, dtype=np.float32)
+        q = q / (np.linalg.norm(q) + 1e-12)
+        scores = self.centroids @ q
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        return (self.labels[best] if score >= self.threshold else None), score
+
+    def classify(self, text: str) -> Tuple[Optional[str], float]:
+        # embed_query goes through CachedEmbeddings, so the answer-cache lookup
+        # for the same text reuses this vector
+        return self.classify_vector(self.embeddings.embed_query(text))
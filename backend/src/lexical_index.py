@@ -0,0 +1,322 @@
+"""
+Local BM25 index over the ingested chunks, fused with dense retrieval.
+
+MiniLM embeddings blur exact tokens: drug names ("azithromycin",
+"B-complex") and dosage strings ("500mg") are often not in the dense top-k.
+A lexical index finds those directly; ``HybridRetriever`` merges both result
+lists with reciprocal-rank fusion, so recall at k=1..3 improves without a
+second vector round trip (the dense side is just asked for a few more
+candidates in the same query).
+
+On-disk layout of an index directory (everything except meta.json is
+memory-mapped; no vocabulary dict is built at load)::
+
+    meta.json              count, terms, avgdl, k1, b, tokenizer
+    chunks.jsonl           one {"id", "text", "metadata"} record per row
+    offsets.bin            uint64 byte offsets into chunks.jsonl (count + 1)
+    doc_len.bin            uint32 tokens per row
+    terms.bin              sorted, concatenated utf-8 terms
+    term_offsets.bin       uint64 byte offsets into terms.bin (terms + 1)
+    postings_offsets.bin   uint64 posting-list boundaries per term (terms + 1)
+    postings_rows.bin      uint32 row ids, grouped by term
+    postings_tf.bin        uint16 term frequency per posting
+"""
+import os
+import re
+import json
+import mmap
+import shutil
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.vector_index import Document, _top_k
+
+logger = logging.getLogger("medical-chatbot")
+
+TOKENIZER_VERSION = 1
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-.'][a-z0-9]+)*")
+_SEP_RE = re.compile(r"[-']|\.(?![0-9])|(?<![0-9])\.")
+_DOSE_RE = re.compile(r"([0-9]+(?:\.[0-9]+)?)([a-z]+)")
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i if in is it its me my of on or so that the "
+    "their them there these they this to was what when which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased word tokens. Compounds are kept whole and also split into their
+    parts, so "B-complex" matches "b complex" and "500mg" matches "500 mg"
+    (only number+unit is split: "b12" stays one token).
+    """
+    out = []
+    for tok in _TOKEN_RE.findall((text or "").lower()):
+        if tok in STOPWORDS:
+            continue
+        out.append(tok)
+        parts = _SEP_RE.split(tok)
+        if len(parts) == 1:
+            m = _DOSE_RE.fullmatch(tok)
+            parts = list(m.groups()) if m else parts
+        if len(parts) > 1:
+            out.extend(p for p in parts if p and p not in STOPWORDS and (len(p) > 1 or p.isdigit()))
+    return out
+
+
+class LexicalIndexWriter:
+    """
+    Streams chunk texts to disk and keeps only postings (row, tf) in memory.
+    Written to ``<path>.building`` and swapped in by ``finalize()``.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.path = os.path.abspath(path)
+        self.tmp = self.path + ".building"
+        self.k1 = k1
+        self.b = b
+        self.count = 0
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self._chunk_f = open(os.path.join(self.tmp, "chunks.jsonl"), "wb")
+        self._offsets = [0]
+        self._doc_len: List[int] = []
+        self._postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, texts: Sequence[str], metadatas: Optional[Sequence[Dict]] = None,
+            ids: Optional[Sequence[str]] = None):
+        metadatas = metadatas or [{}] * len(texts)
+        counted = [Counter(tokenize(t)) for t in texts]  # outside the lock
+        with self._lock:
+            for i, text in enumerate(texts):
+                row = self.count + i
+                rec = {"id": ids[i] if ids else str(row), "text": text, "metadata": metadatas[i] or {}}
+                line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+                self._chunk_f.write(line)
+                self._offsets.append(self._offsets[-1] + len(line))
+                tf = counted[i]
+                self._doc_len.append(sum(tf.values()))
+                for term, n in tf.items():
+                    self._postings[term].append((row, min(n, 65535)))
+            self.count += len(texts)
+
+    def finalize(self) -> str:
+        self._chunk_f.close()
+        tmp = self.tmp
+        np.asarray(self._offsets, dtype=np.uint64).tofile(os.path.join(tmp, "offsets.bin"))
+        np.asarray(self._doc_len, dtype=np.uint32).tofile(os.path.join(tmp, "doc_len.bin"))
+
+        terms = sorted(self._postings)
+        encoded = [t.encode("utf-8") for t in terms]
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+        np.cumsum([len(e) for e in encoded], out=term_offsets[1:])
+        with open(os.path.join(tmp, "terms.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        term_offsets.tofile(os.path.join(tmp, "term_offsets.bin"))
+
+        post_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+        np.cumsum([len(self._postings[t]) for t in terms], out=post_offsets[1:])
+        post_offsets.tofile(os.path.join(tmp, "postings_offsets.bin"))
+        with open(os.path.join(tmp, "postings_rows.bin"), "wb") as rows_f, \
+                open(os.path.join(tmp, "postings_tf.bin"), "wb") as tf_f:
+            for t in terms:
+                p = np.asarray(self._postings[t], dtype=np.uint32)
+                rows_f.write(p[:, 0].tobytes())
+                tf_f.write(p[:, 1].astype(np.uint16).tobytes())
+
+        meta = {
+            "count": self.count,
+            "terms": len(terms),
+            "avgdl": (sum(self._doc_len) / self.count) if self.count else 0.0,
+            "k1": self.k1,
+            "b": self.b,
+            "tokenizer": TOKENIZER_VERSION,
+        }
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+        old = self.path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.replace(self.path, old)
+        os.replace(tmp, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+        logger.info("Lexical index written: %s (%d chunks, %d terms)", self.path, self.count, len(terms))
+        return self.path
+
+
+class LexicalIndex:
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        with open(os.path.join(self.path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("tokenizer") != TOKENIZER_VERSION:
+            logger.warning("Lexical index %s was built with another tokenizer; rebuild it", self.path)
+        self.count = int(self.meta["count"])
+        self.n_terms = int(self.meta["terms"])
+        self.avgdl = float(self.meta["avgdl"]) or 1.0
+        self.k1 = float(self.meta["k1"])
+        self.b = float(self.meta["b"])
+        self._files = []
+        self._chunks = self._map("chunks.jsonl")
+        self._terms = self._map("terms.bin")
+        self._offsets = self._array("offsets.bin", np.uint64)
+        self.doc_len = self._array("doc_len.bin", np.uint32)
+        self._term_offsets = self._array("term_offsets.bin", np.uint64)
+        self._post_offsets = self._array("postings_offsets.bin", np.uint64)
+        self._post_rows = self._array("postings_rows.bin", np.uint32)
+        self._post_tf = self._array("postings_tf.bin", np.uint16)
+        # per-row BM25 length normalisation, computed once
+        self._norm = (self.k1 * (1 - self.b + self.b * self.doc_len.astype(np.float32) / self.avgdl)
+                      if self.count else np.zeros(0, np.float32))
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        return cls(path)
+
+    def _map(self, name: str):
+        p = os.path.join(self.path, name)
+        if not os.path.getsize(p):
+            return b""
+        f = open(p, "rb")
+        self._files.append(f)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _array(self, name: str, dtype) -> np.ndarray:
+        p = os.path.join(self.path, name)
+        if not os.path.getsize(p):
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(p, dtype=dtype, mode="r")
+
+    def _term(self, i: int) -> bytes:
+        return self._terms[int(self._term_offsets[i]):int(self._term_offsets[i + 1])]
+
+    def term_id(self, term: str) -> Optional[int]:
+        """Binary search over the sorted, memory-mapped vocabulary."""
+        key = term.encode("utf-8")
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.n_terms and self._term(lo) == key else None
+
+    def chunk(self, row: int) -> Dict:
+        start, stop = int(self._offsets[row]), int(self._offsets[row + 1])
+        return json.loads(self._chunks[start:stop].decode("utf-8"))
+
+    def ids(self) -> List[str]:
+        return [self.chunk(row)["id"] for row in range(self.count)]
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[int, float]]:
+        """Return [(row, BM25 score)] best first."""
+        if not self.count:
+            return []
+        rows, weights = [], []
+        for term, qtf in Counter(tokenize(query)).items():
+            t = self.term_id(term)
+            if t is None:
+                continue
+            start, stop = int(self._post_offsets[t]), int(self._post_offsets[t + 1])
+            r = np.asarray(self._post_rows[start:stop], dtype=np.int64)
+            tf = np.asarray(self._post_tf[start:stop], dtype=np.float32)
+            df = stop - start
+            idf = np.log1p((self.count - df + 0.5) / (df + 0.5))
+            rows.append(r)
+            weights.append(qtf * idf * tf * (self.k1 + 1) / (tf + self._norm[r]))
+        if not rows:
+            return []
+        r = np.concatenate(rows)
+        w = np.concatenate(weights)
+        if r.size < self.count // 8:
+            # sparse accumulation: only rows that contain a query term
+            uniq, inv = np.unique(r, return_inverse=True)
+            scores = np.bincount(inv, weights=w)
+            return [(int(uniq[i]), float(scores[i])) for i in _top_k(scores, k)]
+        scores = np.bincount(r, weights=w, minlength=self.count)
+        return [(int(i), float(scores[i])) for i in _top_k(scores, k) if scores[i] > 0]
+
+    def documents(self, query: str, k: int = 4) -> List[Document]:
+        out = []
+        for row, _ in self.search(query, k=k):
+            rec = self.chunk(row)
+            out.append(Document(page_content=rec["text"], metadata=rec.get("metadata") or {}))
+        return out
+
+    def close(self):
+        for m in (self._chunks, self._terms):
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files:
+            f.close()
+        self._files = []
+
+
+# ---------------- fusion ----------------
+def _doc_key(doc) -> str:
+    return " ".join((getattr(doc, "page_content", "") or "").split())
+
+
+def reciprocal_rank_fusion(result_lists: Iterable[Sequence], k: int, rrf_k: int = 60,
+                           weights: Optional[Sequence[float]] = None) -> List:
+    """
+    Merge ranked document lists: score(d) = sum_i w_i / (rrf_k + rank_i(d)).
+    Documents are matched by their text (Pinecone and the lexical index assign
+    different ids to the same chunk). Ties keep the order of the first list.
+    """
+    scores: Dict[str, float] = {}
+    docs: Dict[str, object] = {}
+    order: Dict[str, int] = {}
+    for i, results in enumerate(result_lists):
+        w = weights[i] if weights else 1.0
+        for rank, doc in enumerate(results, start=1):
+            key = _doc_key(doc)
+            if not key:
+                continue
+            scores[key] = scores.get(key, 0.0) + w / (rrf_k + rank)
+            docs.setdefault(key, doc)
+            order.setdefault(key, len(order))
+    best = sorted(scores, key=lambda key: (-scores[key], order[key]))[:k]
+    return [docs[key] for key in best]
+
+
+class HybridRetriever:
+    """
+    Dense retriever (asked for ``candidates`` results) + BM25, fused with RRF.
+    Exposes the same ``get_relevant_documents`` / ``invoke`` surface as the
+    LangChain retrievers it wraps.
+    """
+
+    def __init__(self, dense, lexical: LexicalIndex, k: int = 1, candidates: int = 8, rrf_k: int = 60,
+                 lexical_weight: float = 1.0):
+        self.dense = dense
+        self.lexical = lexical
+        self.k = k
+        self.candidates = max(k, candidates)
+        self.rrf_k = rrf_k
+        self.lexical_weight = lexical_weight
+
+    def _dense(self, query: str) -> List:
+        try:
+            if hasattr(self.dense, "invoke"):
+                return list(self.dense.invoke(query))
+            return list(self.dense.get_relevant_documents(query))
+        except Exception as e:
+            logger.exception("Dense retrieval failed, using lexical results only: %s", e)
+            return []
+
+    def get_relevant_documents(self, query: str) -> List:
+        dense = self._dense(query)
+        lexical = self.lexical.documents(query, k=self.candidates)
+        return reciprocal_rank_fusion([dense, lexical], self.k, rrf_k=self.rrf_k,
+                                      weights=(1.0, self.lexical_weight))
+
+    def invoke(self, query: str, config=None) -> List:
+        return self.get_relevant_documents(query)
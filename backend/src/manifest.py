@@ -0,0 +1,145 @@
+"""
+Content-hash manifest for incremental re-indexing.
+
+The manifest records, per PDF (keyed by its path relative to the data dir):
+
+    {"sha256", "size", "mtime", "chunk_ids": [...]}
+
+Chunk ids are derived from (file, chunk text, occurrence), so re-running the
+ingestion on unchanged input produces the same ids and upserts are idempotent.
+Extracted page text is cached by file hash, so unchanged PDFs never go through
+PyPDF again (e.g. after a chunking change or a local index rebuild).
+"""
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("medical-chatbot")
+
+MANIFEST_VERSION = 1
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def chunk_id(source_key: str, text: str, occurrence: int = 0) -> str:
+    """Deterministic vector id for a chunk (occurrence disambiguates repeated text in one file)."""
+    h = hashlib.sha256()
+    h.update(source_key.encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8"))
+    h.update(b"\0")
+    h.update(str(occurrence).encode("ascii"))
+    return h.hexdigest()[:32]
+
+
+def _atomic_write_json(path: str, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class IngestManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.files: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.files = data.get("files", {})
+                else:
+                    logger.warning("Manifest %s has an old version; treating every file as new", path)
+            except Exception:
+                logger.exception("Could not read manifest %s; treating every file as new", path)
+
+    def save(self):
+        _atomic_write_json(self.path, {"version": MANIFEST_VERSION, "files": self.files})
+
+    def file_hash(self, key: str, path: str) -> str:
+        """sha256 of ``path``; reuses the recorded hash when size and mtime are unchanged."""
+        st = os.stat(path)
+        old = self.files.get(key)
+        if old and old.get("size") == st.st_size and old.get("mtime") == st.st_mtime:
+            return old["sha256"]
+        return file_sha256(path)
+
+    def plan(self, paths: List[str], data_path: str) -> Tuple[List[Tuple[str, str, str]], List[str], List[str]]:
+        """
+        Returns (changed, unchanged, removed):
+            changed:   [(key, path, sha256)] new or modified files
+            unchanged: [key]
+            removed:   [key] files in the manifest that no longer exist
+        """
+        changed, unchanged = [], []
+        seen = set()
+        for path in paths:
+            key = os.path.relpath(path, data_path).replace(os.sep, "/")
+            seen.add(key)
+            sha = self.file_hash(key, path)
+            old = self.files.get(key)
+            if old and old.get("sha256") == sha:
+                unchanged.append(key)
+                # refresh size/mtime so the next run skips hashing
+                st = os.stat(path)
+                old["size"], old["mtime"] = st.st_size, st.st_mtime
+            else:
+                changed.append((key, path, sha))
+        removed = [k for k in self.files if k not in seen]
+        return changed, unchanged, removed
+
+    def chunk_ids(self, key: str) -> List[str]:
+        return list((self.files.get(key) or {}).get("chunk_ids", []))
+
+    def record(self, key: str, path: str, sha: str, ids: List[str]):
+        st = os.stat(path)
+        self.files[key] = {"sha256": sha, "size": st.st_size, "mtime": st.st_mtime, "chunk_ids": ids}
+
+    def remove(self, key: str):
+        self.files.pop(key, None)
+
+    def all_chunk_ids(self) -> set:
+        out = set()
+        for entry in self.files.values():
+            out.update(entry.get("chunk_ids", []))
+        return out
+
+
+class PageTextCache:
+    """Extracted page texts keyed by file sha256 (one small JSON file per PDF)."""
+
+    def __init__(self, directory: str):
+        self.dir = directory
+        os.makedirs(self.dir, exist_ok=True)
+
+    def _path(self, sha: str) -> str:
+        return os.path.join(self.dir, sha + ".json")
+
+    def get(self, sha: str) -> Optional[List[str]]:
+        try:
+            with open(self._path(sha), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, sha: str, pages: List[str]):
+        _atomic_write_json(self._path(sha), pages)
+
+    def prune(self, keep: set):
+        """Drop cached texts for hashes no longer referenced by the manifest."""
+        for name in os.listdir(self.dir):
+            if name.endswith(".json") and name[:-5] not in keep:
+                try:
+                    os.remove(os.path.join(self.dir, name))
+                except OSError:
+                    pass
@@ -0,0 +1,255 @@
+"""
+In-process metrics: counters, fixed-bucket latency histograms and gauges.
+
+``/metrics`` renders them in the Prometheus text format (``?format=json`` for
+a JSON dump). Recording is one dict lookup, a bisect over the bucket bounds
+and a few adds under a lock -- about a microsecond, against stages that take
+milliseconds. Gauges (executor queue depth, ...) are callbacks read at scrape
+time, so they cost nothing on the request path.
+
+Numbers are per process: with several gunicorn workers each one is its own
+series (``process_id`` is exported with them).
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+from typing import Callable, ContextManager, Dict, Iterable, List, Optional, Tuple
+
+# seconds; spans cache hits (sub-ms) to slow LLM / OCR calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds: Iterable[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)  # last slot: above the largest bound
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> "_Timer":
+        """``with hist.time(): ...`` observes the block's wall time."""
+        return _Timer(self)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counts, total, n = list(self.counts), self.sum, self.count
+        return {"count": n, "sum": total, "buckets": counts, "bounds": list(self.bounds)}
+
+    def quantile(self, q: float, snap: Optional[Dict] = None) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile (None when empty)."""
+        snap = snap or self.snapshot()
+        if not snap["count"]:
+            return None
+        rank = q * snap["count"]
+        seen = 0
+        for i, c in enumerate(snap["buckets"]):
+            seen += c
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float("inf")
+        return float("inf")
+
+
+class _Timer:
+    __slots__ = ("hist", "start")
+
+    def __init__(self, hist: Histogram):
+        self.hist = hist
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = "", buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._gauges: Dict[str, Dict[LabelKey, Callable[[], float]]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    # ---- recording ----
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = _label_key(labels)
+        series = self._histograms.get(name)
+        hist = series.get(key) if series is not None else None
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(name, {}).setdefault(key, Histogram(self.buckets))
+        return hist
+
+    def observe(self, name: str, seconds: float, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def timer(self, name: str, **labels) -> _Timer:
+        """``with metrics.timer("stage_seconds", stage="llm"): ...``"""
+        return _Timer(self.histogram(name, **labels))
+
+    def gauge(self, name: str, fn: Callable[[], float], **labels):
+        """Register a callback read at scrape time (replaces one with the same labels)."""
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = fn
+
+    # ---- export ----
+    def _read_gauges(self) -> Dict[str, Dict[LabelKey, Optional[float]]]:
+        with self._lock:
+            gauges = {n: dict(s) for n, s in self._gauges.items()}
+        out = {}
+        for name, series in gauges.items():
+            out[name] = {}
+            for key, fn in series.items():
+                try:
+                    out[name][key] = float(fn())
+                except Exception:
+                    out[name][key] = None
+        return out
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = {n: dict(s) for n, s in self._counters.items()}
+            histograms = {n: dict(s) for n, s in self._histograms.items()}
+        result = {"process_id": os.getpid(), "counters": {}, "histograms": {}, "gauges": {}}
+        for name, series in counters.items():
+            result["counters"][name] = [{"labels": dict(k), "value": v} for k, v in series.items()]
+        for name, series in histograms.items():
+            rows = []
+            for key, hist in series.items():
+                snap = hist.snapshot()
+                rows.append({
+                    "labels": dict(key),
+                    "count": snap["count"],
+                    "sum_s": snap["sum"],
+                    "mean_ms": 1000 * snap["sum"] / snap["count"] if snap["count"] else None,
+                    "p50_le_ms": _ms(hist.quantile(0.5, snap)),
+                    "p95_le_ms": _ms(hist.quantile(0.95, snap)),
+                    "p99_le_ms": _ms(hist.quantile(0.99, snap)),
+                })
+            result["histograms"][name] = rows
+        for name, series in self._read_gauges().items():
+            result["gauges"][name] = [{"labels": dict(k), "value": v} for k, v in series.items()]
+        return result
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            counters = {n: dict(s) for n, s in self._counters.items()}
+            histograms = {n: dict(s) for n, s in self._histograms.items()}
+        lines: List[str] = []
+        pid = ("process_id", str(os.getpid()))
+
+        def header(name: str, kind: str):
+            full = self.prefix + name
+            help_text = self._meta.get(name, (kind, ""))[1]
+            if help_text:
+                lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            return full
+
+        for name, series in sorted(counters.items()):
+            full = header(name, "counter")
+            for key, v in sorted(series.items()):
+                lines.append(f"{full}{_fmt_labels(key, pid)} {_fmt_value(v)}")
+        for name, series in sorted(histograms.items()):
+            full = header(name, "histogram")
+            for key, hist in sorted(series.items()):
+                snap = hist.snapshot()
+                cumulative = 0
+                for bound, c in zip(list(snap["bounds"]) + [float("inf")], snap["buckets"]):
+                    cumulative += c
+                    lines.append(f"{full}_bucket{_fmt_labels(key + (pid,), ('le', _fmt_value(bound)))} {cumulative}")
+                lines.append(f"{full}_sum{_fmt_labels(key, pid)} {_fmt_value(snap['sum'])}")
+                lines.append(f"{full}_count{_fmt_labels(key, pid)} {snap['count']}")
+        for name, series in sorted(self._read_gauges().items()):
+            full = header(name, "gauge")
+            for key, v in sorted(series.items()):
+                if v is not None:
+                    lines.append(f"{full}{_fmt_labels(key, pid)} {_fmt_value(v)}")
+        return "\n".join(lines) + "\n"
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    if seconds is None or seconds == float("inf"):
+        return None  # above the largest bucket
+    return seconds * 1000
+
+
+class TimedProxy:
+    """
+    Wraps ``target``; calls to its public methods (or only ``methods``) run inside
+    ``timer()`` -- e.g. ``hist.time`` or a tracing span -- every other attribute
+    passes through. Attribute writes stay on the proxy: write to ``proxy.target``.
+    """
+
+    def __init__(self, target, timer: Callable[[], ContextManager], methods: Optional[Iterable[str]] = None):
+        self.target = target
+        self.timer = timer
+        self.methods = frozenset(methods) if methods is not None else None
+
+    def __getattr__(self, name):
+        if name in ("target", "timer", "methods"):
+            raise AttributeError(name)
+        attr = getattr(self.target, name)
+        if name.startswith("_") or not callable(attr) or (self.methods is not None and name not in self.methods):
+            return attr
+        timer = self.timer
+
+        def timed(*args, **kwargs):
+            with timer():
+                return attr(*args, **kwargs)
+
+        return timed
+
+
+def executor_queue_depth(executor) -> int:
+    """Work items submitted to a ThreadPoolExecutor that no thread has picked up yet."""
+    queue = getattr(executor, "_work_queue", None)
+    return queue.qsize() if queue is not None else 0
@@ -0,0 +1,252 @@
+"""
+Content-addressed OCR result cache.
+
+Users resend the same prescription photo or lab report; re-running Tesseract
+on it costs seconds. Results are stored by a hash of the file:
+
+- ``content`` mode: sha256 of the file bytes (exact re-uploads);
+- ``perceptual`` mode: additionally a 256-bit difference hash (dHash) of the
+  decoded image, so re-compressed/resized copies (WhatsApp re-encodes media)
+  hit as long as the Hamming distance is at most ``phash_distance``. PDFs are
+  only matched by content. Keep the distance small: two different forms from
+  the same template can have close thumbnails.
+
+Entries live in one SQLite database (WAL) shared by every worker on the host,
+with a small in-memory LRU in front of it. The database is bounded by the total
+size of stored text; least recently used rows are evicted first. ``version``
+is part of every key and is stored with every row, and perceptual matches only
+consider rows of the current version, so a change to the OCR pipeline leaves
+old rows to age out.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("medical-chatbot")
+
+PHASH_SIZE = 16  # 16x16 gradient bits = 256-bit hash
+
+CacheKeys = Tuple[str, Optional[bytes]]  # (content key, perceptual hash or None)
+
+
+def content_key(path: str, version: str = "") -> str:
+    h = hashlib.sha256(version.encode("utf-8") + b"\0")
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def perceptual_hash(path: str) -> Optional[bytes]:
+    """dHash of the grayscale image; None for files PIL cannot decode (PDFs, ...)."""
+    try:
+        from PIL import Image
+
+        with Image.open(path) as img:
+            img.draft("L", (PHASH_SIZE * 16, PHASH_SIZE * 16))  # JPEG: decode at reduced scale
+            small = img.convert("L").resize((PHASH_SIZE + 1, PHASH_SIZE), Image.BILINEAR)
+        px = np.asarray(small, dtype=np.int16)
+        return np.packbits(px[:, 1:] > px[:, :-1]).tobytes()
+    except Exception:
+        return None
+
+
+class OCRCache:
+    def __init__(self, path: str, max_bytes: int = 64 << 20, mode: str = "content", phash_distance: int = 4,
+                 memory_entries: int = 512, version: str = "1"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.phash_distance = phash_distance
+        self.memory_entries = memory_entries
+        self.version = version
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        # perceptual index: row keys + (n, 32) uint8 hashes, reloaded when the db changes
+        self._phash_keys = []
+        self._phash_matrix = np.zeros((0, PHASH_SIZE * PHASH_SIZE // 8), dtype=np.uint8)
+        self._phash_dirty = True
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)) or ".", exist_ok=True)
+        self._conn().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS ocr_cache (
+                key TEXT PRIMARY KEY,
+                phash BLOB,
+                version TEXT,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_ocr_cache_used ON ocr_cache(last_used);
+            """
+        )
+        self._migrate()
+
+    def _migrate(self):
+        # databases from before the version column: their rows have no version, so they are
+        # never matched perceptually (content keys already include the version)
+        conn = self._conn()
+        if "version" not in [r[1] for r in conn.execute("PRAGMA table_info(ocr_cache)")]:
+            try:
+                conn.execute("ALTER TABLE ocr_cache ADD COLUMN version TEXT")
+            except sqlite3.OperationalError as e:  # another worker added it first
+                if "duplicate column" not in str(e):
+                    raise
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, text: str):
+        with self._lock:
+            self._lru[key] = text
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.memory_entries:
+                self._lru.popitem(last=False)
+
+    def _touch(self, key: str):
+        try:
+            self._conn().execute("UPDATE ocr_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            logger.debug("OCR cache touch failed: %s", e)
+
+    def _perceptual_match(self, phash: bytes) -> Optional[str]:
+        conn = self._conn()
+        # data_version only compares within one connection (it moves when any other connection,
+        # in this worker or another, commits), so each thread keeps the value its own connection
+        # showed last; a connection seen for the first time cannot vouch for the matrix
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        seen = getattr(self._local, "data_version", None)
+        self._local.data_version = data_version
+        with self._lock:
+            if self._phash_dirty or data_version != seen:
+                rows = conn.execute("SELECT key, phash FROM ocr_cache WHERE phash IS NOT NULL AND version = ?",
+                                    (self.version,)).fetchall()
+                self._phash_keys = [r[0] for r in rows]
+                self._phash_matrix = (np.frombuffer(b"".join(r[1] for r in rows), dtype=np.uint8)
+                                      .reshape(len(rows), -1) if rows else self._phash_matrix[:0])
+                self._phash_dirty = False
+            if not self._phash_keys:
+                return None
+            q = np.frombuffer(phash, dtype=np.uint8)
+            dist = np.unpackbits(self._phash_matrix ^ q, axis=1).sum(axis=1)
+            best = int(np.argmin(dist))
+            if dist[best] > self.phash_distance:
+                return None
+            return self._phash_keys[best]
+
+    # ---- API ----
+    def lookup(self, path: str) -> Tuple[Optional[str], Optional[CacheKeys]]:
+        """
+        Returns (text or None, keys). Pass ``keys`` to ``store`` after a miss so the
+        file is not hashed twice. keys is None if the file cannot be read.
+        """
+        try:
+            key = content_key(path, self.version)
+        except OSError:
+            return None, None
+        with self._lock:
+            text = self._lru.get(key)
+            if text is not None:
+                self._lru.move_to_end(key)
+                self.memory_hits += 1
+                return text, (key, None)
+
+        row = self._conn().execute("SELECT text FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._touch(key)
+            self._remember(key, row[0])
+            with self._lock:
+                self.disk_hits += 1
+            return row[0], (key, None)
+
+        phash = perceptual_hash(path) if self.mode == "perceptual" else None
+        if phash is not None:
+            match = self._perceptual_match(phash)
+            if match is not None:
+                row = self._conn().execute("SELECT text FROM ocr_cache WHERE key = ?", (match,)).fetchone()
+                if row is not None:
+                    self._touch(match)
+                    self._remember(key, row[0])
+                    with self._lock:
+                        self.perceptual_hits += 1
+                    return row[0], (key, phash)
+
+        with self._lock:
+            self.misses += 1
+        return None, (key, phash)
+
+    def store(self, keys: Optional[CacheKeys], text: str):
+        if keys is None:
+            return
+        key, phash = keys
+        size = len(text.encode("utf-8"))
+        self._remember(key, text)
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, phash, version, text, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, phash, self.version, text, size, time.time()),
+            )
+            with self._lock:
+                self._phash_dirty = self._phash_dirty or phash is not None
+            self._evict(conn)
+        except sqlite3.Error as e:
+            logger.warning("OCR cache write failed: %s", e)
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)  # evict in batches, not one row per insert
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM ocr_cache ORDER BY last_used"):
+            if total <= target:
+                break
+            victims.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM ocr_cache WHERE key = ?", victims)
+        with self._lock:
+            for (key,) in victims:
+                self._lru.pop(key, None)
+            self.evictions += len(victims)
+            self._phash_dirty = True
+
+    def stats(self) -> Dict:
+        entries, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits + self.perceptual_hits
+            lookups = hits + self.misses
+            return {
+                "mode": self.mode,
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "memory_entries": len(self._lru),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "perceptual_hits": self.perceptual_hits,
+                "misses": self.misses,
+                "hit_ratio": (hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,614 @@
+"""
+OCR service: image/PDF text extraction in a dedicated process pool.
+
+OpenCV preprocessing and Tesseract are CPU bound and hold a request thread
+for seconds on large photos. ``OCRService`` moves them into worker processes:
+
+- the pool is sized to the cores and created lazily in the process that uses it
+  (so forked gunicorn workers each get their own);
+- submissions go through a bounded queue (``max_queue`` jobs queued or running);
+  callers wait up to ``submit_timeout`` for a slot, then get ``OCRQueueFull``;
+- every job has a deadline counted from submission: time left is passed to
+  Tesseract as its timeout (pytesseract kills the tesseract process), jobs that
+  waited past their deadline are skipped, and the caller stops waiting; a job
+  still running past it (runaway preprocessing or rasterising) gets its pool
+  recycled, so it cannot hold a worker and a queue slot indefinitely;
+- images go through the adaptive preprocessing of src/ocr_preprocess.py
+  (``preprocess`` options, or {"mode": "legacy"});
+- PDFs are split into page batches that run in parallel; pages without a
+  text layer are rasterised and OCR'd, text is yielded page by page
+  (``iter_pdf_text``) and capped by page count and bytes;
+- ``extract_many`` runs several media items in parallel;
+- with an ``OCRCache`` (src/ocr_cache.py), files seen before skip the pool.
+
+The job functions at the top of the module run inside the workers.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.ocr_cache import OCRCache
+from src.ocr_preprocess import DEFAULT_PSM, OCRPreprocessor, legacy_preprocess
+
+logger = logging.getLogger("medical-chatbot")
+
+TESSERACT_CONFIG = "--oem 3"  # --psm is chosen per image (src/ocr_preprocess.py)
+# bump when preprocessing changes so cached results (src/ocr_cache.py) are not reused
+OCR_PIPELINE_VERSION = "3"
+
+
+class OCRQueueFull(RuntimeError):
+    pass
+
+
+# ---------------- job side (worker processes) ----------------
+def _remaining(deadline: Optional[float]) -> float:
+    """Seconds left for pytesseract's ``timeout`` (0 disables it)."""
+    if deadline is None:
+        return 0
+    left = deadline - time.time()
+    if left <= 0:
+        raise TimeoutError("OCR deadline exceeded")
+    return left
+
+
+_preprocessors: Dict[Tuple, OCRPreprocessor] = {}  # per worker process, by options
+
+
+def _preprocessor(options: Dict) -> OCRPreprocessor:
+    key = tuple(sorted(options.items()))
+    pre = _preprocessors.get(key)
+    if pre is None:
+        pre = _preprocessors[key] = OCRPreprocessor.from_options(options)
+    return pre
+
+
+def _tesseract(image, psm: int, deadline: Optional[float]) -> str:
+    import pytesseract
+
+    config = f"{TESSERACT_CONFIG} --psm {psm}"
+    try:
+        return pytesseract.image_to_string(image, config=config, timeout=_remaining(deadline)).strip()
+    except RuntimeError as e:
+        if "timeout" in str(e).lower():
+            raise TimeoutError(str(e))
+        raise
+
+
+def extract_text_from_image(image_path: str, deadline: Optional[float] = None,
+                            preprocess: Optional[Dict] = None) -> str:
+    """
+    ``preprocess``: OCRPreprocessor options, or {"mode": "legacy"} for the old
+    full-resolution path. If preprocessing fails the plain grayscale image
+    (decoded at reduced size) is OCR'd instead; a Tesseract failure is not retried.
+    """
+    options = dict(preprocess or {})
+    legacy = options.pop("mode", "adaptive") == "legacy"
+    pre = _preprocessor({} if legacy else options)
+    try:
+        image, psm = (legacy_preprocess(image_path), DEFAULT_PSM) if legacy else pre.process(image_path)
+    except Exception:
+        image, psm = pre.decode(image_path), DEFAULT_PSM
+    return _tesseract(image, psm, deadline)
+
+
+def _ocr_array(gray, deadline: Optional[float], preprocess: Optional[Dict]) -> str:
+    """OCR an in-memory grayscale image (rasterised or embedded PDF page)."""
+    import cv2
+
+    options = dict(preprocess or {})
+    if options.pop("mode", "adaptive") == "legacy":
+        gray = cv2.GaussianBlur(gray, (3, 3), 0)
+        image, psm = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1], DEFAULT_PSM
+    else:
+        pre = _preprocessor(options)
+        gray = pre.fit(gray)
+        try:
+            image, psm = pre.process_array(gray)
+        except Exception:
+            image, psm = gray, DEFAULT_PSM
+    return _tesseract(image, psm, deadline)
+
+
+class _PageRasterizer:
+    """
+    Grayscale image of a PDF page: rendered with pypdfium2 when installed,
+    otherwise the largest image embedded in the page (scanned PDFs are usually
+    one full-page image per page).
+    """
+
+    def __init__(self, path: str, dpi: int):
+        self.path = path
+        self.dpi = dpi
+        self._doc = None
+        try:
+            import pypdfium2
+            self._pdfium = pypdfium2
+        except ImportError:
+            self._pdfium = None
+
+    def render(self, page) -> Optional[np.ndarray]:
+        if self._pdfium is not None:
+            if self._doc is None:
+                self._doc = self._pdfium.PdfDocument(self.path)
+            bitmap = self._doc[page.page_number].render(scale=self.dpi / 72.0, grayscale=True)
+            return np.asarray(bitmap.to_pil().convert("L"))
+        best = None
+        for img in page.images:
+            try:
+                pil = img.image
+            except Exception:
+                continue
+            if pil is not None and (best is None or pil.width * pil.height > best.width * best.height):
+                best = pil
+        return np.asarray(best.convert("L")) if best is not None else None
+
+    def close(self):
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+
+
+def extract_pdf_pages(path: str, pages: Sequence[int], deadline: Optional[float] = None,
+                      preprocess: Optional[Dict] = None, raster_dpi: int = 200,
+                      min_text_chars: int = 20) -> List[Tuple[int, str]]:
+    """
+    [(page index, text)] for ``pages``. Pages whose text layer has fewer than
+    ``min_text_chars`` characters are treated as scanned and OCR'd.
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    raster = _PageRasterizer(path, raster_dpi)
+    out = []
+    try:
+        for i in pages:
+            page = reader.pages[i]
+            try:
+                text = (page.extract_text() or "").strip()
+            except Exception:
+                text = ""
+            if len(text) < min_text_chars:
+                _remaining(deadline)
+                try:
+                    image = raster.render(page)
+                except Exception:
+                    image = None  # unrenderable page: keep whatever text layer it had
+                if image is not None:
+                    text = _ocr_array(image, deadline, preprocess) or text
+            out.append((i, text))
+    finally:
+        raster.close()
+    return out
+
+
+def pdf_page_count(path: str) -> int:
+    from pypdf import PdfReader
+
+    return len(PdfReader(path).pages)
+
+
+def is_pdf(path: str) -> bool:
+    return path.lower().endswith(".pdf")
+
+
+def extract_text(path: str, deadline: Optional[float] = None, preprocess: Optional[Dict] = None) -> str:
+    if is_pdf(path):
+        pages = extract_pdf_pages(path, range(pdf_page_count(path)), deadline, preprocess)
+        return "\n".join(t for _, t in pages if t).strip()
+    return extract_text_from_image(path, deadline, preprocess)
+
+
+def run_job(path: str, deadline: Optional[float], tesseract_cmd: Optional[str],
+            preprocess: Optional[Dict] = None) -> Tuple[str, float, Optional[str]]:
+    """Worker entry point. Returns (text, started_at, error)."""
+    started = time.time()
+    try:
+        if tesseract_cmd:
+            import pytesseract
+            pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+        _remaining(deadline)  # waited in the queue past the deadline: skip
+        return extract_text(path, deadline, preprocess), started, None
+    except TimeoutError as e:
+        return "", started, f"timeout: {e}"
+    except Exception as e:
+        return "", started, f"{type(e).__name__}: {e}"
+
+
+def run_pdf_job(path: str, pages: Sequence[int], deadline: Optional[float], tesseract_cmd: Optional[str],
+                preprocess: Optional[Dict], raster_dpi: int, min_text_chars: int):
+    """Worker entry point for a batch of PDF pages. Returns ([(page, text)], started_at, error)."""
+    started = time.time()
+    try:
+        if tesseract_cmd:
+            import pytesseract
+            pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+        _remaining(deadline)
+        return extract_pdf_pages(path, pages, deadline, preprocess, raster_dpi, min_text_chars), started, None
+    except TimeoutError as e:
+        return [], started, f"timeout: {e}"
+    except Exception as e:
+        return [], started, f"{type(e).__name__}: {e}"
+
+
+# ---------------- service side (web process) ----------------
+class OCRService:
+    def __init__(self, workers: Optional[int] = None, max_queue: Optional[int] = None, deadline: float = 20.0,
+                 submit_timeout: float = 2.0, tesseract_cmd: Optional[str] = None, start_method: str = "spawn",
+                 cache: Optional[OCRCache] = None, preprocess: Optional[Dict] = None,
+                 pdf_max_pages: int = 50, pdf_max_bytes: int = 200_000, pdf_pages_per_job: int = 2,
+                 pdf_deadline: float = 90.0, pdf_raster_dpi: int = 200, pdf_min_text_chars: int = 20):
+        self.workers = workers or os.cpu_count() or 2
+        self.max_queue = max_queue or self.workers * 4
+        self.deadline = deadline
+        self.submit_timeout = submit_timeout
+        self.tesseract_cmd = tesseract_cmd
+        self.start_method = start_method
+        self.cache = cache
+        self.preprocess = preprocess
+        self.pdf_max_pages = pdf_max_pages
+        self.pdf_max_bytes = pdf_max_bytes
+        self.pdf_pages_per_job = max(1, pdf_pages_per_job)
+        self.pdf_deadline = pdf_deadline
+        self.pdf_raster_dpi = pdf_raster_dpi
+        self.pdf_min_text_chars = pdf_min_text_chars
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_pid: Optional[int] = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._lock = threading.Lock()
+        self._latencies: deque = deque(maxlen=512)    # submit -> result, seconds
+        self._queue_waits: deque = deque(maxlen=512)  # submit -> worker start
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0  # e.g. remaining PDF batches after the text cap was reached
+        self.abandoned = 0  # caller stopped waiting (job stuck past deadline + grace)
+        self.recycled = 0   # pools killed to free workers held by abandoned jobs
+        self.rejected = 0
+        self._job_pool: Dict[Future, ProcessPoolExecutor] = {}  # in-flight job -> the pool running it
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                import multiprocessing
+
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(self.start_method))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _reset_broken_pool(self, pool: ProcessPoolExecutor):
+        with self._pool_lock:
+            if self._pool is pool:
+                logger.warning("OCR process pool broken; recreating it")
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def _recycle_pool(self, pool: ProcessPoolExecutor):
+        """
+        Kill every worker of ``pool``. Only Tesseract honours the deadline, and a
+        running future cannot be cancelled, so this is the only way to get back a
+        worker stuck in a job past its deadline. The pool's other jobs fail with
+        BrokenProcessPool, which releases their slots; the next submission starts
+        a fresh pool.
+        """
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        processes = list((getattr(pool, "_processes", None) or {}).values())
+        for proc in processes:
+            proc.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            self.recycled += 1
+        logger.warning("OCR job ran past its deadline; recycled the pool (%d workers)", len(processes))
+
+    def _abandon(self, fut: Future):
+        """The caller gives up on ``fut``; a queued job is cancelled, a running one loses its pool."""
+        with self._lock:
+            self.abandoned += 1
+            pool = self._job_pool.get(fut)
+        if not fut.cancel() and pool is not None and not fut.done():
+            self._recycle_pool(pool)
+
+    def _image_job(self, path: str) -> tuple:
+        deadline = time.time() + self.deadline if self.deadline else None
+        return (run_job, path, deadline, self.tesseract_cmd, self.preprocess)
+
+    def _pdf_job(self, path: str, pages: Sequence[int], deadline: Optional[float]) -> tuple:
+        return (run_pdf_job, path, list(pages), deadline, self.tesseract_cmd, self.preprocess,
+                self.pdf_raster_dpi, self.pdf_min_text_chars)
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise OCRQueueFull(f"OCR queue full ({self.max_queue} jobs)")
+
+    def _submit_acquired(self, fn, *args) -> Future:
+        submitted_at = time.time()
+        with self._lock:
+            self.pending += 1
+            self.submitted += 1
+        pool = self._get_pool()
+        try:
+            fut = pool.submit(fn, *args)
+        except Exception:
+            self._reset_broken_pool(pool)
+            self._job_done(None, submitted_at, pool)
+            raise
+        with self._lock:
+            self._job_pool[fut] = pool
+        fut.add_done_callback(lambda f: self._job_done(f, submitted_at, pool))
+        return fut
+
+    def _job_done(self, fut: Optional[Future], submitted_at: float, pool: ProcessPoolExecutor):
+        self._slots.release()
+        with self._lock:
+            self._job_pool.pop(fut, None)
+        error = None
+        started = None
+        if fut is None or fut.cancelled():
+            error = "cancelled"
+        elif fut.exception() is not None:
+            error = repr(fut.exception())
+            if "BrokenProcessPool" in type(fut.exception()).__name__:
+                self._reset_broken_pool(pool)
+        else:
+            _, started, error = fut.result()
+        now = time.time()
+        with self._lock:
+            self.pending -= 1
+            self._latencies.append(now - submitted_at)
+            if started is not None:
+                self._queue_waits.append(started - submitted_at)
+            if error is None:
+                self.completed += 1
+            elif error.startswith("timeout"):
+                self.timeouts += 1
+            elif error == "cancelled":
+                self.cancelled += 1
+            else:
+                self.failed += 1
+        if error and not error.startswith("timeout") and error != "cancelled":
+            logger.warning("OCR job failed: %s", error)
+
+    # ---- API ----
+    def submit(self, path: str) -> Future:
+        """Queue one image; raises OCRQueueFull if no slot frees up within submit_timeout."""
+        self._acquire()
+        return self._submit_acquired(*self._image_job(path))
+
+    def _result(self, fut: Future, timeout: Optional[float]) -> Tuple[str, bool]:
+        """(text, ok); ok is False for failures and timeouts, which are not cached."""
+        try:
+            text, _, error = fut.result(timeout=timeout)
+        except FutureTimeout:
+            logger.warning("OCR job exceeded its deadline; giving up on it")
+            self._abandon(fut)
+            return "", False
+        if error:
+            logger.info("OCR returned no text (%s)", error)
+        return text, error is None
+
+    def _lookup(self, path: str):
+        if self.cache is None:
+            return None, None
+        try:
+            return self.cache.lookup(path)
+        except Exception as e:
+            logger.warning("OCR cache lookup failed: %s", e)
+            return None, None
+
+    def _store(self, keys, text: str, ok: bool):
+        if ok and keys is not None and self.cache is not None:
+            self.cache.store(keys, text)
+
+    def _wait_timeout(self) -> Optional[float]:
+        # small grace so a tesseract killed at the deadline can still report back
+        return self.deadline + 1.0 if self.deadline else None
+
+    # ---- PDFs ----
+    def iter_pdf_text(self, path: str, status: Optional[Dict] = None) -> Iterator[str]:
+        """
+        Yields page texts in page order as soon as each batch of pages is done.
+        Batches of ``pdf_pages_per_job`` pages run in parallel (at most one per
+        worker ahead of the consumer); pages without a text layer are rasterised
+        and OCR'd in the worker. Stops after ``pdf_max_pages`` pages or once
+        ``pdf_max_bytes`` of text were produced, cancelling the remaining batches.
+        ``status["complete"]`` is set to True only if every page was processed.
+        """
+        status = status if status is not None else {}
+        status["complete"] = False
+        try:
+            n_pages = pdf_page_count(path)
+        except Exception as e:
+            logger.warning("PDF not readable (%s): %s", path, e)
+            return
+        pages = list(range(min(n_pages, self.pdf_max_pages))) if self.pdf_max_pages else list(range(n_pages))
+        batches = deque(pages[i:i + self.pdf_pages_per_job] for i in range(0, len(pages), self.pdf_pages_per_job))
+        deadline = time.time() + self.pdf_deadline if self.pdf_deadline else None
+        in_flight: deque = deque()
+        budget = self.pdf_max_bytes or None
+        ok = len(pages) == n_pages
+        try:
+            while batches or in_flight:
+                while batches and len(in_flight) < self.workers:
+                    if in_flight:
+                        if not self._slots.acquire(blocking=False):
+                            break  # queue busy: retry once a batch of ours has finished
+                    else:
+                        try:
+                            self._acquire()
+                        except OCRQueueFull as e:
+                            logger.warning("%s; dropping the remaining pages of %s", e, path)
+                            return
+                    in_flight.append(self._submit_acquired(*self._pdf_job(path, batches.popleft(), deadline)))
+                fut = in_flight.popleft()
+                wait = max(0.0, deadline + 1.0 - time.time()) if deadline else None
+                try:
+                    results, _, error = fut.result(timeout=wait)
+                except FutureTimeout:
+                    logger.warning("PDF OCR exceeded its deadline; returning the pages done so far")
+                    self._abandon(fut)
+                    return
+                if error:
+                    ok = False
+                    logger.info("PDF pages failed (%s)", error)
+                for _, text in results:
+                    if not text:
+                        continue
+                    if budget is not None:
+                        data = text.encode("utf-8")
+                        if len(data) >= budget:
+                            yield data[:budget].decode("utf-8", "ignore")
+                            logger.info("PDF text cap (%d bytes) reached for %s", self.pdf_max_bytes, path)
+                            return
+                        budget -= len(data)
+                    yield text
+            status["complete"] = ok
+        finally:
+            for fut in in_flight:
+                fut.cancel()
+
+    def _extract_pdf(self, path: str, keys) -> str:
+        status: Dict = {}
+        text = "\n".join(self.iter_pdf_text(path, status)).strip()
+        # truncated/partial extractions are not cached
+        self._store(keys, text, status["complete"])
+        return text
+
+    def extract_stream(self, path: str) -> Iterator[str]:
+        """Incremental variant of ``extract``: PDFs page by page, images as one piece."""
+        cached, keys = self._lookup(path)
+        if cached is not None:
+            yield cached
+            return
+        if not is_pdf(path):
+            yield self.extract(path)
+            return
+        status: Dict = {}
+        parts = []
+        for text in self.iter_pdf_text(path, status):
+            parts.append(text)
+            yield text
+        self._store(keys, "\n".join(parts).strip(), status["complete"])
+
+    # ---- any file ----
+    def extract(self, path: str) -> str:
+        """Blocking: text of one image/PDF, "" on failure, timeout or a full queue."""
+        cached, keys = self._lookup(path)
+        if cached is not None:
+            return cached
+        if is_pdf(path):
+            return self._extract_pdf(path, keys)
+        try:
+            fut = self.submit(path)
+        except OCRQueueFull as e:
+            logger.warning("%s; skipping %s", e, path)
+            return ""
+        text, ok = self._result(fut, self._wait_timeout())
+        self._store(keys, text, ok)
+        return text
+
+    def extract_many(self, paths: Sequence[str]) -> List[str]:
+        """Submit every image first, then handle PDFs and collect; results keep the input order."""
+        out: List[Optional[str]] = []
+        jobs = []  # (index, future, cache keys)
+        pdfs = []  # (index, path, cache keys)
+        for i, p in enumerate(paths):
+            cached, keys = self._lookup(p)
+            out.append(cached)
+            if cached is not None:
+                continue
+            if is_pdf(p):
+                pdfs.append((i, p, keys))
+                continue
+            try:
+                jobs.append((i, self.submit(p), keys))
+            except OCRQueueFull as e:
+                logger.warning("%s; skipping %s", e, p)
+                out[i] = ""
+        for i, p, keys in pdfs:
+            out[i] = self._extract_pdf(p, keys)
+        end = time.time() + self._wait_timeout() if self.deadline else None
+        for i, fut, keys in jobs:
+            text, ok = self._result(fut, max(0.0, end - time.time()) if end else None)
+            self._store(keys, text, ok)
+            out[i] = text
+        return out
+
+    async def extract_async(self, path: str) -> str:
+        """Event-loop variant of ``extract``: waits for a queue slot without blocking the loop."""
+        cached, keys = (await asyncio.to_thread(self._lookup, path)) if self.cache is not None else (None, None)
+        if cached is not None:
+            return cached
+        if is_pdf(path):
+            return await asyncio.to_thread(self._extract_pdf, path, keys)
+        give_up = time.monotonic() + self.submit_timeout
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= give_up:
+                with self._lock:
+                    self.rejected += 1
+                logger.warning("OCR queue full (%d jobs); skipping %s", self.max_queue, path)
+                return ""
+            await asyncio.sleep(0.05)
+        fut = self._submit_acquired(*self._image_job(path))
+        try:
+            text, _, error = await asyncio.wait_for(asyncio.wrap_future(fut), self._wait_timeout())
+        except asyncio.TimeoutError:
+            logger.warning("OCR job exceeded its deadline; giving up on it")
+            self._abandon(fut)
+            return ""
+        if error:
+            logger.info("OCR returned no text (%s)", error)
+        elif keys is not None:
+            await asyncio.to_thread(self._store, keys, text, True)
+        return text
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lat = sorted(self._latencies)
+            waits = sorted(self._queue_waits)
+            pending = self.pending
+
+            def pct(values, q):
+                return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 1) if values else None
+
+            return {
+                "workers": self.workers,
+                "pool_started": self._pool is not None and self._pool_pid == os.getpid(),  # spawned lazily
+                "max_queue": self.max_queue,
+                "deadline_s": self.deadline,
+                "in_flight": pending,
+                "queue_depth": max(0, pending - self.workers),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timeouts": self.timeouts,
+                "cancelled": self.cancelled,
+                "abandoned": self.abandoned,
+                "recycled": self.recycled,
+                "rejected": self.rejected,
+                "latency_ms": {"p50": pct(lat, 0.5), "p95": pct(lat, 0.95), "max": pct(lat, 1.0)},
+                "queue_wait_ms": {"p50": pct(waits, 0.5), "p95": pct(waits, 0.95)},
+            }
+
+    def cache_stats(self) -> Optional[Dict]:
+        return self.cache.stats() if self.cache is not None else None
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
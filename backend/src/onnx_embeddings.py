@@ -0,0 +1,144 @@
+"""
+ONNX Runtime embedding backend (no torch).
+
+Runs an ONNX export of ``sentence-transformers/all-MiniLM-L6-v2`` -- the
+fp32 graph or an int8 dynamically-quantized one -- with the model's own
+``tokenizer.json`` (HF ``tokenizers``, Rust). Pooling matches the
+sentence-transformers pipeline of that model (mask-aware mean pooling + L2
+normalisation, 256 tokens max), so vectors stay compatible with the existing
+384-dim index; ``index_parity`` checks that against stored vectors.
+
+The model repo on the Hub already ships the exports (``onnx/model.onnx``,
+``onnx/model_quint8_avx2.onnx``, ...); a local directory with ``model.onnx``
+(or any ``*.onnx``) and ``tokenizer.json`` works too, and ``quantize_model``
+produces the int8 file from an fp32 export.
+"""
+import os
+import glob
+import logging
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    from langchain_core.embeddings import Embeddings as _EmbeddingsBase
+except Exception:
+    _EmbeddingsBase = object
+
+logger = logging.getLogger("medical-chatbot")
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_FILES = {
+    "onnx": "onnx/model.onnx",
+    "onnx-int8": "onnx/model_quint8_avx2.onnx",
+}
+
+
+def _resolve(model: str, filename: str, cache_dir: Optional[str] = None):
+    """(onnx path, tokenizer.json path) from a local directory or a Hub repo id."""
+    if os.path.isdir(model):
+        candidates = [os.path.join(model, filename), os.path.join(model, os.path.basename(filename))]
+        onnx_path = next((p for p in candidates if os.path.exists(p)), None)
+        if onnx_path is None:
+            found = sorted(glob.glob(os.path.join(model, "**", "*.onnx"), recursive=True))
+            if not found:
+                raise FileNotFoundError(f"No .onnx file in {model}")
+            onnx_path = found[0]
+        tok_path = os.path.join(model, "tokenizer.json")
+        if not os.path.exists(tok_path):
+            raise FileNotFoundError(f"No tokenizer.json in {model}")
+        return onnx_path, tok_path
+    from huggingface_hub import hf_hub_download
+
+    return (hf_hub_download(model, filename, cache_dir=cache_dir),
+            hf_hub_download(model, "tokenizer.json", cache_dir=cache_dir))
+
+
+class OnnxEmbeddings(_EmbeddingsBase):
+    def __init__(self, model: str = DEFAULT_MODEL, variant: str = "onnx", filename: Optional[str] = None,
+                 max_length: int = 256, batch_size: int = 32, threads: Optional[int] = None,
+                 cache_dir: Optional[str] = None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_name = model
+        self.variant = variant
+        self.batch_size = batch_size
+        onnx_path, tok_path = _resolve(model, filename or ONNX_FILES[variant], cache_dir)
+        self.onnx_path = onnx_path
+
+        self.tokenizer = Tokenizer.from_file(tok_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.no_padding()  # padded per batch below
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            opts.intra_op_num_threads = threads
+            opts.inter_op_num_threads = 1
+        # no arena growth across odd batch shapes; keeps worker RSS flat
+        opts.enable_cpu_mem_arena = False
+        self.session = ort.InferenceSession(onnx_path, sess_options=opts, providers=["CPUExecutionProvider"])
+        self._inputs = {i.name for i in self.session.get_inputs()}
+        logger.info("ONNX embeddings: %s (%s)", onnx_path, variant)
+
+    def _forward(self, texts: Sequence[str]) -> np.ndarray:
+        encs = self.tokenizer.encode_batch(list(texts))
+        width = max(len(e.ids) for e in encs)
+        ids = np.zeros((len(encs), width), dtype=np.int64)
+        mask = np.zeros((len(encs), width), dtype=np.int64)
+        for i, e in enumerate(encs):
+            ids[i, :len(e.ids)] = e.ids
+            mask[i, :len(e.ids)] = 1
+        feed = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self._inputs:
+            feed["token_type_ids"] = np.zeros_like(ids)
+        hidden = self.session.run(None, feed)[0]  # (batch, tokens, dim)
+        m = mask[:, :, None].astype(np.float32)
+        pooled = (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        # batch texts of similar length together: less padding per forward pass
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            for row, vec in zip(rows, self._forward([texts[i] for i in rows]).tolist()):
+                out[row] = vec
+        return out
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._forward([text])[0].tolist()
+
+
+def quantize_model(src: str, dst: str) -> str:
+    """Dynamic int8 quantization of an fp32 ONNX export (weights int8, activations quantized at runtime)."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(os.path.dirname(os.path.abspath(dst)) or ".", exist_ok=True)
+    quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+    return dst
+
+
+def cosine_parity(a: Sequence[Sequence[float]], b: Sequence[Sequence[float]]) -> Dict[str, float]:
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    if a.shape != b.shape:
+        raise ValueError(f"dimension mismatch: {a.shape} vs {b.shape}")
+    cos = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + 1e-12)
+    return {"min": float(cos.min()), "mean": float(cos.mean()), "n": int(len(cos))}
+
+
+def index_parity(embeddings, index, sample: int = 16) -> Optional[Dict[str, float]]:
+    """
+    Re-embed ``sample`` chunks of a LocalVectorIndex and compare with the stored
+    vectors (which came from the ingestion backend). None if the index is empty.
+    """
+    if not index.count:
+        return None
+    rows = np.unique(np.linspace(0, index.count - 1, num=min(sample, index.count)).astype(np.int64))
+    texts = [index.chunk(int(r))["text"] for r in rows]
+    return cosine_parity(embeddings.embed_documents(texts), index.rows_float32(rows))
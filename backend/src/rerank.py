@@ -0,0 +1,177 @@
+"""
+Optional cross-encoder reranking of retrieved chunks (CPU).
+
+The retriever is asked for ``candidates`` chunks; a small cross-encoder scores
+every (question, chunk) pair in one batched forward pass and the best ``k``
+are kept. Each request has a hard time budget: when scoring does not finish
+in time, or every scoring slot is busy, or the model has not finished loading,
+the retriever order is used instead. Scoring that overran keeps running in the
+background (a forward pass cannot be interrupted) but holds a slot, so an
+overloaded host degrades to plain retrieval instead of queueing.
+
+Latency is recorded per batch size (``stats()``) to tune ``candidates``
+against the budget.
+"""
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict, List, Optional, Sequence
+
+logger = logging.getLogger("medical-chatbot")
+
+DEFAULT_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+def _percentile(values: Sequence[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_name: str = DEFAULT_MODEL, budget: float = 0.15, max_length: int = 256,
+                 max_chars: int = 1200, workers: int = 1, torch_threads: Optional[int] = None,
+                 samples: int = 256):
+        self.model_name = model_name
+        self.budget = budget
+        self.max_length = max_length
+        self.max_chars = max_chars
+        self.torch_threads = torch_threads
+        self.model = None
+        self.load_error: Optional[str] = None
+        self._load_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, workers))
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="rerank")
+        self._lock = threading.Lock()
+        self._latency: Dict[int, deque] = {}  # batch size -> recent scoring times (s)
+        self._samples = samples
+        self.calls = 0
+        self.reranked = 0
+        self.timeouts = 0
+        self.busy = 0
+        self.not_loaded = 0
+        self.errors = 0
+
+    # ---- model ----
+    def load(self):
+        """Load the model (blocking). Safe to call from several threads."""
+        with self._load_lock:
+            if self.model is not None or self.load_error:
+                return
+            try:
+                from sentence_transformers import CrossEncoder
+
+                if self.torch_threads:
+                    import torch
+                    torch.set_num_threads(self.torch_threads)
+                t = time.perf_counter()
+                model = CrossEncoder(self.model_name, max_length=self.max_length, device="cpu")
+                model.predict([("warm up", "warm up")], show_progress_bar=False)
+                self.model = model
+                logger.info("Reranker %s loaded in %.1fs", self.model_name, time.perf_counter() - t)
+            except Exception as e:
+                self.load_error = str(e)
+                logger.exception("Reranker load failed, using retriever order: %s", e)
+
+    def load_async(self):
+        threading.Thread(target=self.load, name="rerank-load", daemon=True).start()
+
+    # ---- scoring ----
+    def _score(self, query: str, texts: List[str]) -> List[float]:
+        try:
+            t = time.perf_counter()
+            scores = self.model.predict([(query, x) for x in texts], batch_size=len(texts),
+                                        show_progress_bar=False)
+            elapsed = time.perf_counter() - t
+            with self._lock:
+                self._latency.setdefault(len(texts), deque(maxlen=self._samples)).append(elapsed)
+            return [float(s) for s in scores]
+        finally:
+            self._slots.release()
+
+    def rerank(self, query: str, docs: Sequence, k: int) -> List:
+        """Best ``k`` of ``docs`` by cross-encoder score, or ``docs[:k]`` on any fallback."""
+        docs = list(docs)
+        with self._lock:
+            self.calls += 1
+        if len(docs) <= 1:
+            return docs[:k]
+        if self.model is None:
+            with self._lock:
+                self.not_loaded += 1
+            return docs[:k]
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.busy += 1
+            return docs[:k]
+        texts = [(getattr(d, "page_content", "") or "")[:self.max_chars] for d in docs]
+        try:
+            future = self._pool.submit(self._score, query, texts)
+        except Exception:
+            self._slots.release()
+            raise
+        try:
+            scores = future.result(timeout=self.budget)
+        except FutureTimeout:
+            with self._lock:
+                self.timeouts += 1
+            logger.info("Rerank over budget (%.0f ms, %d candidates); using retriever order",
+                        self.budget * 1000, len(docs))
+            return docs[:k]
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning("Rerank failed, using retriever order: %s", e)
+            return docs[:k]
+        with self._lock:
+            self.reranked += 1
+        order = sorted(range(len(docs)), key=lambda i: -scores[i])
+        return [docs[i] for i in order[:k]]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            by_size = {
+                str(n): {
+                    "count": len(v),
+                    "mean_ms": 1000 * sum(v) / len(v),
+                    "p50_ms": 1000 * _percentile(v, 0.5),
+                    "p95_ms": 1000 * _percentile(v, 0.95),
+                    "max_ms": 1000 * max(v),
+                }
+                for n, v in sorted(self._latency.items()) if v
+            }
+            return {
+                "model": self.model_name,
+                "loaded": self.model is not None,
+                "load_error": self.load_error,
+                "budget_ms": self.budget * 1000,
+                "calls": self.calls,
+                "reranked": self.reranked,
+                "timeouts": self.timeouts,
+                "busy": self.busy,
+                "not_loaded": self.not_loaded,
+                "errors": self.errors,
+                "latency_by_batch_size": by_size,
+            }
+
+
+class RerankingRetriever:
+    """Over-fetching retriever wrapper; same surface as the retrievers it wraps."""
+
+    def __init__(self, base, reranker: CrossEncoderReranker, k: int = 1):
+        self.base = base
+        self.reranker = reranker
+        self.k = k
+
+    def get_relevant_documents(self, query: str) -> List:
+        if hasattr(self.base, "invoke"):
+            docs = self.base.invoke(query)
+        else:
+            docs = self.base.get_relevant_documents(query)
+        return self.reranker.rerank(query, docs, self.k)
+
+    def invoke(self, query: str, config=None) -> List:
+        return self.get_relevant_documents(query)
@@ -0,0 +1,115 @@
+"""
+Sentence boundaries shared by the context packer and text-to-speech.
+
+A plain "split on every full stop" cuts medical text in the wrong places:
+"Take 2.5 mg" or "Dr. Rao advises" are one sentence. A boundary here is a run
+of ``. ! ?`` or a Devanagari danda (Hindi), with any closing quotes/brackets,
+followed by whitespace or the end of the text, or a newline. A full stop is
+not a boundary after a known abbreviation, after "etc." unless a capitalised
+word follows, or after a single capital letter (initials, "vitamin D." is the
+accepted cost).
+
+``sentence_spans`` returns offsets into the original text, so callers can keep
+the original whitespace between the sentences they keep.
+
+    python -m src.sentences    # self-check
+"""
+import re
+from typing import List, Tuple
+
+# titles and prescription shorthand that are followed by a full stop mid-sentence
+ABBREVIATIONS = frozenset({
+    "dr", "drs", "mr", "mrs", "ms", "prof", "sr", "jr", "st", "vs", "approx", "e.g", "i.e", "viz", "cf",
+    "tab", "tabs", "cap", "caps", "inj", "syr", "susp", "oint", "sig",
+})
+
+_END_RE = re.compile(r"[.!?।]+[\"')\]]*|\n")
+_WORD_BEFORE_RE = re.compile(r"([A-Za-z][A-Za-z.]*)$")
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def _is_boundary(text: str, start: int, end: int) -> bool:
+    if text[start] == "\n":
+        return True
+    if end < len(text) and not text[end].isspace():
+        return False  # 2.5, e.g, www.who.int, "?!" continuing into a word
+    if text[start:end] != ".":
+        return True
+    m = _WORD_BEFORE_RE.search(text, max(0, start - 32), start)
+    if not m:
+        return True
+    word = m.group(1)
+    if word.lower().strip(".") in ABBREVIATIONS:
+        return False
+    if len(word) == 1 and word.isupper():
+        return False
+    if word.lower() == "etc":
+        rest = text[end:].lstrip()
+        return not rest or rest[0].isupper()
+    return True
+
+
+def sentence_spans(text: str) -> List[Tuple[int, int]]:
+    """(start, end) of every sentence in ``text``, without surrounding whitespace."""
+    text = text or ""
+    spans: List[Tuple[int, int]] = []
+    start = 0
+    for m in _END_RE.finditer(text):
+        if not _is_boundary(text, m.start(), m.end()):
+            continue
+        _append(text, spans, start, m.end())
+        start = m.end()
+    _append(text, spans, start, len(text))
+    return spans
+
+
+def _append(text: str, spans: List[Tuple[int, int]], start: int, end: int):
+    piece = text[start:end]
+    stripped = piece.strip()
+    if stripped:
+        lead = start + len(piece) - len(piece.lstrip())
+        spans.append((lead, lead + len(stripped)))
+
+
+def split_sentences(text: str) -> List[str]:
+    return [text[a:b] for a, b in sentence_spans(text)]
+
+
+def number_at(text: str, pos: int) -> Tuple[int, int]:
+    """(start, end) of the number (2.5, 1,000) that ``pos`` falls strictly inside, else (pos, pos)."""
+    for m in _NUMBER_RE.finditer(text, max(0, pos - 64), pos + 64):
+        if m.start() < pos < m.end():
+            return m.span()
+    return pos, pos
+
+
+if __name__ == "__main__":
+    CASES = [
+        ("Take 2.5 mg twice daily. Do not exceed 10 mg.", ["Take 2.5 mg twice daily.", "Do not exceed 10 mg."]),
+        ("Paracetamol 0.5 g every 6 hours. Maximum 4 g/day.",
+         ["Paracetamol 0.5 g every 6 hours.", "Maximum 4 g/day."]),
+        ("Dr. Rao prescribed Tab. Metformin 500 mg. Review after 1.5 weeks.",
+         ["Dr. Rao prescribed Tab. Metformin 500 mg.", "Review after 1.5 weeks."]),
+        ("Avoid sugar, salt, etc. and walk daily. Fruits, nuts etc. Drink water!",
+         ["Avoid sugar, salt, etc. and walk daily.", "Fruits, nuts etc.", "Drink water!"]),
+        ("See www.who.int for details, e.g. dosing tables.", ["See www.who.int for details, e.g. dosing tables."]),
+        ("Is it safe? Yes.\nRest well", ["Is it safe?", "Yes.", "Rest well"]),
+        ("आराम करें। पानी पिएं।", ["आराम करें।", "पानी पिएं।"]),
+    ]
+    failed = 0
+    for text, want in CASES:
+        got = split_sentences(text)
+        if got != want:
+            failed += 1
+            print(f"FAIL {text!r}\n  want {want}\n  got  {got}")
+    assert number_at("dose 12.75 mg", 8) == (5, 10) and number_at("dose 12.75 mg", 10) == (10, 10)
+    from src.tts import split_segments  # the TTS segmenter must never cut inside a number
+
+    dose = "Take 2.5 mg. " + "x" * 30 + "12.75 mg"
+    for max_chars in range(4, 50):
+        segments = split_segments(dose, max_chars)
+        if [n for seg in segments for n in _NUMBER_RE.findall(seg)] != ["2.5", "12.75"]:
+            failed += 1
+            print(f"FAIL split_segments(max_chars={max_chars}) cut a number: {segments}")
+    print("sentence self-check " + (f"failed ({failed})" if failed else "passed"))
+    raise SystemExit(1 if failed else 0)
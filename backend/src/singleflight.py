@@ -0,0 +1,139 @@
+"""
+Single-flight request coalescing.
+
+When several callers ask for the same key while a computation for it is
+already running, only the first one (the leader) executes it; the others wait
+and receive the same result (or exception). Nothing is cached: once the leader
+finishes, the next call for that key starts a fresh computation. This collapses
+bursts of identical questions (a forwarded WhatsApp message, a retrying client)
+into one retrieval and one LLM call without serving stale answers.
+
+``SingleFlight`` is for the threaded Flask paths, ``AsyncSingleFlight`` for the
+ASGI app (asgi.py).
+"""
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+def make_key(*parts) -> str:
+    """Join key parts; strings are lowercased and whitespace-collapsed."""
+    out = []
+    for p in parts:
+        if isinstance(p, str):
+            p = " ".join(p.lower().split())
+        out.append(str(p))
+    return "\x1f".join(out)
+
+
+class _Stats:
+    def __init__(self):
+        self.calls = 0
+        self.leaders = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+
+    def snapshot(self, in_flight: int) -> Dict:
+        return {
+            "calls": self.calls,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "coalescing_ratio": (self.coalesced / self.calls) if self.calls else 0.0,
+            "in_flight": in_flight,
+            "max_waiters": self.max_waiters,
+        }
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._stats = _Stats()
+
+    def do(self, key: str, fn: Callable[[], Any], wait_timeout: Optional[float] = None) -> Any:
+        """
+        Run ``fn`` unless a call for ``key`` is in flight, in which case wait for it.
+        A follower that waits longer than ``wait_timeout`` seconds runs ``fn`` itself.
+        """
+        with self._lock:
+            self._stats.calls += 1
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self._stats.leaders += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self._stats.coalesced += 1
+                self._stats.max_waiters = max(self._stats.max_waiters, call.waiters)
+                leader = False
+
+        if not leader:
+            if not call.done.wait(wait_timeout):
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return self._stats.snapshot(len(self._calls))
+
+
+class AsyncSingleFlight:
+    """
+    Event-loop variant. The computation runs as its own task and every caller
+    (leader included) awaits it through ``asyncio.shield``, so a caller whose
+    client disconnects does not cancel the answer for the others.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self._stats = _Stats()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self._stats.calls += 1
+        task = self._tasks.get(key)
+        if task is None:
+            self._stats.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t, key=key: self._finished(key, t))
+        else:
+            self._stats.coalesced += 1
+            self._waiters[key] += 1
+            self._stats.max_waiters = max(self._stats.max_waiters, self._waiters[key])
+        return await asyncio.shield(task)
+
+    def _finished(self, key: str, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+            del self._waiters[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when every caller went away
+
+    def stats(self) -> Dict:
+        return self._stats.snapshot(len(self._tasks))
@@ -0,0 +1,84 @@
+"""
+Startup phase timings and component warm-up state.
+
+``StartupTimer`` records how long each startup phase took (imports, stores,
+embeddings, vector index, ...) so a slow cold start can be attributed; the
+breakdown is logged once and served by ``/readyz``. ``Components`` tracks
+which optional subsystems are warm in this process.
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+logger = logging.getLogger("medical-chatbot")
+
+
+class StartupTimer:
+    def __init__(self, start: Optional[float] = None):
+        self.start = start if start is not None else time.perf_counter()
+        self.pid = os.getpid()
+        self.phases: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def mark(self, name: str):
+        """Record the time since process start (or the previous mark) under ``name``."""
+        now = time.perf_counter()
+        with self._lock:
+            last = getattr(self, "_last_mark", self.start)
+            self._last_mark = now
+        self.record(name, now - last)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                "pid": self.pid,
+                "since_start_s": time.perf_counter() - self.start,
+                "phases_s": {k: round(v, 3) for k, v in self.phases.items()},
+            }
+
+    def log(self, title: str = "Startup"):
+        with self._lock:
+            parts = ", ".join(f"{k} {v:.2f}s" for k, v in self.phases.items())
+        logger.info("%s (pid %d, %.2fs since start): %s", title, os.getpid(), time.perf_counter() - self.start,
+                    parts or "-")
+
+
+class Components:
+    """name -> {"state": cold|loading|warm|failed|disabled, "detail", "seconds"} for /readyz."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state: Dict[str, Dict] = {}
+
+    def set(self, name: str, state: str, detail: Optional[str] = None, seconds: Optional[float] = None):
+        with self._lock:
+            entry = {"state": state}
+            if detail:
+                entry["detail"] = detail
+            if seconds is not None:
+                entry["seconds"] = round(seconds, 3)
+            self._state[name] = entry
+
+    def state(self, name: str) -> Optional[str]:
+        with self._lock:
+            entry = self._state.get(name)
+            return entry["state"] if entry else None
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {k: dict(v) for k, v in self._state.items()}
@@ -0,0 +1,426 @@
+"""
+Per-request span tracing and on-demand sampling profiles.
+
+Every request gets a ``Trace``: a tree of timed spans (``tracer.span("ocr")``)
+that follows the work onto other threads and tasks -- ``tracer.bind`` carries
+the current span into an executor job and keeps the trace open until the job
+returns, so a WhatsApp reply built on a background thread lands in the same
+tree as the webhook that queued it. A trace that took longer than
+``slow_seconds`` is logged with its whole tree and kept for
+``/api/traces/slow``.
+
+Spans are cheap (a ``perf_counter`` pair and a list append); outside a trace
+``span`` only times the block for the ``on_span`` callback (stage histograms).
+
+``SamplingProfiler`` samples the stacks of the threads that are working for a
+profiled trace (``sys._current_frames`` every few ms) and writes them, folded,
+to ``<dir>/<trace id>.folded`` (flamegraph.pl / speedscope input), next to the
+span tree as ``<trace id>.trace.json``. Sampling only runs while a profiled
+trace is open. On the event loop (asgi.py) the loop thread is shared, so its
+samples include whatever else the loop ran meanwhile.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from collections import Counter, deque
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger("medical-chatbot")
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("medibot_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "trace", "start", "end", "attrs", "children", "thread")
+
+    def __init__(self, name: str, trace: "Trace", start: float, attrs: Optional[Dict] = None):
+        self.name = name
+        self.trace = trace
+        self.start = start
+        self.end: Optional[float] = None
+        self.attrs = attrs or {}
+        self.children: List["Span"] = []
+        self.thread = threading.current_thread().name
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+    def to_dict(self, origin: float) -> Dict:
+        d = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": None if self.end is None else round((self.end - self.start) * 1000, 3),
+            "thread": self.thread,
+        }
+        if self.attrs:
+            d["attrs"] = self.attrs
+        if self.children:
+            d["children"] = [c.to_dict(origin) for c in self.children]
+        return d
+
+    def format(self, origin: float, indent: int = 0) -> List[str]:
+        took = "open" if self.end is None else f"{(self.end - self.start) * 1000:.1f} ms"
+        attrs = " ".join(f"{k}={v}" for k, v in self.attrs.items())
+        lines = [f"{'  ' * indent}{self.name} {took} (+{(self.start - origin) * 1000:.1f} ms, {self.thread})"
+                 + (f" {attrs}" if attrs else "")]
+        for c in self.children:
+            lines.extend(c.format(origin, indent + 1))
+        return lines
+
+
+class Trace:
+    def __init__(self, tracer: "Tracer", name: str, attrs: Optional[Dict] = None, profile: bool = False):
+        self.tracer = tracer
+        self.id = uuid.uuid4().hex[:16]
+        self.wall_start = time.time()
+        self.root = Span(name, self, time.perf_counter(), attrs)
+        self.profile = profile
+        self._lock = threading.Lock()
+        self._holds = 1  # the root span; bound jobs add one each
+        self._threads: Dict[int, int] = {}  # thread id -> open spans on it (profiler sampling set)
+
+    def add_child(self, parent: Span, span: Span):
+        with self._lock:
+            parent.children.append(span)
+
+    def hold(self):
+        with self._lock:
+            self._holds += 1
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+            done = self._holds == 0
+        if done:
+            self.tracer._finish(self)
+
+    def enter_thread(self):
+        tid = threading.get_ident()
+        with self._lock:
+            self._threads[tid] = self._threads.get(tid, 0) + 1
+
+    def exit_thread(self):
+        tid = threading.get_ident()
+        with self._lock:
+            n = self._threads.get(tid, 0) - 1
+            if n > 0:
+                self._threads[tid] = n
+            else:
+                self._threads.pop(tid, None)
+
+    def threads(self) -> List[int]:
+        with self._lock:
+            return list(self._threads)
+
+    @property
+    def duration(self) -> float:
+        # bound jobs can outlive the root span (reply sent after the webhook answered)
+        last = self.root.end if self.root.end is not None else time.perf_counter()
+        stack = list(self.root.children)
+        while stack:
+            span = stack.pop()
+            if span.end is not None and span.end > last:
+                last = span.end
+            stack.extend(span.children)
+        return last - self.root.start
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.id,
+            "name": self.root.name,
+            "started": self.wall_start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "profiled": self.profile,
+            "root": self.root.to_dict(self.root.start),
+        }
+
+    def format(self) -> str:
+        return "\n".join(self.root.format(self.root.start))
+
+
+class _SpanScope:
+    __slots__ = ("tracer", "name", "attrs", "start", "span", "token")
+
+    def __init__(self, tracer: "Tracer", name: str, attrs: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.span = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        parent = _current_span.get()
+        if parent is not None:
+            trace = parent.trace
+            self.span = Span(self.name, trace, self.start, self.attrs or None)
+            trace.add_child(parent, self.span)
+            self.token = _current_span.set(self.span)
+            if trace.profile:
+                trace.enter_thread()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        span = self.span
+        if span is not None:
+            span.end = end
+            if exc_type is not None:
+                span.attrs["error"] = exc_type.__name__
+            _current_span.reset(self.token)
+            if span.trace.profile:
+                span.trace.exit_thread()
+        if self.tracer.on_span is not None:
+            self.tracer.on_span(self.name, end - self.start)
+        return False
+
+
+class Tracer:
+    def __init__(self, slow_seconds: float = 5.0, keep: int = 50, enabled: bool = True,
+                 on_span: Optional[Callable[[str, float], None]] = None,
+                 profiler: Optional["SamplingProfiler"] = None):
+        self.slow_seconds = slow_seconds
+        self.enabled = enabled
+        self.on_span = on_span  # (name, seconds) for every span, traced or not
+        self.profiler = profiler
+        self.slow_traces: deque = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self.traces = 0
+        self.slow = 0
+        self.profiled = 0
+
+    # ---- request roots ----
+    def start(self, name: str, profile: bool = False, **attrs):
+        """Open a trace in the current context; returns a handle for ``finish`` (None when disabled)."""
+        if not self.enabled:
+            return None
+        profile = profile and self.profiler is not None
+        trace = Trace(self, name, attrs, profile)
+        token = _current_span.set(trace.root)
+        if profile:
+            trace.enter_thread()
+            self.profiler.begin(trace)
+        return trace, token
+
+    def finish(self, handle, **attrs):
+        if handle is None:
+            return
+        trace, token = handle
+        trace.root.end = time.perf_counter()
+        trace.root.attrs.update(attrs)
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            _current_span.set(None)  # finished from another context (streamed response)
+        if trace.profile:
+            trace.exit_thread()
+        trace.release()
+
+    def discard(self, handle):
+        """Close a trace without recording it (the request was handled elsewhere)."""
+        if handle is None:
+            return
+        trace, token = handle
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            _current_span.set(None)
+        if trace.profile:
+            trace.exit_thread()
+            self.profiler.cancel(trace)
+
+    def _finish(self, trace: Trace):
+        seconds = trace.duration
+        path = None
+        if trace.profile:
+            path = self.profiler.end(trace)
+        with self._lock:
+            self.traces += 1
+            if trace.profile:
+                self.profiled += 1
+            slow = seconds >= self.slow_seconds
+            if slow:
+                self.slow += 1
+                self.slow_traces.append(trace.to_dict())
+        if slow:
+            logger.warning("Slow request %s: %.1f ms [trace %s]\n%s", trace.root.name, seconds * 1000, trace.id,
+                           trace.format())
+        if path:
+            logger.info("Profile for %s (%.1f ms) written to %s", trace.root.name, seconds * 1000, path)
+
+    # ---- spans ----
+    def span(self, name: str, **attrs) -> _SpanScope:
+        return _SpanScope(self, name, attrs)
+
+    def record(self, name: str, start: float, end: Optional[float] = None, **attrs):
+        """Add an already-finished span (``perf_counter`` times) under the current one."""
+        end = time.perf_counter() if end is None else end
+        parent = _current_span.get()
+        if parent is not None:
+            span = Span(name, parent.trace, start, attrs or None)
+            span.end = end
+            parent.trace.add_child(parent, span)
+        if self.on_span is not None:
+            self.on_span(name, end - start)
+
+    def annotate(self, **attrs):
+        span = _current_span.get()
+        if span is not None:
+            span.attrs.update(attrs)
+
+    def current_trace_id(self) -> Optional[str]:
+        span = _current_span.get()
+        return span.trace.id if span is not None else None
+
+    # ---- crossing threads ----
+    def hold_current(self) -> Callable[[], None]:
+        """Keep the current trace open until the returned callable runs (background task)."""
+        span = _current_span.get()
+        if span is None:
+            return lambda: None
+        span.trace.hold()
+        return span.trace.release
+
+    def bind(self, fn: Callable, name: Optional[str] = None) -> Callable:
+        """
+        ``fn`` to run on another thread (executor job) inside the current trace,
+        as a child span ``name``; the trace stays open until it has run.
+        """
+        parent = _current_span.get()
+        if parent is None:
+            return fn
+        ctx = contextvars.copy_context()
+        parent.trace.hold()
+
+        def run(*args, **kwargs):
+            def inner():
+                try:
+                    if name:
+                        with self.span(name):
+                            return fn(*args, **kwargs)
+                    if parent.trace.profile:
+                        parent.trace.enter_thread()
+                        try:
+                            return fn(*args, **kwargs)
+                        finally:
+                            parent.trace.exit_thread()
+                    return fn(*args, **kwargs)
+                finally:
+                    parent.trace.release()
+
+            return ctx.run(inner)
+
+        return run
+
+    def bind_iter(self, iterable: Iterable, name: Optional[str] = None):
+        """Iterate ``iterable`` (a streamed response body) inside the current trace."""
+        parent = _current_span.get()
+        if parent is None:
+            yield from iterable
+            return
+        ctx = contextvars.copy_context()
+        parent.trace.hold()
+        start = time.perf_counter()
+        it = iter(iterable)
+        try:
+            while True:
+                try:
+                    item = ctx.run(next, it)
+                except StopIteration:
+                    break
+                yield item
+        finally:
+            close = getattr(it, "close", None)
+            if close is not None:
+                ctx.run(close)
+            if name:
+                ctx.run(self.record, name, start)
+            parent.trace.release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "slow_ms": self.slow_seconds * 1000,
+                "traces": self.traces,
+                "slow": self.slow,
+                "profiled": self.profiled,
+            }
+
+
+def _fold(frame, max_depth: int) -> str:
+    names = []
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self, directory: str = "profiles", interval: float = 0.005, max_depth: int = 64):
+        self.directory = directory
+        self.interval = interval
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._active: Dict[str, tuple] = {}  # trace id -> (trace, Counter of folded stacks)
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def begin(self, trace: Trace):
+        with self._lock:
+            self._active[trace.id] = (trace, Counter())
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+        self._wake.set()
+
+    def cancel(self, trace: Trace):
+        with self._lock:
+            self._active.pop(trace.id, None)
+
+    def end(self, trace: Trace) -> Optional[str]:
+        with self._lock:
+            entry = self._active.pop(trace.id, None)
+        if entry is None:
+            return None
+        stacks = entry[1]
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}_{trace.id}")
+            with open(base + ".folded", "w", encoding="utf-8") as f:
+                for stack, n in stacks.most_common():
+                    f.write(f"{stack} {n}\n")
+            with open(base + ".trace.json", "w", encoding="utf-8") as f:
+                json.dump({**trace.to_dict(), "samples": sum(stacks.values()),
+                           "interval_ms": self.interval * 1000}, f, indent=1)
+            return base + ".folded"
+        except OSError as e:
+            logger.warning("Could not write profile for trace %s: %s", trace.id, e)
+            return None
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                active = list(self._active.values())
+                if not active:
+                    self._wake.clear()
+            if not active:
+                self._wake.wait()
+                continue
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for trace, stacks in active:
+                for tid in trace.threads():
+                    frame = frames.get(tid)
+                    if frame is not None and tid != me:
+                        stacks[_fold(frame, self.max_depth)] += 1
+            del frames
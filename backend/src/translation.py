@@ -0,0 +1,224 @@
+"""
+Answer translation: "answer in Kannada" translates the sender's last answer
+instead of re-running retrieval and generation for the question.
+
+An answer is split into lines (bullets, paragraphs). Each line is cached by
+(backend, target language, text hash), so shared lines such as disclaimers and
+repeated answers cost nothing the second time. The lines that miss go to the
+backend together in one call.
+
+Backends (``load_backend``):
+
+- ``llm``: the chat model, one JSON-array prompt per batch;
+- ``google``: deep_translator's GoogleTranslator, lines joined into one request;
+- ``stub``: offline, prefixes the language code (tests and benchmarks);
+- ``package.module:Class``: anything with ``name`` and ``translate_batch``.
+"""
+import re
+import json
+import hashlib
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger("medical-chatbot")
+
+# code -> English name; English names, native names and bare codes parse (see parse_language)
+LANGUAGES = {
+    "en": "English", "hi": "Hindi", "kn": "Kannada", "ta": "Tamil", "te": "Telugu", "ml": "Malayalam",
+    "mr": "Marathi", "bn": "Bengali", "gu": "Gujarati", "pa": "Punjabi", "ur": "Urdu", "or": "Odia",
+    "es": "Spanish", "fr": "French", "de": "German", "ar": "Arabic", "zh-CN": "Chinese",
+}
+_NATIVE = {
+    "ಕನ್ನಡ": "kn", "हिंदी": "hi", "हिन्दी": "hi", "தமிழ்": "ta", "తెలుగు": "te", "മലയാളം": "ml",
+    "मराठी": "mr", "বাংলা": "bn", "ગુજરાતી": "gu", "ਪੰਜਾਬੀ": "pa", "اردو": "ur", "ଓଡ଼ିଆ": "or",
+}
+_NAMES = {**{n.lower(): c for c, n in LANGUAGES.items()},
+          "bangla": "bn", "oriya": "or", "chinese": "zh-CN", "mandarin": "zh-CN"}
+_CODES = {c.lower(): c for c in LANGUAGES}
+_WORD_RE = re.compile(r"[a-z]+")
+
+
+def parse_language(text: Optional[str]) -> Optional[str]:
+    """Language code named in ``text`` ("kannada", "in Hindi please", "ಕನ್ನಡ", "ta"), else None."""
+    t = (text or "").strip().lower()
+    if t in _CODES:  # a bare code; inside a sentence "or", "de", ... are just words
+        return _CODES[t]
+    for native, code in _NATIVE.items():
+        if native in t:
+            return code
+    for word in _WORD_RE.findall(t):
+        if word in _NAMES:
+            return _NAMES[word]
+    return None
+
+
+def language_name(code: str) -> str:
+    return LANGUAGES.get(code, code)
+
+
+# ---------------- backends ----------------
+class TranslationBackend:
+    """``translate_batch`` returns one translation per input, in order."""
+
+    name = "base"
+
+    def translate_batch(self, texts: List[str], target: str) -> List[str]:
+        raise NotImplementedError
+
+
+class LLMTranslator(TranslationBackend):
+    """
+    ``complete(system_message, user_message, max_tokens) -> str``. A batch is
+    sent as a JSON array and must come back as one; if the reply does not
+    parse, every line is translated on its own.
+    """
+
+    name = "llm"
+    SYSTEM = ("You are a medical translator. Translate faithfully, keep drug names, doses and numbers unchanged, "
+              "and keep any markdown, bullets and emoji.")
+
+    def __init__(self, complete: Callable[[str, str, int], str], max_tokens: int = 2000):
+        self.complete = complete
+        self.max_tokens = max_tokens
+
+    def translate_batch(self, texts: List[str], target: str) -> List[str]:
+        lang = language_name(target)
+        if len(texts) == 1:
+            return [self._one(texts[0], lang)]
+        prompt = (f"Translate each string in this JSON array to {lang}. Reply with only a JSON array of "
+                  f"{len(texts)} strings, in the same order.\n{json.dumps(texts, ensure_ascii=False)}")
+        reply = self.complete(self.SYSTEM, prompt, self.max_tokens)
+        try:
+            out = json.loads(reply[reply.index("["):reply.rindex("]") + 1])
+            if isinstance(out, list) and len(out) == len(texts) and all(isinstance(t, str) for t in out):
+                return out
+        except ValueError:
+            pass
+        logger.warning("Batch translation reply did not parse; translating %d lines one by one", len(texts))
+        return [self._one(t, lang) for t in texts]
+
+    def _one(self, text: str, lang: str) -> str:
+        prompt = f"Translate this to {lang}. Reply with only the translation.\n{text}"
+        return (self.complete(self.SYSTEM, prompt, self.max_tokens) or "").strip()
+
+
+class GoogleTranslateBackend(TranslationBackend):
+    """deep_translator (optional dependency); lines are joined so a batch is one request per ~4.5k chars."""
+
+    name = "google"
+    MAX_CHARS = 4500  # the endpoint rejects more than 5000
+
+    def __init__(self):
+        self._translators: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _translator(self, target: str):
+        with self._lock:
+            tr = self._translators.get(target)
+            if tr is None:
+                from deep_translator import GoogleTranslator
+
+                tr = self._translators[target] = GoogleTranslator(source="auto", target=target)
+            return tr
+
+    def translate_batch(self, texts: List[str], target: str) -> List[str]:
+        tr = self._translator(target)
+        out: List[str] = []
+        batch: List[str] = []
+        for text in texts + [None]:  # None flushes the last batch
+            if batch and (text is None or sum(map(len, batch)) + len(batch) + len(text) > self.MAX_CHARS):
+                joined = tr.translate("\n".join(batch)) or ""
+                lines = joined.split("\n")
+                if len(lines) != len(batch):  # the service merged or split lines
+                    lines = [tr.translate(t) or t for t in batch]
+                out.extend(lines)
+                batch = []
+            if text is not None:
+                batch.append(text)
+        return out
+
+
+class StubTranslator(TranslationBackend):
+    """Offline: ``[kn] original text``."""
+
+    name = "stub"
+
+    def translate_batch(self, texts: List[str], target: str) -> List[str]:
+        return [f"[{target}] {t}" for t in texts]
+
+
+def load_backend(spec: str, complete: Optional[Callable[[str, str, int], str]] = None,
+                 max_tokens: int = 2000) -> TranslationBackend:
+    """``llm`` (needs ``complete``) | ``google`` | ``stub`` | ``package.module:Class``."""
+    if spec == "llm":
+        if complete is None:
+            raise ValueError("The llm translation backend needs a completion function")
+        return LLMTranslator(complete, max_tokens=max_tokens)
+    if spec == "google":
+        return GoogleTranslateBackend()
+    if spec == "stub":
+        return StubTranslator()
+    module, _, cls = spec.partition(":")
+    if not cls:
+        raise ValueError(f"Unknown translation backend {spec!r} (use llm, google, stub or package.module:Class)")
+    return getattr(importlib.import_module(module), cls)()
+
+
+# ---------------- translator ----------------
+class Translator:
+    def __init__(self, backend: TranslationBackend, max_entries: int = 4096):
+        self.backend = backend
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+
+    def _key(self, text: str, target: str) -> str:
+        return hashlib.sha256(f"{self.backend.name}\0{target}\0{text}".encode("utf-8")).hexdigest()
+
+    def translate(self, text: str, target: str) -> str:
+        return self.translate_many([text], target)[0]
+
+    def translate_many(self, texts: List[str], target: str) -> List[str]:
+        """Every line of every text is looked up; all misses go to the backend in one batch."""
+        docs = [(t or "").split("\n") for t in texts]
+        lines = {line for doc in docs for line in doc if line.strip()}
+        done: Dict[str, str] = {}
+        with self._lock:
+            for line in lines:
+                key = self._key(line, target)
+                hit = self._cache.get(key)
+                if hit is not None:
+                    self._cache.move_to_end(key)
+                    done[line] = hit
+            self.hits += len(done)
+            self.misses += len(lines) - len(done)
+        todo = sorted(lines - done.keys())
+        if todo:
+            translated = self.backend.translate_batch(todo, target)
+            with self._lock:
+                self.calls += 1
+                for src, dst in zip(todo, translated):
+                    done[src] = dst
+                    self._cache[self._key(src, target)] = dst
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return ["\n".join(done.get(line, line) for line in doc) for doc in docs]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.backend.name,
+                "size": len(self._cache),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "backend_calls": self.calls,
+            }
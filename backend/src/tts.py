@@ -0,0 +1,292 @@
+"""
+Text-to-speech: sentence-level synthesis with a content-addressed audio cache.
+
+An answer is split into sentences, packed into segments of up to ``max_chars``.
+Each segment is synthesized on a small thread pool and cached on its own, keyed
+by a hash of (engine, lang, text). Then a repeated answer, or a new answer that
+shares sentences with an old one (disclaimers, greetings), only synthesizes
+what is new. MP3 frames concatenate, so segments are streamed to the client in
+order as they become ready, and playback starts after the first sentence
+instead of the whole answer.
+
+Engines are pluggable (``load_engine``): ``gtts`` (Google, needs network),
+``silent`` (valid silent MP3 of the speech's length, for offline tests), or any
+``package.module:Class`` with ``name`` and ``synthesize(text, lang) -> bytes``.
+
+Audio lives in one SQLite database (WAL) shared by every worker on the host,
+bounded by total audio bytes; least recently used rows are evicted first.
+"""
+import io
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import importlib
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, ContextManager, Dict, Iterator, List, Optional
+
+from src.sentences import number_at, split_sentences
+from src.singleflight import SingleFlight
+
+logger = logging.getLogger("medical-chatbot")
+
+_BREAK_RE = re.compile(r"[,;:]\s+|\s+")
+
+
+# ---------------- engines ----------------
+class TTSEngine:
+    """``synthesize`` returns MP3 bytes; it is called from several threads at once."""
+
+    name = "base"
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        raise NotImplementedError
+
+
+class GTTSEngine(TTSEngine):
+    name = "gtts"
+
+    def __init__(self, slow: bool = False):
+        self.slow = slow
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        from gtts import gTTS  # first TTS request pays the import, not startup
+
+        buf = io.BytesIO()
+        gTTS(text=text, lang=lang, slow=self.slow).write_to_fp(buf)
+        return buf.getvalue()
+
+
+class SilentEngine(TTSEngine):
+    """Silent MPEG-2 Layer III (16 kHz mono, 8 kbps) lasting about as long as reading ``text`` aloud."""
+
+    name = "silent"
+    CHARS_PER_SECOND = 15.0
+    FRAME = b"\xff\xf3\x18\xc0" + b"\x00" * 32  # 36-byte frame, 576 samples = 36 ms
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        frames = max(1, int(len(text) / self.CHARS_PER_SECOND / 0.036))
+        return self.FRAME * frames
+
+
+ENGINES = {"gtts": GTTSEngine, "silent": SilentEngine}
+
+
+def load_engine(spec: str) -> TTSEngine:
+    """``gtts`` | ``silent`` | ``package.module:Class`` (constructed without arguments)."""
+    if spec in ENGINES:
+        return ENGINES[spec]()
+    module, _, cls = spec.partition(":")
+    if not cls:
+        raise ValueError(f"Unknown TTS engine {spec!r} (use {', '.join(ENGINES)} or package.module:Class)")
+    return getattr(importlib.import_module(module), cls)()
+
+
+# ---------------- segmentation ----------------
+def split_segments(text: str, max_chars: int = 200) -> List[str]:
+    """
+    Sentences (src/sentences.py) packed into segments of at most ``max_chars``
+    (longer sentences are cut at a comma or space, never inside a number). The
+    first sentence stays on its own so the first audio is ready quickly.
+    """
+    pieces: List[str] = []
+    for s in split_sentences(text):
+        while len(s) > max_chars:
+            cut = max((m.end() for m in _BREAK_RE.finditer(s, 0, max_chars)), default=max_chars)
+            start, end = number_at(s, cut)
+            cut = start or end  # before the number, or after it if it starts the piece
+            pieces.append(s[:cut].strip())
+            s = s[cut:].strip()
+        if s:
+            pieces.append(s)
+    segments: List[str] = []
+    for p in pieces:
+        if len(segments) > 1 and len(segments[-1]) + 1 + len(p) <= max_chars:
+            segments[-1] += " " + p
+        else:
+            segments.append(p)
+    return segments
+
+
+def audio_key(engine: str, lang: str, text: str) -> str:
+    return hashlib.sha256(f"{engine}\0{lang}\0{text}".encode("utf-8")).hexdigest()
+
+
+# ---------------- cache ----------------
+class AudioCache:
+    def __init__(self, path: str, max_bytes: int = 128 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tts_cache (
+                key TEXT PRIMARY KEY,
+                audio BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_tts_cache_used ON tts_cache(last_used);
+            """
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            conn = self._conn()
+            row = conn.execute("SELECT audio FROM tts_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE tts_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            logger.warning("TTS cache read failed: %s", e)
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return bytes(row[0]) if row is not None else None
+
+    def put(self, key: str, audio: bytes):
+        try:
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO tts_cache (key, audio, size, last_used) VALUES (?, ?, ?, ?)",
+                         (key, sqlite3.Binary(audio), len(audio), time.time()))
+            self._evict(conn)
+        except sqlite3.Error as e:
+            logger.warning("TTS cache write failed: %s", e)
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tts_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)  # evict in batches, not one row per insert
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM tts_cache ORDER BY last_used"):
+            if total <= target:
+                break
+            victims.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM tts_cache WHERE key = ?", victims)
+        with self._lock:
+            self.evictions += len(victims)
+
+    def stats(self) -> Dict:
+        entries, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tts_cache").fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+# ---------------- service ----------------
+class TTSService:
+    """
+    ``stream(text, lang)`` yields MP3 bytes segment by segment, in order. At most
+    ``window`` segments of one request are queued or synthesizing at a time, so a
+    long answer cannot take the whole pool and a client that goes away stops the
+    work after the current window. Identical segments being synthesized for
+    several requests at once are synthesized once.
+    """
+
+    def __init__(self, engine: TTSEngine, cache: Optional[AudioCache] = None, workers: int = 4,
+                 max_chars: int = 200, timeout: float = 30.0, window: Optional[int] = None,
+                 timer: Optional[Callable[[], ContextManager]] = None):
+        self.engine = engine
+        self.cache = cache
+        self.workers = workers
+        self.max_chars = max_chars
+        self.timeout = timeout
+        self.window = window or workers
+        self.timer = timer or nullcontext
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.segments = 0
+        self.synthesized = 0
+        self.synth_seconds = 0.0
+
+    def segment_audio(self, text: str, lang: str) -> bytes:
+        key = audio_key(self.engine.name, lang, text)
+        if self.cache is not None:
+            audio = self.cache.get(key)
+            if audio is not None:
+                return audio
+        return self._flight.do(key, lambda: self._synthesize(key, text, lang), wait_timeout=self.timeout)
+
+    def _synthesize(self, key: str, text: str, lang: str) -> bytes:
+        t = time.perf_counter()
+        with self.timer():
+            audio = self.engine.synthesize(text, lang)
+        with self._lock:
+            self.synthesized += 1
+            self.synth_seconds += time.perf_counter() - t
+        if self.cache is not None and audio:
+            self.cache.put(key, audio)
+        return audio
+
+    def _submit(self, text: str, lang: str):
+        ctx = contextvars.copy_context()  # spans opened on the pool join the request's trace
+        return self.executor.submit(ctx.run, self.segment_audio, text, lang)
+
+    def stream(self, text: str, lang: str) -> Iterator[bytes]:
+        segments = split_segments(text, self.max_chars)
+        with self._lock:
+            self.requests += 1
+            self.segments += len(segments)
+        todo = iter(segments)
+        pending = deque(self._submit(s, lang) for s, _ in zip(todo, range(self.window)))
+        try:
+            while pending:
+                audio = pending.popleft().result(timeout=self.timeout)
+                nxt = next(todo, None)
+                if nxt is not None:
+                    pending.append(self._submit(nxt, lang))
+                yield audio
+        finally:
+            for f in pending:
+                f.cancel()  # the client went away or a segment failed
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        return b"".join(self.stream(text, lang))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            out = {
+                "engine": self.engine.name,
+                "workers": self.workers,
+                "requests": self.requests,
+                "segments": self.segments,
+                "synthesized": self.synthesized,
+                "synth_ms_mean": 1000 * self.synth_seconds / self.synthesized if self.synthesized else None,
+                "coalesced": self._flight.stats().get("coalesced"),
+            }
+        if self.cache is not None:
+            out["cache"] = self.cache.stats()
+        return out
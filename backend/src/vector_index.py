@@ -0,0 +1,338 @@
+"""
+Local, in-process vector index (drop-in for PineconeVectorStore).
+
+On-disk layout of an index directory::
+
+    meta.json          dim, count, dtype, mode, nlist, ...
+    vectors.bin        row-major float16 or int8 vectors (L2-normalised), memory-mapped
+    scales.bin         float32 per-row scale (int8 only)
+    chunks.jsonl       one {"id", "text", "metadata"} record per row
+    offsets.bin        uint64 byte offsets into chunks.jsonl (count + 1 entries)
+    centroids.bin      float32 IVF centroids            (ivf mode only)
+    ivf_rows.bin       int64 row ids grouped by list    (ivf mode only)
+    ivf_offsets.bin    int64 list boundaries (nlist+1)  (ivf mode only)
+
+Search is cosine similarity. "exact" mode scans the whole matrix (fast for the
+corpus sizes we have today); "ivf" mode probes the ``nprobe`` closest coarse
+clusters and is chosen automatically above ``IVF_AUTO_THRESHOLD`` rows.
+"""
+import os
+import json
+import mmap
+import shutil
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from langchain.schema import Document
+except Exception:  # keep the index usable without langchain installed
+    class Document:
+        def __init__(self, page_content: str, metadata: Optional[Dict] = None):
+            self.page_content = page_content
+            self.metadata = metadata or {}
+
+logger = logging.getLogger("medical-chatbot")
+
+IVF_AUTO_THRESHOLD = int(os.getenv("LOCAL_INDEX_IVF_THRESHOLD", "50000"))
+# Vectors up to this many bytes are upcast once to float32 in RAM for the fastest exact scans.
+FLOAT32_CACHE_BYTES = int(os.getenv("LOCAL_INDEX_F32_CACHE_MB", "64")) * 1024 * 1024
+_SCAN_BLOCK = 65536
+
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    mat = np.asarray(mat, dtype=np.float32)
+    norms = np.linalg.norm(mat, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+def _kmeans(sample: np.ndarray, nlist: int, iters: int = 15, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on normalised vectors."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(sample.shape[0], size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        if empty.any():
+            sums[empty] = sample[rng.integers(sample.shape[0], size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+# ---------------- writer ----------------
+class LocalIndexWriter:
+    """
+    Streams vectors + chunk texts to disk so builds never hold the corpus in RAM.
+    Files are written to ``<path>.building`` and swapped in atomically by ``finalize()``.
+    """
+
+    def __init__(self, path: str, dim: int, dtype: str = "float16"):
+        if dtype not in ("float16", "int8"):
+            raise ValueError("dtype must be 'float16' or 'int8'")
+        self.path = os.path.abspath(path)
+        self.tmp = self.path + ".building"
+        self.dim = dim
+        self.dtype = dtype
+        self.count = 0
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self._vec_f = open(os.path.join(self.tmp, "vectors.bin"), "wb")
+        self._scale_f = open(os.path.join(self.tmp, "scales.bin"), "wb") if dtype == "int8" else None
+        self._chunk_f = open(os.path.join(self.tmp, "chunks.jsonl"), "wb")
+        self._offsets = [0]
+        self._lock = threading.Lock()
+
+    def add(self, vectors: Sequence[Sequence[float]], texts: Sequence[str],
+            metadatas: Optional[Sequence[Dict]] = None, ids: Optional[Sequence[str]] = None):
+        vecs = _normalize(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+        if len(texts) != vecs.shape[0]:
+            raise ValueError("vectors and texts length mismatch")
+        metadatas = metadatas or [{}] * len(texts)
+        with self._lock:
+            if self.dtype == "float16":
+                self._vec_f.write(vecs.astype(np.float16).tobytes())
+            else:
+                scales = np.abs(vecs).max(axis=1) / 127.0
+                scales[scales == 0] = 1.0
+                q = np.clip(np.rint(vecs / scales[:, None]), -127, 127).astype(np.int8)
+                self._vec_f.write(q.tobytes())
+                self._scale_f.write(scales.astype(np.float32).tobytes())
+            for i, text in enumerate(texts):
+                rec = {
+                    "id": ids[i] if ids else str(self.count + i),
+                    "text": text,
+                    "metadata": metadatas[i] or {},
+                }
+                line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+                self._chunk_f.write(line)
+                self._offsets.append(self._offsets[-1] + len(line))
+            self.count += len(texts)
+
+    def finalize(self, mode: str = "auto", nlist: Optional[int] = None) -> str:
+        for f in (self._vec_f, self._scale_f, self._chunk_f):
+            if f is not None:
+                f.close()
+        np.asarray(self._offsets, dtype=np.uint64).tofile(os.path.join(self.tmp, "offsets.bin"))
+
+        if mode == "auto":
+            mode = "ivf" if self.count >= IVF_AUTO_THRESHOLD else "exact"
+        meta = {"dim": self.dim, "count": self.count, "dtype": self.dtype, "mode": mode, "metric": "cosine"}
+
+        if mode == "ivf" and self.count:
+            nlist = nlist or max(1, int(4 * np.sqrt(self.count)))
+            nlist = min(nlist, self.count)
+            meta["nlist"] = nlist
+            self._build_ivf(nlist)
+
+        with open(os.path.join(self.tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+        old = self.path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.replace(self.path, old)
+        os.replace(self.tmp, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+        logger.info("Local vector index written: %s (%d vectors, %s, %s)", self.path, self.count, self.dtype, mode)
+        return self.path
+
+    def _build_ivf(self, nlist: int):
+        index = LocalVectorIndex(self.tmp, meta={"dim": self.dim, "count": self.count, "dtype": self.dtype,
+                                                 "mode": "exact"})
+        rng = np.random.default_rng(0)
+        sample_n = min(self.count, max(nlist * 64, 10000))
+        sample_rows = np.sort(rng.choice(self.count, size=sample_n, replace=False))
+        centroids = _kmeans(index.rows_float32(sample_rows), nlist)
+
+        assign = np.empty(self.count, dtype=np.int64)
+        for start in range(0, self.count, _SCAN_BLOCK):
+            stop = min(start + _SCAN_BLOCK, self.count)
+            block = index.rows_float32(np.arange(start, stop))
+            assign[start:stop] = np.argmax(block @ centroids.T, axis=1)
+        index.close()
+
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        counts = np.bincount(assign, minlength=nlist)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        centroids.astype(np.float32).tofile(os.path.join(self.tmp, "centroids.bin"))
+        order.tofile(os.path.join(self.tmp, "ivf_rows.bin"))
+        offsets.tofile(os.path.join(self.tmp, "ivf_offsets.bin"))
+
+
+# ---------------- reader / search ----------------
+class LocalVectorIndex:
+    def __init__(self, path: str, meta: Optional[Dict] = None):
+        self.path = os.path.abspath(path)
+        if meta is None:
+            with open(os.path.join(self.path, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        self.meta = meta
+        self.dim = int(meta["dim"])
+        self.count = int(meta["count"])
+        self.dtype = meta["dtype"]
+        self.mode = meta.get("mode", "exact")
+
+        np_dtype = np.float16 if self.dtype == "float16" else np.int8
+        self.vectors = (np.memmap(os.path.join(self.path, "vectors.bin"), dtype=np_dtype, mode="r",
+                                  shape=(self.count, self.dim)) if self.count else np.zeros((0, self.dim), np_dtype))
+        self.scales = None
+        if self.dtype == "int8" and self.count:
+            self.scales = np.fromfile(os.path.join(self.path, "scales.bin"), dtype=np.float32)
+
+        self._f32 = None
+        if self.count and self.count * self.dim * 4 <= FLOAT32_CACHE_BYTES:
+            self._f32 = self.rows_float32(slice(None))
+
+        self._chunks_file = None
+        self._chunks = None
+        self._offsets = None
+        chunks_path = os.path.join(self.path, "chunks.jsonl")
+        if os.path.exists(chunks_path) and os.path.getsize(chunks_path):
+            self._chunks_file = open(chunks_path, "rb")
+            self._chunks = mmap.mmap(self._chunks_file.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets_path = os.path.join(self.path, "offsets.bin")
+        if os.path.exists(offsets_path):
+            self._offsets = np.fromfile(offsets_path, dtype=np.uint64)
+
+        self.centroids = None
+        if self.mode == "ivf" and self.count:
+            nlist = int(meta["nlist"])
+            self.centroids = np.fromfile(os.path.join(self.path, "centroids.bin"),
+                                         dtype=np.float32).reshape(nlist, self.dim)
+            self.ivf_rows = np.fromfile(os.path.join(self.path, "ivf_rows.bin"), dtype=np.int64)
+            self.ivf_offsets = np.fromfile(os.path.join(self.path, "ivf_offsets.bin"), dtype=np.int64)
+
+    @classmethod
+    def load(cls, path: str) -> "LocalVectorIndex":
+        return cls(path)
+
+    def rows_float32(self, rows) -> np.ndarray:
+        block = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            block *= self.scales[rows][:, None]
+        return block
+
+    def chunk(self, row: int) -> Dict:
+        start, stop = int(self._offsets[row]), int(self._offsets[row + 1])
+        return json.loads(self._chunks[start:stop].decode("utf-8"))
+
+    def ids(self) -> List[str]:
+        return [self.chunk(row)["id"] for row in range(self.count)]
+
+    def _scores_exact(self, q: np.ndarray) -> np.ndarray:
+        if self._f32 is not None:
+            return self._f32 @ q
+        scores = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, _SCAN_BLOCK):
+            stop = min(start + _SCAN_BLOCK, self.count)
+            scores[start:stop] = self.rows_float32(slice(start, stop)) @ q
+        return scores
+
+    def search_vector(self, query_vec: Sequence[float], k: int = 4,
+                      nprobe: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Return [(row, cosine score)] best first."""
+        if not self.count:
+            return []
+        q = _normalize(np.asarray(query_vec, dtype=np.float32).reshape(self.dim))
+        if self.mode == "ivf" and self.centroids is not None:
+            nprobe = nprobe or int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+            lists = _top_k(self.centroids @ q, nprobe)
+            cand = np.concatenate([self.ivf_rows[self.ivf_offsets[c]:self.ivf_offsets[c + 1]] for c in lists])
+            if cand.size == 0:
+                return []
+            cand.sort()  # sequential memmap access
+            if self._f32 is not None:
+                scores = self._f32[cand] @ q
+            else:
+                scores = self.rows_float32(cand) @ q
+            best = _top_k(scores, k)
+            return [(int(cand[i]), float(scores[i])) for i in best]
+        scores = self._scores_exact(q)
+        return [(int(i), float(scores[i])) for i in _top_k(scores, k)]
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks_file.close()
+            self._chunks = None
+
+
+# ---------------- LangChain-style wrappers ----------------
+class LocalRetriever:
+    def __init__(self, store: "LocalVectorStore", k: int = 4):
+        self.store = store
+        self.k = k
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return self.store.similarity_search(query, k=self.k)
+
+    def invoke(self, query: str, config=None) -> List[Document]:
+        return self.get_relevant_documents(query)
+
+
+class LocalVectorStore:
+    """Mirrors the subset of PineconeVectorStore the app and store_index.py use."""
+
+    def __init__(self, index: LocalVectorIndex, embedding):
+        self.index = index
+        self.embedding = embedding
+
+    @classmethod
+    def from_existing_index(cls, path: str, embedding) -> "LocalVectorStore":
+        return cls(LocalVectorIndex.load(path), embedding)
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[Document], embedding, path: str, dtype: str = "float16",
+                       mode: str = "auto", batch_size: int = 256) -> "LocalVectorStore":
+        writer = None
+        batch: List[Document] = []
+
+        def flush():
+            nonlocal writer
+            if not batch:
+                return
+            vecs = embedding.embed_documents([d.page_content for d in batch])
+            if writer is None:
+                writer = LocalIndexWriter(path, dim=len(vecs[0]), dtype=dtype)
+            writer.add(vecs, [d.page_content for d in batch], [d.metadata for d in batch])
+            batch.clear()
+
+        for doc in documents:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+        if writer is None:
+            writer = LocalIndexWriter(path, dim=len(embedding.embed_query("test")), dtype=dtype)
+        writer.finalize(mode=mode)
+        return cls.from_existing_index(path, embedding)
+
+    def similarity_search_by_vector_with_score(self, embedding: Sequence[float], k: int = 4):
+        out = []
+        for row, score in self.index.search_vector(embedding, k=k):
+            rec = self.index.chunk(row)
+            out.append((Document(page_content=rec["text"], metadata=rec.get("metadata") or {}), score))
+        return out
+
+    def similarity_search_with_score(self, query: str, k: int = 4):
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k=k)
+
+    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+        return [d for d, _ in self.similarity_search_with_score(query, k=k)]
+
+    def as_retriever(self, search_type: str = "similarity", search_kwargs: Optional[Dict] = None) -> LocalRetriever:
+        return LocalRetriever(self, k=(search_kwargs or {}).get("k", 4))
@@ -1,44 +1,87 @@
 from dotenv import load_dotenv
 import os
-from src.helper import load_pdf_file, filter_to_minimal_docs, text_split, download_hugging_face_embeddings
-from pinecone import Pinecone
-from pinecone import ServerlessSpec 
-from langchain_pinecone import PineconeVectorStore
+import argparse
+import logging
+
+from src.ingest import (run_ingestion, PineconeSink, LocalIndexSink, LexicalIndexSink, MultiSink,
+                        UntrackedIndexError)
+from src.manifest import IngestManifest, PageTextCache
 
 load_dotenv()
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+# "pinecone" (default) or "local" (writes an in-process index for VECTOR_BACKEND=local)
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 'pinecone').lower()
+LOCAL_INDEX_DIR = os.environ.get('LOCAL_INDEX_DIR', 'vector_index')
+LOCAL_INDEX_DTYPE = os.environ.get('LOCAL_INDEX_DTYPE', 'float16')  # float16 | int8
+LOCAL_INDEX_MODE = os.environ.get('LOCAL_INDEX_MODE', 'auto')       # auto | exact | ivf
+# BM25 index over the same chunks, fused with dense results at query time (src/lexical_index.py)
+LEXICAL_INDEX_DIR = os.environ.get('LEXICAL_INDEX_DIR', 'lexical_index')
 
 PINECONE_API_KEY=os.environ.get('PINECONE_API_KEY')
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
 
-os.environ["PINECONE_API_KEY"] = PINECONE_API_KEY
-os.environ["GITHUB_TOKEN"] = GITHUB_TOKEN
+if PINECONE_API_KEY:
+    os.environ["PINECONE_API_KEY"] = PINECONE_API_KEY
+if GITHUB_TOKEN:
+    os.environ["GITHUB_TOKEN"] = GITHUB_TOKEN
+
+index_name = os.environ.get("PINECONE_INDEX", "medical-chatbot")  # change if desired
 
+# manifests (file + chunk hashes) and extracted page text for incremental runs
+INDEX_CACHE_DIR = os.environ.get('INDEX_CACHE_DIR', '.index_cache')
 
-extracted_data=load_pdf_file(data='data/')
-filter_data = filter_to_minimal_docs(extracted_data)
-text_chunks=text_split(filter_data)
 
-embeddings = download_hugging_face_embeddings()
+def make_pinecone_sink():
+    from pinecone import Pinecone
+    from pinecone import ServerlessSpec
 
-pinecone_api_key = PINECONE_API_KEY
-pc = Pinecone(api_key=pinecone_api_key)
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    if not pc.has_index(index_name):
+        pc.create_index(
+            name=index_name,
+            dimension=384,
+            metric="cosine",
+            spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+        )
+    return PineconeSink(pc.Index(index_name))
 
-index_name = "medical-chatbot"  # change if desired
 
-if not pc.has_index(index_name):
-    pc.create_index(
-        name=index_name,
-        dimension=384,
-        metric="cosine",
-        spec=ServerlessSpec(cloud="aws", region="us-east-1"),
-    )
+def main():
+    parser = argparse.ArgumentParser(description="Embed the PDF corpus into the vector store.")
+    parser.add_argument("--data", default="data/", help="directory containing *.pdf files")
+    parser.add_argument("--backend", default=VECTOR_BACKEND, choices=["pinecone", "local"])
+    parser.add_argument("--parse-workers", type=int, default=None, help="PDF parser processes (default: cores-1)")
+    parser.add_argument("--embed-batch", type=int, default=256, help="chunks per embedding call")
+    parser.add_argument("--upsert-workers", type=int, default=4, help="concurrent upsert batches")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore the manifest, clear the store and re-embed everything")
+    parser.add_argument("--no-lexical", action="store_true", help="do not build the BM25 index")
+    args = parser.parse_args()
 
-index = pc.Index(index_name)
+    if args.backend == "local":
+        sink = LocalIndexSink(LOCAL_INDEX_DIR, dtype=LOCAL_INDEX_DTYPE, mode=LOCAL_INDEX_MODE, carry_over=True)
+        manifest_name = "manifest-local.json"
+    else:
+        sink = make_pinecone_sink()
+        manifest_name = f"manifest-pinecone-{index_name}.json"
+    if not args.no_lexical:
+        sink = MultiSink(sink, LexicalIndexSink(LEXICAL_INDEX_DIR))
 
+    try:
+        run_ingestion(
+            args.data,
+            sink,
+            parse_workers=args.parse_workers,
+            embed_batch=args.embed_batch,
+            upsert_workers=args.upsert_workers,
+            manifest=IngestManifest(os.path.join(INDEX_CACHE_DIR, manifest_name)),
+            page_cache=PageTextCache(os.path.join(INDEX_CACHE_DIR, "pages")),
+            full=args.full,
+        )
+    except UntrackedIndexError as e:
+        parser.exit(2, f"{parser.prog}: error: {e}\n")
 
-docsearch = PineconeVectorStore.from_documents(
-    documents=text_chunks,
-    index_name=index_name,
-    embedding=embeddings, 
-)
 
+if __name__ == "__main__":
+    main()
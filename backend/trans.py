@@ -1,11 +1,13 @@
 # translator_deep.py
-from deep_translator import GoogleTranslator
+from src.translation import GoogleTranslateBackend, Translator
+
+# one GoogleTranslator per target language; translated lines are cached (see src/translation.py)
+_translator = Translator(GoogleTranslateBackend())
 
 # translate_text: detects source automatically, translates to target_lang
 def translate_text(text: str, target_lang: str = 'en') -> str:
     try:
-        translated = GoogleTranslator(source='auto', target=target_lang).translate(text)
-        return translated
+        return _translator.translate(text, target_lang)
     except Exception as e:
         print("Translation error:", e)
         return text